@@ -0,0 +1,345 @@
+"""
+Batch runs of the model PADF calculator from a job spec
+
+A spec (TOML or JSON) gives the ModelPadfCalculator attributes shared by all jobs, optional
+explicit jobs overriding them, a sweep (one job per combination of the listed values) and
+optional MD frames (one job per frame of every sweep point, summed into a trajectory result):
+
+    [calculator]
+    root = "/data/model_padf/"
+    project = "fm3m/"
+    tag = "fm3m"
+    subject_atoms = "fm3m.cif"
+    rmax = 10.0
+    nr = 100
+    nth = 180
+
+    [sweep]
+    nth = [90, 180]
+    convergence_target = [0.5, 0.9]
+
+    [frames]
+    glob = "md_frame_*_sc.xyz"      # or files = [...], in root + project
+
+    [batch]
+    workers = 4
+
+The stages of each job (setup, pairing, trimming, then accumulation and saving) form a graph keyed
+by the parameters each stage depends on. A setup, pairing or trimming result shared by several
+jobs is computed once and handed to them, so a sweep over convergence_target or nth reuses the
+pair table. Independent tasks run in a pool of worker processes. Finished jobs are recorded in
+{spec}_batch_log.json and skipped when the batch is run again. Shared stages write their side
+outputs (clean atoms, pair lists, PDF) once, under the tag of the job that ran them.
+
+    python batch_runner.py <spec.toml | spec.json> [workers]
+
+@author: andrewmartin, jack-binns
+"""
+import concurrent.futures
+import glob
+import hashlib
+import itertools
+import json
+import os
+import socket
+import sys
+import time
+
+import numpy as np
+
+import fast_model_padf as fmp
+import padf_io
+import utils
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    tomllib = None
+
+# Shared stages in graph order, the calculator parameters each depends on (besides the stages before it)
+# and the calculator attributes that hold its result
+STAGE_PARAMETERS = {
+    'setup': ('root', 'project', 'subject_atoms', 'supercell_atoms', 'unit_cell_dimensions', 'periodic_flag',
+              'lattice_vectors', 'symmetry_mode', 'rmax', 'com_cluster_flag', 'com_radius', 'cluster_centre'),
+    'pairing': ('nr',),
+    'trimming': ('rmin', 'vector_dtype', 'probe_radii'),
+}
+STAGE_ATTRIBUTES = {
+    'setup': ('subject_atoms', 'extended_atoms', 'raw_extended_atoms', 'subject_orbits', 'lattice_vectors',
+              'species_z', 'n_species_pairs'),
+    'pairing': ('n2_contacts', 'interatomic_vectors'),
+    'trimming': ('interatomic_vectors',),
+}
+SHARED_STAGES = tuple(STAGE_PARAMETERS)
+
+
+def load_spec(path):
+    """
+    Reads a job spec from a .toml or .json file
+    :return: dict
+    """
+    if path.endswith('.toml'):
+        if tomllib is None:
+            raise ImportError('<batch_runner.load_spec> TOML specs need Python 3.11 or later, use a JSON spec')
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def format_value(value):
+    return f'{value:g}' if isinstance(value, float) else str(value)
+
+
+def parameter_key(parameters, names, upstream=''):
+    """
+    Hash of the named parameters and the key of the stage before
+    """
+    values = json.dumps({name: parameters.get(name) for name in names}, sort_keys=True, default=repr)
+    return hashlib.sha1((upstream + values).encode()).hexdigest()[:16]
+
+
+def make_calculator(parameters):
+    """
+    ModelPadfCalculator with the job parameters set. Strings given for dtype attributes
+    (e.g. vector_dtype = "float64") are numpy types
+    """
+    calc = fmp.ModelPadfCalculator()
+    for key, value in parameters.items():
+        if not hasattr(calc, key):
+            raise ValueError(f"<batch_runner.make_calculator> ModelPadfCalculator has no parameter '{key}'")
+        if isinstance(getattr(calc, key), type) and isinstance(value, str):
+            value = getattr(np, value)
+        setattr(calc, key, value)
+    return calc
+
+
+def run_stages(parameters, state, stages):
+    """
+    Runs stages of a job on a fresh calculator, starting from the state left by the stages before them
+    :param parameters: calculator parameters of the job
+    :param state: dict of calculator attributes set by the earlier stages (empty to start from setup)
+    :param stages: names of the stages to run, in order
+    :return: the attributes of all stages run so far for a shared stage, or a summary of the finished job
+    """
+    calc = make_calculator(parameters)
+    calc.run_start = time.time()
+    calc.setup_instrument()
+    calc.setup_writer()
+    if stages[0] != 'setup':
+        calc.parameter_check()
+        calc.write_all_params_to_file()
+        calc.get_dimension()
+    for key, value in state.items():
+        setattr(calc, key, value)
+    for stage in stages:
+        getattr(calc, f'run_{stage}')()
+    if stages[-1] != 'saving':
+        calc.writer.flush()
+        done = SHARED_STAGES[:SHARED_STAGES.index(stages[-1]) + 1]
+        return {key: getattr(calc, key) for stage in done for key in STAGE_ATTRIBUTES[stage]}
+    return {'tag': calc.tag, 'contacts': int(calc.total_contribs), 'reference_vectors': int(calc.converged_loop),
+            'converged': bool(calc.converged_flag), 'calculation_time': calc.calculation_time}
+
+
+class InlineExecutor(concurrent.futures.Executor):
+    """
+    Runs each task as it is submitted (a single worker, no processes)
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class BatchRunner:
+
+    def __init__(self, spec, workers=None, log_path=None):
+        self.spec = spec
+        self.workers = workers if workers is not None else spec.get('batch', {}).get('workers', 1)
+        self.log_path = log_path  # finished jobs, None keeps no log
+        self.jobs = self.expand_jobs()
+        self.completed = {}  # job key : summary
+
+    @classmethod
+    def from_file(cls, path, workers=None):
+        return cls(load_spec(path), workers=workers, log_path=os.path.splitext(path)[0] + '_batch_log.json')
+
+    def frame_files(self):
+        frames = self.spec.get('frames', {})
+        if 'glob' not in frames:
+            return list(frames.get('files', []))
+        calculator = self.spec.get('calculator', {})
+        paths = glob.glob(f"{calculator.get('root', '')}{calculator.get('project', '')}{frames['glob']}")
+        return [os.path.basename(path) for path in utils.sorted_nicely(paths)]
+
+    def expand_jobs(self):
+        """
+        One job per explicit job, sweep combination and frame
+        :return: list of dicts with the job 'parameters', its 'key' and 'point' (the tag of its sweep point)
+        """
+        calculator = self.spec.get('calculator', {})
+        sweep = self.spec.get('sweep', {})
+        frames = self.frame_files()
+        jobs = []
+        for overrides in self.spec.get('jobs', [{}]):
+            for values in itertools.product(*sweep.values()):
+                point = dict(calculator, **overrides)
+                point.update(zip(sweep, values))
+                point['tag'] = point.get('tag', '') + ''.join(f'_{name}{format_value(value)}'
+                                                              for name, value in zip(sweep, values))
+                for k, frame in (enumerate(frames) if frames else [(None, None)]):
+                    parameters = dict(point)
+                    if frame is not None:
+                        parameters.update(subject_atoms=frame, supercell_atoms=frame, tag=f"{point['tag']}_{k}")
+                    make_calculator(parameters)  # fails on unknown parameters before anything runs
+                    jobs.append({'parameters': parameters, 'point': point['tag'] if frames else None,
+                                 'key': parameter_key(parameters, sorted(parameters))})
+        tags = [job['parameters']['tag'] for job in jobs]
+        if len(set(tags)) < len(tags):
+            raise ValueError('<batch_runner.expand_jobs> jobs with the same tag, give each explicit job its own tag')
+        return jobs
+
+    def stage_keys(self, parameters):
+        """
+        Keys of the shared stages of a job, each covering the stages before it
+        """
+        keys, key = [], ''
+        for stage in SHARED_STAGES:
+            key = parameter_key(parameters, STAGE_PARAMETERS[stage], key)
+            keys.append(key)
+        return keys
+
+    def build_graph(self, jobs):
+        """
+        Tasks of the batch. A shared stage is its own task (and its result is kept) when it has more than
+        one distinct next stage, otherwise it runs in the same task as the stage after it
+        :return: dict of task key : (stages, parent task key or None, job or None)
+        """
+        chains = {job['key']: self.stage_keys(job['parameters']) + [job['key']] for job in jobs}
+        children = {}
+        for chain in chains.values():
+            for parent, child in zip(chain, chain[1:]):
+                children.setdefault(parent, set()).add(child)
+        tasks = {}
+        for job in jobs:
+            chain, parent, start = chains[job['key']], None, 0
+            for level, key in enumerate(chain):
+                job_level = level == len(SHARED_STAGES)
+                if not job_level and len(children[key]) < 2:
+                    continue
+                stages = (SHARED_STAGES + ('accumulation', 'saving'))[start:level + 1 if not job_level else None]
+                tasks[key] = (stages, parent, job if job_level else None)
+                parent, start = key, level + 1
+        return tasks
+
+    def read_log(self):
+        if self.log_path is None or not os.path.exists(self.log_path):
+            return {}
+        with open(self.log_path) as f:
+            return json.load(f)
+
+    def write_log(self):
+        if self.log_path is None:
+            return
+        tmp = self.log_path + f'.{socket.gethostname()}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.completed, f, indent=2)
+        os.replace(tmp, self.log_path)
+
+    def prepare_projects(self, jobs):
+        """
+        Creates each project folder (copying the input files) before the workers start
+        """
+        for job in jobs:
+            parameters = job['parameters']
+            if not os.path.isdir(parameters.get('root', '') + parameters.get('project', '')):
+                make_calculator(parameters).write_all_params_to_file()
+
+    def run(self):
+        """
+        Runs the jobs not finished yet, then consolidates the frames of each sweep point
+        :return: dict of job key : summary
+        """
+        self.completed = self.read_log()
+        jobs = [job for job in self.jobs if job['key'] not in self.completed]
+        print(f'<batch_runner.run> {len(jobs)} of {len(self.jobs)} jobs to run')
+        self.prepare_projects(jobs)
+        tasks = self.build_graph(jobs)
+        waiting = {key: len([t for t in tasks.values() if t[1] == key]) for key in tasks}
+        states = {}
+        running = {}
+        executor = InlineExecutor() if self.workers <= 1 else concurrent.futures.ProcessPoolExecutor(self.workers)
+        with executor:
+            pending = dict(tasks)
+            while pending or running:
+                for key, (stages, parent, job) in list(pending.items()):
+                    if parent is not None and parent not in states:
+                        continue
+                    parameters = job['parameters'] if job else self.task_parameters(key, jobs, tasks)
+                    state = states.get(parent, {})
+                    running[executor.submit(run_stages, parameters, state, stages)] = key
+                    del pending[key]
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    key = running.pop(future)
+                    stages, parent, job = tasks[key]
+                    result = future.result()
+                    if job is None:
+                        states[key] = result
+                    else:
+                        self.completed[key] = result
+                        self.write_log()
+                        print(f"<batch_runner.run> {result['tag']} finished: {result['contacts']} contacts")
+                    if parent is not None:
+                        waiting[parent] -= 1
+                        if waiting[parent] == 0:
+                            del states[parent]
+        self.consolidate_frames()
+        return self.completed
+
+    @staticmethod
+    def task_parameters(key, jobs, tasks):
+        """
+        Parameters of a shared stage task: those of any job that runs through it
+        """
+        for job in jobs:
+            task = job['key']
+            while task is not None:
+                if task == key:
+                    return job['parameters']
+                task = tasks[task][1]
+        raise KeyError(key)
+
+    def consolidate_frames(self):
+        """
+        Sums the frames of each sweep point into {point}_trajectory_mPADF_*_sum.npy (or appends
+        them to {point}_trajectory_mPADF.h5)
+        :return:
+        """
+        points = {}
+        for job in self.jobs:
+            if job['point'] is not None:
+                points.setdefault(job['point'], []).append(job['parameters'])
+        for point, frames in points.items():
+            path = frames[0].get('root', '') + frames[0].get('project', '')
+            if frames[0].get('output_format', 'npy') == 'hdf5':
+                for parameters in frames:
+                    arrays = {part: padf_io.read_theta(f"{path}{parameters['tag']}_mPADF.h5", part)
+                              for part in ('total', 'odds', 'evens')}
+                    padf_io.append_trajectory_frame(f'{path}{point}_trajectory_mPADF.h5', parameters['tag'], arrays)
+            else:
+                for part in ('total', 'odds', 'evens'):
+                    trajectory = sum(np.load(f"{path}{parameters['tag']}_mPADF_{part}_sum.npy") for parameters in frames)
+                    np.save(f'{path}{point}_trajectory_mPADF_{part}_sum.npy', trajectory)
+            print(f'<batch_runner.consolidate_frames> {len(frames)} frames summed into {point}')
+
+
+if __name__ == '__main__':
+    # python batch_runner.py <spec.toml | spec.json> [workers]
+    runner = BatchRunner.from_file(sys.argv[1], workers=int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    runner.run()
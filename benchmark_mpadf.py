@@ -0,0 +1,311 @@
+"""
+Model PADF benchmark suite
+
+Generates synthetic structures (FCC lattice, random amorphous cluster and
+MD-like jittered frames) at several sizes and times each stage of the model
+PADF pipeline separately. Results are written as JSON so runs can be compared
+between releases:
+
+    python benchmark_mpadf.py --sizes small medium --output bench.json
+    python benchmark_mpadf.py --sizes small --compare bench.json
+    python benchmark_mpadf.py --nr 256 --accumulation vector tiled
+
+Stage times come from an untraced run; the peak memory of each stage comes
+from a second run of the case under tracemalloc (skip it with --no_memory).
+
+@author: andrewmartin, jack-binns
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import controller
+import fast_model_padf as fmp
+import utils as u
+
+# Structure parameters for each size preset
+SIZES = {
+    'small': {'fcc_cells': 3, 'cluster_atoms': 150, 'md_atoms': 80, 'md_frames': 2},
+    'medium': {'fcc_cells': 4, 'cluster_atoms': 300, 'md_atoms': 150, 'md_frames': 3},
+    'large': {'fcc_cells': 5, 'cluster_atoms': 600, 'md_atoms': 300, 'md_frames': 4},
+}
+
+STRUCTURES = ['fcc', 'amorphous', 'md']
+
+
+def fcc_lattice(n_cells, a=3.615, z=29):
+    """
+    FCC supercell of n_cells^3 conventional cells, and the central cell as the subject set
+    :return: subject atoms, extended atoms as [x, y, z, Z]
+    """
+    basis = np.array([[0, 0, 0], [0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0]])
+    shifts = np.stack(np.meshgrid(*[np.arange(n_cells)] * 3, indexing='ij'), axis=-1).reshape(-1, 1, 3)
+    extended = ((shifts + basis[None, :, :]).reshape(-1, 3)) * a
+    extended = np.column_stack((extended, np.full(len(extended), float(z))))
+    centre = (n_cells // 2) * a
+    subject = extended[np.all((extended[:, :3] >= centre) & (extended[:, :3] < centre + a), axis=1)]
+    return subject, extended
+
+
+def amorphous_cluster(n_atoms, rng, density=0.08, min_distance=1.2, species=(6, 8)):
+    """
+    Random spherical cluster with a hard-sphere minimum distance. The whole cluster is the subject set
+    :return: subject atoms, extended atoms as [x, y, z, Z]
+    """
+    radius = (3 * n_atoms / (4 * np.pi * density)) ** (1 / 3)
+    positions = []
+    while len(positions) < n_atoms:
+        trial = rng.uniform(-radius, radius, 3)
+        if np.linalg.norm(trial) > radius:
+            continue
+        if positions and np.min(np.linalg.norm(np.array(positions) - trial, axis=1)) < min_distance:
+            continue
+        positions.append(trial)
+    atoms = np.column_stack((np.array(positions), rng.choice(species, n_atoms).astype(float)))
+    return atoms, atoms
+
+
+def md_frames(n_atoms, n_frames, rng, jitter=0.05):
+    """
+    MD-like trajectory: an amorphous cluster whose atoms are displaced by a small Gaussian jitter each frame
+    :return: list of (subject atoms, extended atoms)
+    """
+    base, _ = amorphous_cluster(n_atoms, rng)
+    frames = []
+    for _ in range(n_frames):
+        frame = base.copy()
+        frame[:, :3] += rng.normal(scale=jitter, size=(n_atoms, 3))
+        frames.append((frame, frame))
+    return frames
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    """
+    Silences the calculator's print output unless verbose (then it goes to stderr, stdout
+    is kept for the JSON results)
+    """
+    if verbose:
+        with contextlib.redirect_stdout(sys.stderr):
+            yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+class StageTimer:
+    """
+    Times stages, and records the peak traced memory of each if trace (tracemalloc must be running;
+    tracing slows the calculation down, so its times are not comparable to an untraced run)
+    """
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.trace:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if self.trace else 0
+        record = self.stages.setdefault(name, {'time_s': 0.0, 'peak_memory_bytes': 0, 'calls': 0})
+        record['time_s'] += elapsed
+        record['peak_memory_bytes'] = max(record['peak_memory_bytes'], peak)
+        record['calls'] += 1
+
+
+def run_frame(work_dir, tag, subject, extended, args, timer, accumulation='vector'):
+    """
+    Runs the pipeline on one structure, stage by stage
+    :return: the calculator
+    """
+    with quiet(args.verbose):
+        u.output_reference_xyz(subject, path=os.path.join(work_dir, f'{tag}_subject.xyz'))
+        u.output_reference_xyz(extended, path=os.path.join(work_dir, f'{tag}_supercell.xyz'))
+    mpc = fmp.ModelPadfCalculator()
+    mpc.root = work_dir + os.sep
+    mpc.project = ''
+    mpc.tag = tag
+    mpc.rmax = args.rmax
+    mpc.nr = args.nr
+    mpc.nth = args.nth
+    mpc.seed = args.seed
+    mpc.convergence_target = args.convergence_target
+    mpc.accumulation = accumulation
+    mpc.tile_references = args.tile_references
+    mpc.tile_partners = args.tile_partners
+    with quiet(args.verbose):
+        mpc.parameter_check()
+        mpc.write_all_params_to_file()
+        with timer.stage('read_xyz'):
+            mpc.subject_atoms = u.read_xyz(os.path.join(work_dir, f'{tag}_subject.xyz'))
+            mpc.raw_extended_atoms = u.read_xyz(os.path.join(work_dir, f'{tag}_supercell.xyz'))
+        with timer.stage('clean_extended_atoms'):
+            mpc.extended_atoms = mpc.clean_extended_atoms()
+            mpc.species_setup()
+        with timer.stage('pair_dist_calculation'):
+            mpc.interatomic_vectors = mpc.pair_dist_calculation()
+        with timer.stage('trim_interatomic_vectors_to_probe'):
+            mpc.trim_interatomic_vectors_to_probe()
+        with timer.stage('theta_loop'):
+            mpc.accumulate_theta()
+        with timer.stage('consolidation'):
+            mpc.save_theta()
+    return mpc
+
+
+def run_case(structure, size, args, rng, accumulation='vector', trace=False):
+    """
+    Benchmarks one structure at one size with one accumulation mode
+    :param trace: record the peak traced memory of each stage (tracemalloc must be running)
+    :return: dict of results
+    """
+    preset = SIZES[size]
+    if structure == 'fcc':
+        frames = [fcc_lattice(preset['fcc_cells'])]
+    elif structure == 'amorphous':
+        frames = [amorphous_cluster(preset['cluster_atoms'], rng)]
+    else:
+        frames = md_frames(preset['md_atoms'], preset['md_frames'], rng)
+    work_dir = tempfile.mkdtemp(prefix=f'mpadf_bench_{structure}_{size}_')
+    timer = StageTimer(trace)
+    contacts = 0
+    n_vectors = 0
+    try:
+        for k, (subject, extended) in enumerate(frames):
+            tag = f'{structure}_{k}' if structure == 'md' else structure
+            mpc = run_frame(work_dir, tag, subject, extended, args, timer, accumulation)
+            contacts += mpc.total_contribs
+            n_vectors += len(mpc.interatomic_vectors)
+        if structure == 'md':
+            cont = controller.MPADFController(root=work_dir + os.sep, project='', tag=structure,
+                                              rmax=args.rmax, nr=args.nr, nth=args.nth)
+            with quiet(args.verbose), timer.stage('consolidation'):
+                cont.consolidate_md_results()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    loop_time = timer.stages['theta_loop']['time_s']
+    if not trace:
+        for stage in timer.stages.values():
+            stage['peak_memory_bytes'] = None
+    return {
+        'structure': structure,
+        'size': size,
+        'accumulation': accumulation,
+        'frames': len(frames),
+        'subject_atoms': int(sum(len(f[0]) for f in frames)),
+        'extended_atoms': int(sum(len(f[1]) for f in frames)),
+        'interatomic_vectors': int(n_vectors),
+        'contacts': float(contacts),
+        'contacts_per_second': float(contacts / loop_time) if loop_time > 0 else None,
+        'total_time_s': float(sum(s['time_s'] for s in timer.stages.values())),
+        'peak_memory_bytes': int(max(s['peak_memory_bytes'] for s in timer.stages.values())) if trace else None,
+        'stages': timer.stages,
+    }
+
+
+def compare(results, previous_path):
+    """
+    Prints the ratio of each stage time to a previous benchmark run
+    """
+    with open(previous_path) as f:
+        previous = {(c['structure'], c['size'], c.get('accumulation', 'vector')): c for c in json.load(f)['cases']}
+    print(f'<benchmark_mpadf.compare> time ratios against {previous_path} (>1 is slower)', file=sys.stderr)
+    for case in results['cases']:
+        old = previous.get((case['structure'], case['size'], case['accumulation']))
+        if old is None:
+            continue
+        for name, stage in case['stages'].items():
+            if name in old['stages'] and old['stages'][name]['time_s'] > 0:
+                ratio = stage['time_s'] / old['stages'][name]['time_s']
+                print(f"{case['structure']:>10} {case['size']:>7} {case['accumulation']:>6} {name:>34} : {ratio:6.2f}",
+                      file=sys.stderr)
+
+
+def measure_memory(case, structure, size, args, seed, accumulation):
+    """
+    Reruns a case with tracemalloc on and copies the peak memory of each stage into the timed results
+    """
+    tracemalloc.start()
+    try:
+        traced = run_case(structure, size, args, np.random.default_rng(seed), accumulation, trace=True)
+    finally:
+        tracemalloc.stop()
+    for name, stage in case['stages'].items():
+        stage['peak_memory_bytes'] = traced['stages'][name]['peak_memory_bytes']
+    case['peak_memory_bytes'] = traced['peak_memory_bytes']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the model PADF pipeline on synthetic structures')
+    parser.add_argument('--structures', nargs='+', default=STRUCTURES, choices=STRUCTURES)
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=list(SIZES))
+    parser.add_argument('--rmax', type=float, default=6.0)
+    parser.add_argument('--nr', type=int, default=32)
+    parser.add_argument('--nth', type=int, default=90)
+    parser.add_argument('--convergence_target', type=float, default=2.0,
+                        help='odd/even cosine target, >1 processes every reference vector')
+    parser.add_argument('--accumulation', nargs='+', default=['vector'], choices=['vector', 'tiled'],
+                        help='accumulation modes to run, each structure is run once per mode')
+    parser.add_argument('--tile_references', type=int, default=64)
+    parser.add_argument('--tile_partners', type=int, default=8192)
+    parser.add_argument('--seed', type=int, default=888)
+    parser.add_argument('--output', default='', help='write the JSON results here (default: stdout)')
+    parser.add_argument('--compare', default='', help='previous JSON results to compare stage times against')
+    parser.add_argument('--verbose', action='store_true', help='show the calculator output')
+    parser.add_argument('--no_memory', action='store_true',
+                        help='skip the second, traced run of each case that measures peak memory')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'parameters': {'rmax': args.rmax, 'nr': args.nr, 'nth': args.nth, 'seed': args.seed,
+                           'convergence_target': args.convergence_target, 'tile_references': args.tile_references,
+                           'tile_partners': args.tile_partners},
+        },
+        'cases': [],
+    }
+    for size in args.sizes:
+        for structure in args.structures:
+            # Every accumulation mode sees the same structure
+            structure_seed = rng.integers(2 ** 32)
+            for accumulation in args.accumulation:
+                # Timed with tracing off, peak memory from a separate traced run
+                case = run_case(structure, size, args, np.random.default_rng(structure_seed), accumulation)
+                if not args.no_memory:
+                    measure_memory(case, structure, size, args, structure_seed, accumulation)
+                print(f"<benchmark_mpadf> {structure:>10} {size:>7} {accumulation:>6} : "
+                      f"{case['interatomic_vectors']} vectors, {case['total_time_s']:.3f} s, "
+                      f"{case['contacts_per_second'] or 0:.3e} contacts/s", file=sys.stderr)
+                results['cases'].append(case)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'<benchmark_mpadf> results written to {args.output}', file=sys.stderr)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,13 +4,21 @@ Model PADF MD controller
 @author: jack-binns, andrewmartin
 """
 import glob
+import os
+import re
 import shutil
+import subprocess
+import sys
+import time
 
 import numpy as np
 
 import utils
 
 import fast_model_padf as fmp
+import incremental_theta as it
+import work_queue as wq
+import padf_io
 import random
 import matplotlib.animation
 
@@ -37,9 +45,27 @@ class MPADFController:
         self.total_counts = 0
 
         self.convergence_target = 1.0
+        self.sampling = 'uniform'
+        self.error_bound = 0.0
+        self.accumulation = 'vector'
+        self.vector_dtype = np.float32  # float dtype of the vector tables (a numpy type or its name, e.g. 'float64')
+        self.output_format = 'npy'  # 'hdf5' : one container per frame and a trajectory container
         self.com_cluster_flag = False
         self.com_radius = 0.0
+        # Cluster centres sampled in every frame: None for one cluster at the centre of mass, or a (k, 3)
+        # array (e.g. from utils.cluster_centre_grid), each centre giving an independent frame result
+        self.cluster_centres = None
+        self.cached_frame = (None, None)  # (frame index, atoms) of the last frame read
+        # Incremental trajectory mode (run_incremental_mPADF_calc): atoms that moved at most incremental_tolerance
+        # keep their previous position (0 is exact), and every incremental_check_interval frames the volumes are
+        # checked against a full recompute (0 never)
+        self.incremental_tolerance = 0.0
+        self.incremental_check_interval = 0
         self.verbosity = 1
+        self.instrument = None  # shared by all frames, see instrumentation.py
+        # Writer shared by all frames (see output_writer.py): None writes synchronously, a BackgroundWriter
+        # writes each frame's output while the next frame is calculated. Waited for at the end of each run
+        self.writer = None
 
     def generate_calculation_plan(self, stringtag='_sc.xyz'):
         """
@@ -61,28 +87,30 @@ class MPADFController:
 
     def consolidate_md_results(self, clean_folder: bool = False,
                                animate: bool = False,
-                               total_string_tag: str = '*_mPADF_total_sum.npy',
-                               odd_string_tag: str = '*_mPADF_odds_sum.npy',
-                               even_string_tag: str = '*_mPADF_evens_sum.npy'):
+                               total_string_tag: str = None,
+                               odd_string_tag: str = None,
+                               even_string_tag: str = None):
         """
         Combine the mPADFs from each frame of an MD trajectory and combine them. Options to clean the folder up and make
         a movie.
         :param clean_folder: bool, delete files in work folder once results have been consolidated
         :param animate: bool, generate a movie for presentations
-        :param total_string_tag: str, suffix to denote the total sum from each MD frame,
-        unlikely to be changed from default value
-        :param odd_string_tag:  str, suffix to denote the odd contributions from each MD frame,
-        unlikely to be changed from default value
-        :param even_string_tag:  str, suffix to denote the even contributions from each MD frame,
-        unlikely to be changed from default value
+        :param total_string_tag: str, glob of the total sum from each MD frame, default None takes the
+        frames of this tag ({tag}_{k}_mPADF_total_sum.npy, not the probe sweep or rebinned volumes)
+        :param odd_string_tag:  str, glob of the odd contributions from each MD frame, default None as above
+        :param even_string_tag:  str, glob of the even contributions from each MD frame, default None as above
         :return:
         """
-        mpadf_list = utils.sorted_nicely(glob.glob(f'{self.root}{self.project}\\{total_string_tag}'))
-        odds_list = glob.glob(f'{self.root}{self.project}\\{odd_string_tag}')
-        evens_list = glob.glob(f'{self.root}{self.project}\\{even_string_tag}')
+        self.wait_for_writes()
+        if self.output_format == 'hdf5':
+            self.consolidate_md_containers()
+            return
+        mpadf_list = self.frame_files('_mPADF_total_sum.npy', total_string_tag)
+        odds_list = self.frame_files('_mPADF_odds_sum.npy', odd_string_tag)
+        evens_list = self.frame_files('_mPADF_evens_sum.npy', even_string_tag)
         # print(mpadf_list[0], odds_list[0], evens_list[0])
 
-        shutil.copyfile(src=f'{self.root}{self.project}{self.tag}_0_mPADF_param_log.txt',
+        shutil.copyfile(src=f'{self.root}{self.project}{self.frame_tag(0)}_mPADF_param_log.txt',
                         dst=f'{self.root}{self.project}{self.tag}_trajectory_mPADF_param_log.txt')
 
         trajectory_sum = np.zeros((self.nr, self.nr, self.nth))
@@ -105,23 +133,297 @@ class MPADFController:
 
         print(f'<controller.consolidate_md_results> total trajectory intensity {self.total_counts}')
 
+    def wait_for_writes(self):
+        """
+        Waits for the frames' background writes, raising the first that failed
+        :return:
+        """
+        if self.writer is not None:
+            self.writer.flush()
+
+    def n_centres(self):
+        return 1 if self.cluster_centres is None else len(self.cluster_centres)
+
+    def frame_tag(self, k, centre=0):
+        """
+        Tag of MD frame k, with the cluster centre index when there are several centres
+        """
+        return f'{self.tag}_{k}' if self.cluster_centres is None else f'{self.tag}_{k}_c{centre}'
+
+    def read_frame(self, k):
+        """
+        Atoms of MD frame k if the subject and supercell sets are the same file, otherwise None
+        (the calculator reads its own files). The last frame read is kept for the next centre or shard
+        """
+        if self.subject_set_manifest[k] != self.supercell_set_manifest[k]:
+            return None
+        if self.cached_frame[0] != k:
+            self.cached_frame = (k, utils.read_xyz(f'{self.root}{self.project}{self.subject_set_manifest[k]}'))
+        return self.cached_frame[1]
+
+    def frame_calculator(self, k, centre=0, frame_atoms=None):
+        """
+        Sets up the calculator for MD frame k and cluster centre index centre
+        :param frame_atoms: atoms of the frame if already read, see read_frame
+        :return: ModelPadfCalculator
+        """
+        mpc = fmp.ModelPadfCalculator()
+        mpc.root = self.root
+        mpc.project = self.project
+        mpc.tag = self.frame_tag(k, centre)
+        mpc.supercell_atoms = self.supercell_set_manifest[k]
+        mpc.subject_atoms = self.subject_set_manifest[k]
+        mpc.rmax = self.rmax
+        mpc.nr = self.nr
+        mpc.nth = self.nth
+        mpc.verbosity = self.verbosity
+        mpc.instrument = self.instrument
+        if self.writer is not None:
+            mpc.writer = self.writer
+            mpc.flush_writer = False
+        mpc.convergence_target = self.convergence_target
+        mpc.convergence_check_flag = True
+        mpc.sampling = self.sampling
+        mpc.error_bound = self.error_bound
+        mpc.accumulation = self.accumulation
+        mpc.vector_dtype = np.dtype(self.vector_dtype).type
+        mpc.output_format = self.output_format
+        mpc.seed = self.seed + int(k) * self.n_centres() + int(centre)
+        mpc.com_cluster_flag = True
+        mpc.com_radius = self.com_radius
+        if self.cluster_centres is not None:
+            mpc.cluster_centre = np.asarray(self.cluster_centres[centre], dtype=float)
+        mpc.frame_atoms = frame_atoms
+        return mpc
+
+    def trajectory_container_path(self):
+        return f'{self.root}{self.project}{self.tag}_trajectory_mPADF.h5'
+
+    def frame_files(self, suffix, string_tag=None):
+        """
+        Frame result files in the project folder, in frame order
+        :param suffix: str, suffix following the frame tag, e.g. '_mPADF_total_sum.npy'
+        :param string_tag: str, glob to use instead; None matches only {tag}_{k}{suffix} and
+        {tag}_{k}_c{centre}{suffix}, so the probe sweep (_rmax), rebinned (_nr_nth), shard and
+        trajectory files of the same suffix are left out
+        :return: list of paths
+        """
+        if string_tag is not None:
+            return utils.sorted_nicely(glob.glob(f'{self.root}{self.project}{string_tag}'))
+        frame = re.compile(rf'{re.escape(self.tag)}_\d+(_c\d+)?{re.escape(suffix)}')
+        return [path for path in utils.sorted_nicely(glob.glob(f'{self.root}{self.project}{self.tag}_*{suffix}'))
+                if frame.fullmatch(os.path.basename(path))]
+
+    def consolidate_md_containers(self, container_string_tag: str = None):
+        """
+        Appends the frame containers to the trajectory container ({tag}_trajectory_mPADF.h5),
+        which stacks the frames and keeps the trajectory sums. Frames already in it are skipped,
+        so this can be rerun as more frames finish
+        :param container_string_tag: str, glob of the frame containers, default None takes the frames of
+        this tag ({tag}_{k}_mPADF.h5)
+        :return:
+        """
+        trajectory = self.trajectory_container_path()
+        frame_list = [path for path in self.frame_files('_mPADF.h5', container_string_tag)
+                      if os.path.abspath(path) != os.path.abspath(trajectory)]
+        appended = 0
+        for path in frame_list:
+            frame_name = os.path.basename(path)[:-len('_mPADF.h5')]
+            arrays = {part: padf_io.read_theta(path, part) for part in ('total', 'odds', 'evens')}
+            attrs = None if os.path.exists(trajectory) else padf_io.read_parameters(path)
+            appended += padf_io.append_trajectory_frame(trajectory, frame_name, arrays, attrs=attrs)
+        self.total_counts = np.sum(padf_io.read_theta(trajectory, 'total'))
+        print(f'<controller.consolidate_md_containers> {appended} of {len(frame_list)} frames appended to {trajectory}')
+        print(f'<controller.consolidate_md_results> total trajectory intensity {self.total_counts}')
+
     def run_serial_mPADF_calc(self, starting_frame: int = 0):
         print(f'<controller.run_serial_mPADF_calc> Beginning mPADF calculation on MD trajectory')
         for k in np.arange(start=starting_frame, stop=self.frame_number):
             print(f'<controller.run_serial_mPADF_calc> Starting MD frame {k}')
-            mpc = fmp.ModelPadfCalculator()
-            mpc.root = self.root
-            mpc.project = self.project
-            mpc.tag = f'{self.tag}_{k}'
-            mpc.supercell_atoms = self.supercell_set_manifest[k]
-            mpc.subject_atoms = self.subject_set_manifest[k]
-            mpc.rmax = self.rmax
-            mpc.nr = self.nr
-            mpc.nth = self.nth
-            mpc.verbosity = self.verbosity
-            mpc.convergence_target = self.convergence_target
-            mpc.convergence_check_flag = True
-            mpc.com_cluster_flag = True
-            mpc.com_radius = self.com_radius
-            mpc.write_all_params_to_file()
-            fmp.ModelPadfCalculator.run_fast_serial_calculation(mpc)
+            frame_atoms = self.read_frame(k)
+            for centre in range(self.n_centres()):
+                mpc = self.frame_calculator(k, centre, frame_atoms)
+                mpc.write_all_params_to_file()
+                fmp.ModelPadfCalculator.run_fast_serial_calculation(mpc)
+        self.wait_for_writes()
+
+    def run_incremental_mPADF_calc(self):
+        """
+        Runs the trajectory in frame order, updating Theta from the previous frame instead of
+        recomputing it (see incremental_theta.py). Every vector is used as a reference vector,
+        and the subject and supercell of each frame must be the same file
+        :return:
+        """
+        print(f'<controller.run_incremental_mPADF_calc> Beginning incremental mPADF calculation on MD trajectory')
+        order = [list(self.subject_set_manifest).index(name) for name in utils.sorted_nicely(self.subject_set_manifest)]
+        states = {}
+        for n, k in enumerate(order):
+            frame_atoms = self.read_frame(k)
+            if frame_atoms is None:
+                raise ValueError('<controller.run_incremental_mPADF_calc> incremental mode needs the subject and '
+                                 'supercell of each frame to be the same file')
+            for centre in range(self.n_centres()):
+                if centre not in states:
+                    states[centre] = it.IncrementalTheta(self.frame_calculator(k, centre),
+                                                         tolerance=self.incremental_tolerance)
+                inc = states[centre]
+                inc.calc.tag = self.frame_tag(k, centre)
+                inc.calc.setup_instrument()
+                with inc.calc.instrument.stage('incremental_update', tag=inc.calc.tag) as info:
+                    start = time.time()
+                    inc.update(frame_atoms)
+                    inc.calc.calculation_time = time.time() - start
+                    info['changed_atoms'] = inc.moved_atoms
+                    info['updated_vectors'] = inc.updated_vectors
+                    info['kept_vectors'] = inc.kept_vectors
+                    info['interatomic_vectors'] = len(inc.rows)
+                if self.incremental_check_interval and (n + 1) % self.incremental_check_interval == 0:
+                    inc.verify()
+                inc.save()
+        self.wait_for_writes()
+
+    """
+    Distributed runs: write_job_manifest() writes one job per frame (or per shard of the
+    reference vectors of each frame), any number of workers on nodes sharing the filesystem run
+        python controller.py worker <manifest>
+    and reduce_distributed_results() merges the shards into per-frame mPADFs, ready for
+    consolidate_md_results()
+    """
+
+    def jobs_dir(self):
+        return f'{self.root}{self.project}{self.tag}_jobs{os.sep}'
+
+    def shard_tag(self, k, shard, centre=0):
+        return f'{self.frame_tag(k, centre)}_shard_{shard}'
+
+    def write_job_manifest(self, shards_per_frame: int = 1):
+        """
+        Writes the job manifest of the trajectory calculation
+        :param shards_per_frame: number of reference vector ranges each frame is split into
+        :return: path to the manifest
+        """
+        parameters = {key: getattr(self, key) for key in (
+            'root', 'project', 'tag', 'rmin', 'rmax', 'nr', 'nth', 'seed', 'frame_number', 'convergence_target',
+            'sampling', 'error_bound', 'accumulation', 'output_format', 'com_cluster_flag', 'com_radius',
+            'verbosity')}
+        parameters['vector_dtype'] = np.dtype(self.vector_dtype).name
+        parameters['subject_set_manifest'] = list(self.subject_set_manifest)
+        parameters['supercell_set_manifest'] = list(self.supercell_set_manifest)
+        parameters['cluster_centres'] = None if self.cluster_centres is None \
+            else np.asarray(self.cluster_centres, dtype=float).tolist()
+        jobs = [{'id': f'frame_{k}_c{j}_shard_{i}', 'frame': k, 'centre': j, 'shard': i, 'shards': shards_per_frame}
+                for k in range(self.frame_number) for j in range(self.n_centres()) for i in range(shards_per_frame)]
+        return wq.write_manifest(self.jobs_dir(), parameters, jobs)
+
+    @classmethod
+    def from_manifest(cls, path):
+        """
+        Controller with the parameters of a job manifest
+        :return: MPADFController, list of jobs
+        """
+        manifest = wq.read_manifest(path)
+        cont = cls()
+        for key, value in manifest['parameters'].items():
+            setattr(cont, key, value)
+        return cont, manifest['jobs']
+
+    def run_job(self, job):
+        """
+        Runs one job of the manifest: a whole frame, or one shard of its reference vectors
+        :return:
+        """
+        mpc = self.frame_calculator(job['frame'], job.get('centre', 0), self.read_frame(job['frame']))
+        if job['shards'] > 1:
+            mpc.tag = self.shard_tag(job['frame'], job['shard'], job.get('centre', 0))
+            mpc.shard_index = job['shard']
+            mpc.shard_count = job['shards']
+        mpc.write_all_params_to_file()
+        mpc.run_fast_serial_calculation()
+        self.wait_for_writes()
+
+    def run_worker(self, jobs, stale_after=None, max_jobs=None):
+        """
+        Claims and runs jobs of the manifest until none are left
+        :param stale_after: seconds since the lock of a running job was last touched after which it may be taken
+        over, None never
+        :return: number of jobs run
+        """
+        return wq.run_worker(self.jobs_dir(), jobs, self.run_job, stale_after=stale_after, max_jobs=max_jobs)
+
+    def run_local_workers(self, n_workers: int, shards_per_frame: int = 1):
+        """
+        Writes the manifest and runs n_workers worker processes on this machine,
+        then reduces the results
+        :return: True if every job finished
+        """
+        manifest = self.write_job_manifest(shards_per_frame)
+        workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', manifest])
+                   for _ in range(n_workers)]
+        for worker in workers:
+            worker.wait()
+        return self.reduce_distributed_results(manifest)
+
+    def reduce_distributed_results(self, manifest_path):
+        """
+        Sums the shards of each frame into the frame mPADFs ({tag}_{k}_mPADF_*_sum.npy) and moves
+        the shard arrays into the jobs directory
+        :return: True if every job finished
+        """
+        _, jobs = self.from_manifest(manifest_path)
+        status = wq.queue_status(self.jobs_dir(), jobs)
+        if len(status['done']) < len(jobs):
+            print(f"<controller.reduce_distributed_results> {len(status['done'])} of {len(jobs)} jobs done, "
+                  f"failed: {status['failed']}, running: {status['running']}")
+            return False
+        path = self.root + self.project
+        for k, centre in sorted({(job['frame'], job.get('centre', 0)) for job in jobs}):
+            shards = [job['shard'] for job in jobs if job['frame'] == k and job.get('centre', 0) == centre]
+            if len(shards) == 1:
+                continue
+            if self.output_format == 'hdf5':
+                self.reduce_shard_containers(k, shards, centre)
+                continue
+            for part in ('total', 'odds', 'evens'):
+                frame = np.zeros((self.nr, self.nr, self.nth))
+                for i in shards:
+                    shard_file = f'{self.shard_tag(k, i, centre)}_mPADF_{part}_sum.npy'
+                    if os.path.exists(path + shard_file):
+                        shutil.move(path + shard_file, self.jobs_dir() + shard_file)
+                    frame += np.load(self.jobs_dir() + shard_file)
+                np.save(f'{path}{self.frame_tag(k, centre)}_mPADF_{part}_sum.npy', frame)
+            shutil.copyfile(src=f'{path}{self.shard_tag(k, shards[0], centre)}_mPADF_param_log.txt',
+                            dst=f'{path}{self.frame_tag(k, centre)}_mPADF_param_log.txt')
+        print(f'<controller.reduce_distributed_results> {len(jobs)} jobs reduced')
+        return True
+
+    def reduce_shard_containers(self, k, shards, centre=0):
+        """
+        Sums the shard containers of frame k (and cluster centre) into the frame container
+        :return:
+        """
+        path = self.root + self.project
+        volumes = {part: np.zeros((self.nr, self.nr, self.nth)) for part in ('total', 'odds', 'evens')}
+        for i in shards:
+            shard_file = f'{self.shard_tag(k, i, centre)}_mPADF.h5'
+            if os.path.exists(path + shard_file):
+                shutil.move(path + shard_file, self.jobs_dir() + shard_file)
+            for part in volumes:
+                volumes[part] += padf_io.read_theta(self.jobs_dir() + shard_file, part)
+        attrs = padf_io.read_parameters(self.jobs_dir() + f'{self.shard_tag(k, shards[0], centre)}_mPADF.h5')
+        attrs.update({'tag': self.frame_tag(k, centre), 'shard_count': len(shards)})
+        padf_io.write_datasets(f'{path}{self.frame_tag(k, centre)}_mPADF.h5', volumes, attrs=attrs, mode='w')
+
+
+if __name__ == '__main__':
+    # python controller.py worker|reduce|status <manifest> [stale_after seconds]
+    command, manifest_path = sys.argv[1], sys.argv[2]
+    cont, manifest_jobs = MPADFController.from_manifest(manifest_path)
+    if command == 'worker':
+        cont.run_worker(manifest_jobs, stale_after=float(sys.argv[3]) if len(sys.argv) > 3 else None)
+    elif command == 'reduce':
+        cont.reduce_distributed_results(manifest_path)
+    elif command == 'status':
+        for state, ids in wq.queue_status(cont.jobs_dir(), manifest_jobs).items():
+            print(f'{state}: {len(ids)} {ids}')
+    else:
+        raise ValueError(f'<controller> unknown command {command}')
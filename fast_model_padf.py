@@ -6,14 +6,20 @@ Fast Model PADF Calculator
 import shutil
 import numpy as np
 import time
-import multiprocessing as mp
 import math as m
 import matplotlib.pyplot as plt
 import os
 import utils as u
+import instrumentation as ins
+import vector_table as vt
+import padf_io
+import output_writer as ow
 
 
 class ModelPadfCalculator:
+    # Stages of run_fast_serial_calculation, each run by its run_{stage} method. Batch runs (batch_runner.py) share
+    # the results of the first three between jobs with the same parameters up to that stage
+    stages = ('setup', 'pairing', 'trimming', 'accumulation', 'saving')
 
     def __init__(self):
 
@@ -21,8 +27,13 @@ class ModelPadfCalculator:
         self.project = ""
         self.tag = ""
         self.supercell_atoms = ""  # the xyz file contains the cartesian coords of the crystal structure expanded
-        # to include r_probe
+        # to include r_probe. Leave empty (or give a cif) to expand the subject cif directly
         self.subject_atoms = ""  # the cif containing the asymmetric unit
+        self.unit_cell_dimensions = None  # optional a, b, c overriding the cif cell lengths
+        # Periodic mode: supercell_atoms holds a single unit cell (xyz or cif) and pair vectors are generated
+        # from its periodic images within rmax
+        self.periodic_flag = False
+        self.lattice_vectors = None  # (3, 3) lattice vectors as rows, read from the cif if not given
         # probe radius
         self.rmin = 0.0
         self.rmax = 10.0
@@ -36,11 +47,11 @@ class ModelPadfCalculator:
         self.mode = 'stm'
         self.dimension = 3
         self.processor_num = 2
-        self.Pool = mp.Pool(self.processor_num)
+        self.Pool = None  # worker pool, only created by parallel runs
         self.loops = 0
         self.verbosity = 0
         self.Theta = np.zeros(0)
-        self.rolling_Theta = np.zeros(0)
+        # Half sums of Theta over the odd and even reference vectors, the total is their sum (rolling_Theta)
         self.rolling_Theta_odds = np.zeros(0)
         self.rolling_Theta_evens = np.zeros(0)
         self.n2_contacts = []
@@ -55,10 +66,79 @@ class ModelPadfCalculator:
         self.converged_flag = False
         self.com_cluster_flag = False
         self.com_radius = 0.0
+        self.cluster_centre = None  # (3,) centre of the COM cluster, None for the centre of mass of the subject atoms
+        self.frame_atoms = None  # (N, 4) atoms of an MD frame already in memory, used as subject and extended set
         self.total_contribs = 0
         self.calculation_time = 0.0
+        self.run_start = 0.0  # time.time() at the start of the run
         self.percent_milestones = np.zeros(0)
         self.iteration_times = np.zeros(0)
+        self.loop_time = 0.0
+        self.convergence_time = 0.0  # time spent in cycle_assessment
+        # Receives stage timings and progress events (see instrumentation.py). None gives a console
+        # instrument that reports progress every 10 s, or every reference vector with verbosity 1
+        self.instrument = None
+        # Species-resolved (partial) PADFs
+        self.partials_flag = False
+        self.partial_storage = 'dense'  # 'dense' : one array for all combinations, 'sparse' : only combinations hit
+        self.partial_dtype = np.float64  # np.float32 halves the memory of the partial volumes
+        self.species_z = np.zeros(0)  # sorted unique atomic numbers, species code = index into this array
+        self.n_species_pairs = 0
+        self.partial_Theta = {}
+        # Symmetry reduction: None, 'cif' (asymmetric unit of the cif, the full cell is used as subject set)
+        # or 'fingerprint' (subject atoms with matching environments)
+        self.symmetry_mode = None
+        self.symmetry_decimals = 3  # rounding of the environment fingerprints
+        self.subject_orbits = np.zeros(0)  # equivalence class of each subject atom
+        self.subject_multiplicity = np.zeros(0)  # weight of each subject atom, zero if not a representative
+        self.reference_vectors = []
+        # Sampling of the reference vectors
+        self.sampling = 'uniform'  # 'uniform' shuffle or 'stratified' by |r| bin and species pair
+        self.seed = None  # seed for the reference vector order, None for a fresh random order
+        self.n_strata_r = 8  # number of |r| strata for stratified sampling
+        self.error_bound = 0.0  # stop once the estimated relative error of Theta is below this, 0 disables
+        self.loop_error_array = []
+        # Binning tables for the accumulation engine, set up by setup_binning
+        self.r_bin_edges = np.zeros(0)
+        self.cos_bin_edges = np.zeros(0)
+        # Float dtype of the interatomic vector table, np.float64 reproduces the full precision angular binning
+        self.vector_dtype = np.float32
+        # Accumulation: 'vector' bins one reference vector at a time, 'tiled' bins blocks of tile_references
+        # reference vectors against blocks of tile_partners partners (sorted by r) into small local histograms
+        self.accumulation = 'vector'
+        self.tile_references = 64
+        self.tile_partners = 8192
+        # Shard of the reference vectors processed by this calculator (distributed runs): shard shard_index of
+        # shard_count contiguous ranges of the sampling order. Shards run their whole range, without convergence
+        # checks, and keep the global odd/even split so their sums add up to the full calculation
+        self.shard_index = 0
+        self.shard_count = 1
+        self.reference_rows = np.zeros(0, dtype=int)  # row in reference_vectors of each reference vector number
+        # Probe sweep: Theta for each probe radius in probe_radii (multiples of rmax / nr, below rmax) is cut out
+        # of this run's volumes after the accumulation, with its own contact count
+        self.probe_radii = []
+        self.probe_Theta = {}  # probe radius : (total, odds, evens) volumes of its nr bins
+        self.probe_contribs = {}  # probe radius : contributing contacts
+        # Coarser (nr, nth) grids also written on save, summed from this run's volumes. nr and nth must divide this
+        # run's nr and nth by odd factors (e.g. nr = 384 rebins to 128, never to 192), so the coarse bin edges fall
+        # on fine bin edges. Saved volumes can be rebinned later in the same way with utils.rebin_theta
+        self.rebin_grids = []
+        # Output: 'npy' writes .npy volumes and text logs, 'hdf5' writes everything into one chunked,
+        # compressed container per run ({tag}_mPADF.h5, needs h5py)
+        self.output_format = 'npy'
+        self.compression = 'gzip'  # h5py filter: 'gzip', 'lzf' or None
+        self.compression_level = 4
+        # Writes the output files (see output_writer.py). ow.SyncWriter() writes them straight away,
+        # ow.BackgroundWriter() writes snapshots in a background thread while the calculation continues
+        self.writer = ow.SyncWriter()
+        self.flush_writer = True  # wait for the writes at the end of the run (an MD controller waits once at the end)
+
+    @property
+    def rolling_Theta(self):
+        """
+        Total Theta, materialised from the odd and even half sums (only the halves are accumulated)
+        """
+        return self.rolling_Theta_odds + self.rolling_Theta_evens
 
     def parameter_check(self):
         """
@@ -77,6 +157,9 @@ class ModelPadfCalculator:
         print(f'<parameter_check>: nth : {self.nth}')
         print(f'<parameter_check>: angular_bin : {self.angular_bin}')
         print(f'<parameter_check>: model PADF dimensions: {self.nr, self.nr, self.nth}')
+        for nr, nth in self.rebin_grids:
+            print(f'<parameter_check>: rebinned to {nr, nr, nth} (factors {u.rebin_factor(self.nr, nr, "nr")}, '
+                  f'{u.rebin_factor(self.nth, nth, "nth")})')
 
     def get_dimension(self):
         """
@@ -107,9 +190,10 @@ class ModelPadfCalculator:
         if not os.path.isdir(path):
             print('<write_all_params_to_file>: Moving files...')
             os.mkdir(path)
-            src = self.root + self.supercell_atoms
-            dst = self.root + self.project + self.supercell_atoms
-            shutil.copy(src, dst)
+            if self.supercell_atoms:
+                src = self.root + self.supercell_atoms
+                dst = self.root + self.project + self.supercell_atoms
+                shutil.copy(src, dst)
             src = self.root + self.subject_atoms
             dst = self.root + self.project + self.subject_atoms
             shutil.copy(src, dst)
@@ -132,7 +216,38 @@ class ModelPadfCalculator:
             f.write(f'Total number of interatomic vectors {len(self.interatomic_vectors)}\n')
             f.write(f'Total number of atoms in system {len(self.extended_atoms)}\n')
             f.write(f'Total number of contributing contacts {self.total_contribs}\n')
-        np.savetxt(self.root + self.project + f'{self.tag}_similarity_log.txt', np.array(self.loop_similarity_array))
+            f.write(f'Reference vectors used {self.converged_loop} of {len(self.reference_vectors)}\n')
+            for probe, contribs in self.probe_contribs.items():
+                f.write(f'Probe rmax {probe}: {self.probe_Theta[probe][0].shape[0]} radial bins, '
+                        f'{contribs} contributing contacts\n')
+        if self.output_format == 'hdf5':
+            logs = {'similarity_log': np.array(self.loop_similarity_array).reshape(-1, 2)}
+            if self.error_bound > 0:
+                logs['error_log'] = np.array(self.loop_error_array).reshape(-1, 2)
+            metadata = {'calculation_time': self.calculation_time, 'total_contribs': self.total_contribs,
+                        'interatomic_vectors': len(self.interatomic_vectors),
+                        'extended_atoms': len(self.extended_atoms), 'reference_vectors_used': self.converged_loop,
+                        'reference_vectors': len(self.reference_vectors), 'converged': self.converged_flag,
+                        'written': time.strftime('%Y-%m-%dT%H:%M:%S')}
+            metadata.update(padf_io.scalar_parameters(self.__dict__))
+            self.write_container(logs, attrs=metadata)
+            return
+        self.writer.submit(np.savetxt, self.root + self.project + f'{self.tag}_similarity_log.txt',
+                           np.array(self.loop_similarity_array))
+        if self.error_bound > 0:
+            self.writer.submit(np.savetxt, self.root + self.project + f'{self.tag}_error_log.txt',
+                               np.array(self.loop_error_array))
+
+    def container_path(self):
+        return self.root + self.project + self.tag + '_mPADF.h5'
+
+    def write_container(self, datasets, attrs=None, group='/', mode='a'):
+        """
+        Writes datasets into the run container (output_format 'hdf5')
+        :return:
+        """
+        self.writer.submit(padf_io.write_datasets, self.container_path(), datasets, attrs=attrs, group=group,
+                           mode=mode, compression=self.compression, compression_level=self.compression_level)
 
     def subject_target_setup(self):
         """
@@ -140,53 +255,155 @@ class ModelPadfCalculator:
         :return:
         """
         print(f'<subject_target_setup> Reading in subject set...')
-        self.subject_atoms = u.read_xyz(
-            f'{self.root}{self.project}{self.subject_atoms}')  # Read the full asymmetric unit
-        if self.com_cluster_flag:
-            self.subject_atoms = self.clean_subject_atoms()
-
-        print(f'<subject_target_setup> Reading in extended atom set...')
-        self.raw_extended_atoms = u.read_xyz(
-            f'{self.root}{self.project}{self.supercell_atoms}')  # Take in the raw environment atoms
-        self.extended_atoms = self.clean_extended_atoms()  # Trim to the atoms probed by the subject set
+        if self.periodic_flag:
+            self.subject_atoms, self.extended_atoms = self.periodic_cell_setup()
+            self.raw_extended_atoms = self.extended_atoms
+        elif self.subject_atoms[-3:] == 'cif' and (not self.supercell_atoms or self.supercell_atoms[-3:] == 'cif'):
+            # Build the supercell directly from the cif, already trimmed to rmax around the subject set
+            cif = self.supercell_atoms if self.supercell_atoms else self.subject_atoms
+            self.subject_atoms, self.extended_atoms, self.subject_orbits = u.expand_cif_supercell(
+                f'{self.root}{self.project}{cif}', self.rmax, ucds=self.unit_cell_dimensions,
+                full_cell=self.symmetry_mode == 'cif')
+            self.raw_extended_atoms = self.extended_atoms
+        else:
+            if self.frame_atoms is not None:
+                self.subject_atoms = self.frame_atoms
+            else:
+                self.subject_atoms = u.subject_atom_reader(
+                    f'{self.root}{self.project}{self.subject_atoms}',
+                    ucds=self.unit_cell_dimensions)  # Read the full asymmetric unit
+            if self.com_cluster_flag:
+                self.subject_atoms = self.clean_subject_atoms()
+
+            print(f'<subject_target_setup> Reading in extended atom set...')
+            if self.frame_atoms is not None:
+                self.raw_extended_atoms = self.frame_atoms
+            else:
+                self.raw_extended_atoms = u.read_xyz(
+                    f'{self.root}{self.project}{self.supercell_atoms}')  # Take in the raw environment atoms
+            self.extended_atoms = self.clean_extended_atoms()  # Trim to the atoms probed by the subject set
         # if self.com_cluster_flag:
         #     self.output_cluster_xyz()       ## WRITE OUT THE CLUSTER GEOMETRIES
-        u.output_reference_xyz(self.subject_atoms, path=f'{self.root}{self.project}{self.tag}_clean_subject_atoms.xyz')
-        u.output_reference_xyz(self.extended_atoms,
-                               path=f'{self.root}{self.project}{self.tag}_clean_extended_atoms.xyz')
+        self.writer.submit(u.output_reference_xyz, self.subject_atoms,
+                           path=f'{self.root}{self.project}{self.tag}_clean_subject_atoms.xyz')
+        self.writer.submit(u.output_reference_xyz, self.extended_atoms,
+                           path=f'{self.root}{self.project}{self.tag}_clean_extended_atoms.xyz')
+        self.species_setup()
         return self.subject_atoms, self.extended_atoms
 
+    def periodic_cell_setup(self):
+        """
+        Reads the subject atoms and the single unit cell used in periodic mode
+        :return: subject atoms, unit cell atoms
+        """
+        cell_file = self.supercell_atoms if self.supercell_atoms else self.subject_atoms
+        if cell_file[-3:] == 'cif':
+            cell, cell_frac, cell_z, asym_index = u.read_cif_unit_cell(f'{self.root}{self.project}{cell_file}',
+                                                                      ucds=self.unit_cell_dimensions)
+            cell_atoms = np.column_stack((cell_frac @ cell, cell_z))
+            if self.lattice_vectors is None:
+                self.lattice_vectors = cell
+        else:
+            cell_atoms = u.read_xyz(f'{self.root}{self.project}{cell_file}')
+        if self.lattice_vectors is None:
+            raise ValueError('<periodic_cell_setup>: periodic mode needs lattice_vectors or a cif unit cell')
+        self.lattice_vectors = np.asarray(self.lattice_vectors, dtype=float)
+        if cell_file == self.subject_atoms and cell_file[-3:] == 'cif':
+            if self.symmetry_mode == 'cif':
+                subject_rows = np.arange(len(cell_atoms))
+            else:
+                subject_rows = np.unique(asym_index, return_index=True)[1]
+            subject = cell_atoms[subject_rows]
+            self.subject_orbits = asym_index[subject_rows]
+        else:
+            subject = u.subject_atom_reader(f'{self.root}{self.project}{self.subject_atoms}',
+                                            ucds=self.unit_cell_dimensions)
+        print(f'<periodic_cell_setup> {len(subject)} subject atoms, {len(cell_atoms)} atoms in the periodic cell')
+        return subject, cell_atoms
+
+    def species_setup(self):
+        """
+        Assigns the compact species codes used to label interatomic vectors and partial PADFs
+        :return:
+        """
+        self.species_z = np.unique(np.concatenate((self.subject_atoms[:, 3], self.extended_atoms[:, 3])))
+        self.n_species_pairs = len(self.species_z) * (len(self.species_z) + 1) // 2
+        print(f'<subject_target_setup> Species present (Z): {self.species_z}')
+
     def cycle_assessment(self, k, start_time):
         # Measure internal convergence
-        if k > 1:
+        loop_error = None
+        if k > 1 and self.shard_count == 1:
             loop_cos = u.cossim_measure(self.rolling_Theta_odds, self.rolling_Theta_evens)
-            # print(f"{loop_cos=}")
             self.loop_similarity_array.append([k, loop_cos])
-            if self.verbosity == 1:
-                print(
-                    f"| {k} / {len(self.interatomic_vectors)} | Odd/even cosine similarity == {loop_cos}")
-            if k % 100 == 0:
-                print(
-                    f"| {k} / {len(self.interatomic_vectors)} | Odd/even cosine similarity == {loop_cos}")
-                # foo = np.array(self.loop_similarity_array)
-                # plt.plot(foo[:, 0], foo[:, 1], '-')
-                # plt.show()
         else:
             loop_cos = 0.0
         if loop_cos >= self.convergence_target:
             self.converged_flag = True
+        if self.error_bound > 0 and k > 1 and self.shard_count == 1:
+            loop_error = self.relative_error_estimate(k)
+            self.loop_error_array.append([k, loop_error])
+            if loop_error <= self.error_bound:
+                self.converged_flag = True
         # Estimate remaining time:
         cycle_time = time.time() - start_time
         self.iteration_times[k] = cycle_time
-        time_remaining = np.mean(np.array(self.iteration_times[:k + 1])) * (len(self.iteration_times) - k)
-        # print(cycle_time)
-        # print(time_remaining)
-        if self.verbosity == 1:
-            if time_remaining > 3600:
-                print(
-                    f"| {k} / {len(self.interatomic_vectors)} | Estimate {round(time_remaining / 3600, 3)} hr remaining")
-            else:
-                print(f"| {k} / {len(self.interatomic_vectors)} | Estimate {round(time_remaining, 3)} s remaining")
+        self.loop_time += cycle_time
+        if self.instrument.enabled:
+            time_remaining = self.loop_time / (k + 1) * (len(self.iteration_times) - k)
+            self.instrument.emit('progress', tag=self.tag, k=k, n=len(self.reference_vectors),
+                                 similarity=loop_cos if k > 1 else None, error=loop_error,
+                                 eta_s=time_remaining, contacts=self.total_contribs)
+
+    def relative_error_estimate(self, k):
+        """
+        Split-half estimate of the relative (L2) error of Theta after k + 1 reference vectors,
+        including the finite population correction so it reaches zero when all are used
+        :param k: index of the last reference vector processed
+        :return: float
+        """
+        fpc = max(0.0, 1.0 - (k + 1) / len(self.reference_vectors))
+        total = np.linalg.norm(self.rolling_Theta_odds + self.rolling_Theta_evens)
+        if total == 0:
+            return np.inf
+        return m.sqrt(fpc) * np.linalg.norm(self.rolling_Theta_odds - self.rolling_Theta_evens) / total
+
+    def variance_estimate(self, k):
+        """
+        Per-bin variance of Theta, extrapolated to the full set of reference vectors,
+        estimated from the difference of the odd and even half sums
+        :param k: number of reference vectors processed
+        :return: (nr, nr, nth) array
+        """
+        n = len(self.reference_vectors)
+        fpc = max(0.0, 1.0 - k / n)
+        return fpc * (n / k) ** 2 * (self.rolling_Theta_odds - self.rolling_Theta_evens) ** 2
+
+    def order_reference_vectors(self):
+        """
+        Orders the reference vectors for sampling. 'uniform' shuffles them, 'stratified' interleaves
+        strata of |r| bin and species pair so every prefix covers the whole volume in proportion
+        :return:
+        """
+        rng = np.random.default_rng(self.seed)
+        if self.sampling == 'stratified':
+            r = self.reference_vectors.r.astype(np.float64)
+            r_stratum = np.minimum(((r - self.rmin) / (self.rmax - self.rmin) * self.n_strata_r).astype(int),
+                                   self.n_strata_r - 1)
+            strata = r_stratum * max(self.n_species_pairs, 1) + self.reference_vectors.pair_code
+            order = u.stratified_order(strata, rng)
+            print(f'<order_reference_vectors> Stratified sampling over {len(np.unique(strata))} strata '
+                  f'(seed {self.seed})')
+        elif self.sampling == 'uniform':
+            order = rng.permutation(len(self.reference_vectors))  # Shuffle list of vectors
+        else:
+            raise ValueError(f"<order_reference_vectors>: unknown sampling '{self.sampling}'")
+        if self.reference_vectors is self.interatomic_vectors:
+            # Reorder the table in place rather than keeping a second copy
+            self.interatomic_vectors = self.interatomic_vectors.subset(order)
+            self.reference_vectors = self.interatomic_vectors
+        else:
+            self.reference_vectors = self.reference_vectors.subset(order)
 
     def generate_empty_theta(self, shape):
         """
@@ -213,62 +430,113 @@ class ModelPadfCalculator:
         :return:
         """
         print(f'<fast_model_padf.clean_extended_atoms> Trimming atom sets to rmax')
-        clean_ex = []
-        cluster_subject = []
         if not self.com_cluster_flag:
-            for ex_atom in self.raw_extended_atoms:
-                for as_atom in self.subject_atoms:
-                    diff = u.fast_vec_difmag(ex_atom[0], ex_atom[1], ex_atom[2], as_atom[0], as_atom[1], as_atom[2])
-                    if abs(diff) <= self.rmax:
-                        clean_ex.append(ex_atom)
-                        break
-                    else:
-                        continue
-        elif self.com_cluster_flag:
-            x_com = np.mean(self.subject_atoms[:, 0])
-            y_com = np.mean(self.subject_atoms[:, 1])
-            z_com = np.mean(self.subject_atoms[:, 2])
-            print(f'center of mass at {[x_com, y_com, z_com]}')
-            for ex_atom in self.raw_extended_atoms:
-                diff = u.fast_vec_difmag(ex_atom[0], ex_atom[1], ex_atom[2], x_com, y_com, z_com)
-                if abs(diff) <= 2 * self.rmax:
-                    clean_ex.append(ex_atom)
-                else:
-                    continue
-            for s_atom in self.subject_atoms:
-                diff = u.fast_vec_difmag(s_atom[0], s_atom[1], s_atom[2], x_com, y_com, z_com)
-                if abs(diff) <= self.rmax:
-                    cluster_subject.append(s_atom)
-                else:
-                    continue
-        clean_ex = np.array(clean_ex)
+            clean_ex = self.raw_extended_atoms[u.atoms_near_any(self.raw_extended_atoms, self.subject_atoms,
+                                                                self.rmax)]
+        else:
+            centre = self.cluster_centre if self.cluster_centre is not None \
+                else np.mean(self.subject_atoms[:, :3], axis=0)
+            print(f'center of mass at {list(centre)}')
+            clean_ex = self.raw_extended_atoms[self.cluster_atoms(self.raw_extended_atoms, centre, 2 * self.rmax)]
         print(
             f"<clean_extended_atoms>: Extended atom set has been reduced to {len(clean_ex)} atoms within {self.rmax} radius")
         return np.array(clean_ex)
 
     def clean_subject_atoms(self):
         """
-        Trims the length of the extended atoms to the set probed by
-        the r_probe and asymmetric unit
+        Trims the subject atoms to the sphere of com_radius around the cluster centre
+        (the centre of mass of the subject atoms unless cluster_centre is set)
         :return:
         """
         print(f'<fast_model_padf.clean_extended_atoms> Trimming atom sets to rmax {len(self.subject_atoms)} atoms')
-        cluster_subject = []
-        x_com = np.mean(self.subject_atoms[:, 0])
-        y_com = np.mean(self.subject_atoms[:, 1])
-        z_com = np.mean(self.subject_atoms[:, 2])
-        print(f'center of mass at {[x_com, y_com, z_com]} {self.com_radius}')
-        for s_atom in self.subject_atoms:
-            diff = u.fast_vec_difmag(s_atom[0], s_atom[1], s_atom[2], x_com, y_com, z_com)
-            if abs(diff) <= self.com_radius:
-                cluster_subject.append(s_atom)
-            else:
-                continue
-        cluster_subject = np.array(cluster_subject)
+        centre = self.cluster_centre if self.cluster_centre is not None \
+            else np.mean(self.subject_atoms[:, :3], axis=0)
+        print(f'center of mass at {list(centre)} {self.com_radius}')
+        cluster_subject = self.subject_atoms[self.cluster_atoms(self.subject_atoms, centre, self.com_radius)]
         print(
             f"<clean_subject_atoms>: Subject atom set has been reduced to {len(cluster_subject)} atoms within {self.com_radius} radius")
         return np.array(cluster_subject)
 
+    @staticmethod
+    def cluster_atoms(atoms, centre, radius):
+        """
+        Indices of the atoms within radius of centre
+        :return: int array
+        """
+        return np.flatnonzero(u.radial_distances(atoms, centre) <= radius)
+
+    def partial_labels(self):
+        """
+        Labels of the species-pair combinations, ordered by combination code
+        :return: list of str, e.g. 'C-C|C-O'
+        """
+        pairs = u.pair_labels([u.get_id(z) for z in self.species_z])
+        return [f'{pairs[a]}|{pairs[b]}' for a in range(len(pairs)) for b in range(a, len(pairs))]
+
+    def setup_partial_theta(self):
+        """
+        Sets up the partial Theta volumes, one per combination of species pairs
+        :return:
+        """
+        n_combos = self.n_species_pairs * (self.n_species_pairs + 1) // 2
+        if self.partial_storage == 'dense':
+            self.partial_Theta = np.zeros((n_combos, self.nr, self.nr, self.nth), dtype=self.partial_dtype)
+        elif self.partial_storage == 'sparse':
+            self.partial_Theta = {}
+        else:
+            raise ValueError(f"<setup_partial_theta>: unknown partial_storage '{self.partial_storage}'")
+        print(f'<setup_partial_theta> Accumulating {n_combos} partial volumes ({self.partial_storage}, '
+              f'{np.dtype(self.partial_dtype).name})')
+
+    def get_partial_theta(self, combo):
+        """
+        Returns the partial Theta volume for a species-pair combination, allocating
+        it on first use in sparse storage
+        :param combo: combination code of the two species pairs
+        :return: view of the partial volume
+        """
+        if self.partial_storage == 'sparse':
+            if combo not in self.partial_Theta:
+                self.partial_Theta[combo] = np.zeros((self.nr, self.nr, self.nth), dtype=self.partial_dtype)
+        return self.partial_Theta[combo]
+
+    def sum_partial_theta(self):
+        """
+        Sum of all partial volumes, equal to the total Theta
+        :return:
+        """
+        if self.partial_storage == 'sparse':
+            total = np.zeros((self.nr, self.nr, self.nth))
+            for partial in self.partial_Theta.values():
+                total += partial
+            return total
+        return np.sum(self.partial_Theta, axis=0, dtype=np.float64)
+
+    def save_partial_theta(self):
+        """
+        Writes out the partial volumes and their labels. Dense storage is saved as a single
+        (n_combos, nr, nr, nth) array, sparse storage as an npz of the populated combinations only.
+        In the hdf5 container each populated combination is a dataset of the 'partials' group
+        :return:
+        """
+        labels = self.partial_labels()
+        if self.output_format == 'hdf5':
+            partials = self.partial_Theta.items() if self.partial_storage == 'sparse' else enumerate(self.partial_Theta)
+            self.write_container({str(combo): partial for combo, partial in partials}, group='partials',
+                                 attrs={'labels': str(labels)})
+        else:
+            with open(self.root + self.project + self.tag + '_mPADF_partial_labels.txt', 'w') as f:
+                for combo, label in enumerate(labels):
+                    f.write(f'{combo} {label}\n')
+            if self.partial_storage == 'sparse':
+                self.writer.submit(np.savez, self.root + self.project + self.tag + '_mPADF_partials',
+                                   **{str(combo): partial for combo, partial in self.partial_Theta.items()})
+            else:
+                self.writer.submit(np.save, self.root + self.project + self.tag + '_mPADF_partials',
+                                   self.partial_Theta)
+        if not np.allclose(self.sum_partial_theta(), self.rolling_Theta):
+            print(f'<save_partial_theta> WARNING: partial volumes do not sum to the total')
+
     def bin_cor_vec_to_theta(self, cor_vec, fz, array):
         """
         Bin and then add the correlation vector to the
@@ -295,51 +563,188 @@ class ModelPadfCalculator:
             if self.r12_reflection:
                 array[r2_index, r1_index, th_index] = array[r2_index, r1_index, th_index] + fz
 
-    def calc_padf_frm_iav(self, k, r_ij):
-        start = time.time()
-        # print(f'<calc_padf_frm_iav>: Starting calculation on thread {k}...')
-        fb_hit_count = 0
-        for r_xy in self.interatomic_vectors:
-            if np.array_equal(r_ij, r_xy):
-                continue
-            theta = u.fast_vec_angle(r_ij[0], r_ij[1], r_ij[2], r_xy[0], r_xy[1], r_xy[2])
-            fprod = r_ij[4] * r_xy[4]
-            self.bin_cor_vec_to_theta([r_ij[3], r_xy[3], theta], fprod, self.rolling_Theta)
-            if k % 2 == 0:
-                self.bin_cor_vec_to_theta([r_ij[3], r_xy[3], theta], fprod, self.rolling_Theta_evens)
-            else:
-                self.bin_cor_vec_to_theta([r_ij[3], r_xy[3], theta], fprod, self.rolling_Theta_odds)
-            fb_hit_count += 1
-        end = time.time()
-        # print(f"<calc_padf_frm_iav>: Thread {k} execution time = ", end - start, " seconds")
-        # print(f"<calc_padf_frm_iav>: Thread {k} added {fb_hit_count} four-body contacts")
-        # Save the Theta array as is:
-        self.total_contribs += fb_hit_count
-        # print(self.total_contribs, fb_hit_count)
-        # np.save(self.root + self.project + self.tag + '_Theta_' + str(k), Theta)
+    def setup_binning(self):
+        """
+        Precomputes the bin edge tables used by the interatomic vector table and calc_padf_frm_iav
+        :return:
+        """
+        self.r_bin_edges = u.r_bin_edges(self.r_dist_bin, self.nr)
+        self.cos_bin_edges = u.cos_bin_edges(self.angular_bin, self.nth)
+
+    def bin_contacts_to_theta(self, r1_index, r2_index, th_index, weights, arrays):
+        """
+        Adds the contacts of one reference vector to Theta arrays. All contacts share r1, so they
+        are histogrammed over (r2, theta) and added to the r1 slab (and the r1 column if reflecting)
+        :param r1_index: radial bin of the reference vector
+        :param r2_index: radial bins of the partner vectors
+        :param th_index: theta bins of the contacts
+        :param weights: weight of each contact
+        :param arrays: Theta arrays to add to
+        :return:
+        """
+        hist = np.bincount(np.multiply(r2_index, self.nth, dtype=np.intp) + th_index, weights=weights,
+                           minlength=self.nr * self.nth).reshape(self.nr, self.nth)
+        for array in arrays:
+            array[r1_index] += hist
+            if self.r12_reflection:
+                array[:, r1_index] += hist
+
+    def bin_partial_contacts_to_theta(self, r1_index, r2_index, th_index, weights, combo):
+        """
+        Adds the contacts of one reference vector to the partial Theta volumes of their
+        species-pair combinations
+        :return:
+        """
+        n_combos = self.n_species_pairs * (self.n_species_pairs + 1) // 2
+        hist = np.bincount((combo * self.nr + r2_index) * self.nth + th_index, weights=weights,
+                           minlength=n_combos * self.nr * self.nth).reshape(n_combos, self.nr, self.nth)
+        for c in np.unique(combo[weights != 0]):
+            partial = self.get_partial_theta(c)
+            partial[r1_index] += hist[c]
+            if self.r12_reflection:
+                partial[:, r1_index] += hist[c]
+
+    def calc_padf_frm_iav(self, k, weight=1.0):
+        """
+        Bins the contacts between one reference vector and every other interatomic vector.
+        Angles are binned directly on the cosine of the precomputed unit vectors
+        :param k: reference vector number (row of reference_vectors), sets the odd/even half
+        :param weight: multiplicity of the reference vector
+        :return:
+        """
+        ref = self.reference_vectors
+        table = self.interatomic_vectors
+        th_index = u.cos_bin_index(ref.unit[:, k] @ table.unit, self.cos_bin_edges)
+        fprod = (ref.z_product[k] * weight) * table.z_product
+        # Skip partners identical to the reference vector
+        same = table.same_as(ref, k)
+        fprod[same] = 0.0
+        r1_index = ref.r_bin[k]
+        half = self.rolling_Theta_evens if k % 2 == 0 else self.rolling_Theta_odds
+        self.bin_contacts_to_theta(r1_index, table.r_bin, th_index, fprod, [half])
+        if self.partials_flag:
+            combo = u.pair_code(int(ref.pair_code[k]), table.pair_code.astype(np.intp), self.n_species_pairs)
+            self.bin_partial_contacts_to_theta(r1_index, table.r_bin, th_index, fprod, combo)
+        self.total_contribs += (len(table) - len(same)) * weight
+
+    def add_tile_to_theta(self, hist, r1_values, r2_start, array):
+        """
+        Adds a local tile histogram to the (r1_values, r2_start:r2_start + n2) sub-region of a Theta array
+        (and the transposed sub-region if reflecting)
+        :param hist: (n1, n2, nth) tile histogram
+        :param r1_values: radial bins of the n1 histogram rows
+        :param r2_start: radial bin of the first histogram column
+        :param array: Theta array to add to
+        :return:
+        """
+        r2_stop = r2_start + hist.shape[1]
+        array[r1_values, r2_start:r2_stop] += hist
+        if self.r12_reflection:
+            array[r2_start:r2_stop, r1_values] += hist.transpose(1, 0, 2)
+
+    def calc_padf_frm_tile(self, k0, rows, weights):
+        """
+        Bins the contacts between a batch of reference vectors and every interatomic vector, one
+        block of tile_partners partners at a time. Each tile is histogrammed locally over the
+        (r1, r2, theta) sub-region it touches, which stays in cache, and then added to Theta
+        :param k0: number of the first reference vector in the batch, sets the odd/even halves
+        :param rows: rows of the batch in reference_vectors
+        :param weights: multiplicity of each reference vector in the batch
+        :return:
+        """
+        ref = self.reference_vectors
+        table = self.interatomic_vectors
+        r1_values, r1_local = np.unique(ref.r_bin[rows], return_inverse=True)
+        n1 = len(r1_values)
+        ref_unit = ref.unit[:, rows].T
+        ref_fz = ref.z_product[rows] * weights
+        # Row of the local histogram: [even, odd] x r1
+        ref_base = (k0 + np.arange(len(rows))) % 2 * n1 + r1_local
+        # Skip partners identical to the reference vectors
+        same = [table.same_as(ref, row) for row in rows]
+        same_i = np.repeat(np.arange(len(rows)), [len(s) for s in same])
+        same_j = np.concatenate(same)
+        if self.partials_flag:
+            ref_code = ref.pair_code[rows].astype(np.intp)[:, None]
+            n_combos = self.n_species_pairs * (self.n_species_pairs + 1) // 2
+        for lo in range(0, len(table), self.tile_partners):
+            hi = min(lo + self.tile_partners, len(table))
+            r2_start = int(table.r_bin[lo])
+            n2 = int(table.r_bin[hi - 1]) - r2_start + 1
+            r2_local = table.r_bin[lo:hi] - np.uint16(r2_start)
+            th_index = u.cos_bin_index(ref_unit @ table.unit[:, lo:hi], self.cos_bin_edges)
+            fprod = ref_fz[:, None] * table.z_product[lo:hi]
+            in_block = (same_j >= lo) & (same_j < hi)
+            fprod[same_i[in_block], same_j[in_block] - lo] = 0.0
+            index = (ref_base[:, None] * n2 + r2_local) * self.nth + th_index
+            hist = np.bincount(index.ravel(), weights=fprod.ravel(),
+                               minlength=2 * n1 * n2 * self.nth).reshape(2, n1, n2, self.nth)
+            self.add_tile_to_theta(hist[0], r1_values, r2_start, self.rolling_Theta_evens)
+            self.add_tile_to_theta(hist[1], r1_values, r2_start, self.rolling_Theta_odds)
+            if self.partials_flag:
+                combo = u.pair_code(ref_code, table.pair_code[lo:hi].astype(np.intp), self.n_species_pairs)
+                index = ((combo * n1 + r1_local[:, None]) * n2 + r2_local) * self.nth + th_index
+                hist = np.bincount(index.ravel(), weights=fprod.ravel(),
+                                   minlength=n_combos * n1 * n2 * self.nth).reshape(n_combos, n1, n2, self.nth)
+                for c in np.unique(combo[fprod != 0]):
+                    self.add_tile_to_theta(hist[c], r1_values, r2_start, self.get_partial_theta(c))
+        self.total_contribs += np.sum((len(table) - np.bincount(same_i, minlength=len(rows))) * weights)
+
+    def periodic_pair_calculation(self, subject_species, extended_species):
+        """
+        Generates the interatomic vectors from the subject atoms to the periodic images
+        of the unit cell within rmax
+        :return:
+        """
+        print(f'<periodic_pair_calculation> Cell list over lattice {self.lattice_vectors.tolist()}')
+        vectors, mags, i_index, j_index = u.periodic_pair_vectors(self.subject_atoms, self.extended_atoms,
+                                                                  self.lattice_vectors, self.rmax)
+        for i in np.flatnonzero(mags < 0.8):
+            print(f'<pair_dist_calculation> Warning: Unphysical interatomic distances detected:')
+            print(f'<pair_dist_calculation> {self.subject_atoms[i_index[i]]} {self.extended_atoms[j_index[i]]} '
+                  f'are problematic')
+        self.n2_contacts = mags
+        self.interatomic_vectors = np.column_stack(
+            (vectors, mags, self.subject_atoms[i_index, 3] * self.extended_atoms[j_index, 3],
+             u.pair_code(subject_species[i_index], extended_species[j_index], len(self.species_z)), i_index))
 
     def pair_dist_calculation(self):
         print(f'<pair_dist_calculation> Calculating pairwise interatomic distances...')
-        # interatomic_vectors
-        for k, a_i in enumerate(self.subject_atoms):
-            if k % int(len(self.subject_atoms) * 1) == 0:
-                print(f"{k} / {len(self.subject_atoms)}")
-            for a_j in self.extended_atoms:
-                if not np.array_equal(a_i, a_j):
-                    mag_r_ij = u.fast_vec_difmag(a_i[0], a_i[1], a_i[2], a_j[0], a_j[1], a_j[2])
-                    r_ij = u.fast_vec_subtraction(a_i[0], a_i[1], a_i[2], a_j[0], a_j[1], a_j[2])
-                    r_ij.append(mag_r_ij)
-                    r_ij.append(a_i[3] * a_j[3])
-                    # print(f'r_ij : {r_ij}')
-                    if mag_r_ij < 0.8:
-                        print(f'<pair_dist_calculation> Warning: Unphysical interatomic distances detected:')
-                        print(f'<pair_dist_calculation> {a_i} {a_j} are problematic')
-                    self.n2_contacts.append(mag_r_ij)
-                    self.interatomic_vectors.append(r_ij)
-        np.array(self.n2_contacts)
+        self.setup_instrument()
+        # interatomic_vectors : [dx, dy, dz, |r|, Z_i * Z_j, species pair code, subject atom index]
+        subject_species = u.species_codes(self.subject_atoms[:, 3], self.species_z)
+        extended_species = u.species_codes(self.extended_atoms[:, 3], self.species_z)
+        if self.periodic_flag:
+            self.periodic_pair_calculation(subject_species, extended_species)
+        else:
+            for k, a_i in enumerate(self.subject_atoms):
+                if self.instrument.enabled:
+                    self.instrument.emit('progress', tag=self.tag, stage='pair_dist_calculation', k=k,
+                                         n=len(self.subject_atoms))
+                for j, a_j in enumerate(self.extended_atoms):
+                    if not np.array_equal(a_i, a_j):
+                        mag_r_ij = u.fast_vec_difmag(a_i[0], a_i[1], a_i[2], a_j[0], a_j[1], a_j[2])
+                        r_ij = u.fast_vec_subtraction(a_i[0], a_i[1], a_i[2], a_j[0], a_j[1], a_j[2])
+                        r_ij.append(mag_r_ij)
+                        r_ij.append(a_i[3] * a_j[3])
+                        r_ij.append(u.pair_code(subject_species[k], extended_species[j], len(self.species_z)))
+                        r_ij.append(k)
+                        # print(f'r_ij : {r_ij}')
+                        if mag_r_ij < 0.8:
+                            print(f'<pair_dist_calculation> Warning: Unphysical interatomic distances detected:')
+                            print(f'<pair_dist_calculation> {a_i} {a_j} are problematic')
+                        self.n2_contacts.append(mag_r_ij)
+                        self.interatomic_vectors.append(r_ij)
         print(f'<pair_dist_calculation> {len(self.interatomic_vectors)} interatomic vectors')
-        np.savetxt(self.root + self.project + self.tag + '_atomic_pairs.txt', self.n2_contacts)
-        np.save(self.root + self.project + self.tag + '_interatomic_vectors.npy', self.interatomic_vectors)
+        # Arrays, so the writer sizes them for its back-pressure and snapshots them in one copy
+        pair_distances = np.asarray(self.n2_contacts, dtype=float)
+        vectors = np.asarray(self.interatomic_vectors, dtype=float).reshape(-1, 7)
+        if self.output_format == 'hdf5':
+            self.write_container({'pair_distances': pair_distances, 'interatomic_vectors': vectors},
+                                 group='pairs', mode='w')
+        else:
+            self.writer.submit(np.savetxt, self.root + self.project + self.tag + '_atomic_pairs.txt', pair_distances)
+            self.writer.submit(np.save, self.root + self.project + self.tag + '_interatomic_vectors.npy', vectors)
         # np.savetxt(self.root + self.project + self.tag + '_interatomic_vectors.txt', self.interatomic_vectors)
         print(f'<pair_dist_calculation> ... interatomic distances calculated')
         pdf_r_range = np.arange(start=0, stop=self.rmax, step=(self.r_dist_bin / 10))
@@ -356,11 +761,16 @@ class ModelPadfCalculator:
         for k, rb in enumerate(adfr_r):
             adfr_corr[k] = n_atom_density * (1 / (4 * np.pi * rb ** 2 * n_atoms)) * adfr_int[k]
         pdf_arr = np.column_stack((adfr_r, adfr_corr))
+        apdf_arr = np.column_stack((adfr_r, adfr_int))
         print(f'<pair_dist_calculation> PDF written to: ')
-        np.savetxt(self.root + self.project + self.tag + '_PDF.txt', pdf_arr)
-        np.savetxt(self.root + self.project + self.tag + '_APDF.txt', np.column_stack((adfr_r, adfr_int)))
-        print(f"{self.root + self.project + self.tag + '_PDF.txt'}")
-        print(f"{self.root + self.project + self.tag + '_APDF.txt'}")
+        if self.output_format == 'hdf5':
+            self.write_container({'pdf': pdf_arr, 'apdf': apdf_arr}, group='pairs')
+            print(f"{self.container_path()} (pairs/pdf, pairs/apdf)")
+        else:
+            self.writer.submit(np.savetxt, self.root + self.project + self.tag + '_PDF.txt', pdf_arr)
+            self.writer.submit(np.savetxt, self.root + self.project + self.tag + '_APDF.txt', apdf_arr)
+            print(f"{self.root + self.project + self.tag + '_PDF.txt'}")
+            print(f"{self.root + self.project + self.tag + '_APDF.txt'}")
         return self.interatomic_vectors
 
     def trim_interatomic_vectors_to_probe(self):
@@ -376,57 +786,345 @@ class ModelPadfCalculator:
         print(f'<trim_interatomic_vectors_to_probe> ..after trimming to < self.rmax : {len(b)} vectors')
         print(f'<trim_interatomic_vectors_to_probe> ..after trimming to > self.rmin : {len(c)} vectors')
         print(f'<trim_interatomic_vectors_to_probe> ..after trimming : {len(c)} vectors')
-        self.interatomic_vectors = c
-        np.save(self.root + self.project + self.tag + '_interatomic_vectors_trim.npy', self.interatomic_vectors)
+        # Compact columnar table with the radial bins and unit vectors [ux, uy, uz] precomputed,
+        # so the angular binning only needs a dot product
+        self.setup_binning()
+        self.interatomic_vectors = vt.InteratomicVectorTable.from_array(c, self.r_bin_edges, dtype=self.vector_dtype,
+                                                                        probe_radii=list(self.probe_bins()))
+        print(f'<trim_interatomic_vectors_to_probe> Vector table : {self.interatomic_vectors.nbytes / 1e6} MB')
+        if self.output_format == 'hdf5':
+            self.write_container(self.interatomic_vectors.columns(), group='interatomic_vectors_trim')
+        else:
+            self.writer.submit(np.savez, self.root + self.project + self.tag + '_interatomic_vectors_trim.npz',
+                               **self.interatomic_vectors.columns())
+
+    def symmetry_setup(self):
+        """
+        Finds the symmetry-equivalent subject atoms and selects the reference vectors of one
+        representative per equivalence class. Each representative is weighted by the size of
+        its class. The partner set is still the full vector table, so the result equals the
+        full calculation when the subject set is closed under the symmetry (e.g. a full unit cell):
+        bin edge ties and duplicate vectors are resolved the same way for every class member
+        (utils.cos_bin_index, utils.r_bin_index, vector_table.value_keys)
+        :return:
+        """
+        n_subject = len(self.subject_atoms)
+        if self.symmetry_mode == 'cif':
+            if len(self.subject_orbits) != n_subject:
+                raise ValueError("<symmetry_setup>: symmetry_mode 'cif' needs the subject atoms from a cif")
+            orbits = self.subject_orbits
+        elif self.symmetry_mode == 'fingerprint':
+            orbits = u.environment_fingerprints(self.interatomic_vectors.as_array(), self.interatomic_vectors.subject,
+                                                n_subject, decimals=self.symmetry_decimals)
+        else:
+            self.subject_multiplicity = np.ones(n_subject)
+            self.reference_vectors = self.interatomic_vectors
+            return
+        _, representatives, counts = np.unique(orbits, return_index=True, return_counts=True)
+        self.subject_multiplicity = np.zeros(n_subject)
+        self.subject_multiplicity[representatives] = counts
+        self.reference_vectors = self.interatomic_vectors.subset(
+            self.subject_multiplicity[self.interatomic_vectors.subject] > 0)
+        print(f'<symmetry_setup> {n_subject} subject atoms in {len(representatives)} equivalence classes, '
+              f'multiplicities {counts.tolist()}')
+        print(f'<symmetry_setup> {len(self.reference_vectors)} of {len(self.interatomic_vectors)} '
+              f'interatomic vectors used as reference vectors')
+
+    def setup_instrument(self):
+        """
+        Creates the default console instrument if none was given
+        :return:
+        """
+        if self.instrument is None:
+            self.instrument = ins.ConsoleInstrument(progress_interval=0.0 if self.verbosity == 1 else 10.0)
+
+    def setup_writer(self):
+        """
+        Creates a synchronous writer if the writer was set to None
+        :return:
+        """
+        if self.writer is None:
+            self.writer = ow.SyncWriter()
+
+    def run_setup(self):
+        with self.instrument.stage('setup', tag=self.tag) as info:
+            self.parameter_check()
+            self.write_all_params_to_file()
+            self.subject_atoms, self.extended_atoms = self.subject_target_setup()  # Sets up the atom positions of the subject set and supercell
+            self.dimension = self.get_dimension()  # Sets the target dimension (somewhat redundant until I get the fast r=r' mode set up)
+            info['subject_atoms'] = len(self.subject_atoms)
+            info['extended_atoms'] = len(self.extended_atoms)
+
+    def run_pairing(self):
+        with self.instrument.stage('pairing', tag=self.tag) as info:
+            self.interatomic_vectors = self.pair_dist_calculation()  # Calculate all the interatomic vectors.
+            info['interatomic_vectors'] = len(self.interatomic_vectors)
+
+    def run_trimming(self):
+        with self.instrument.stage('trimming', tag=self.tag) as info:
+            self.trim_interatomic_vectors_to_probe()  # Trim all the interatomic vectors to the r_probe limit
+            info['interatomic_vectors'] = len(self.interatomic_vectors)
+
+    def run_accumulation(self):
+        with self.instrument.stage('accumulation', tag=self.tag) as info:
+            self.accumulate_theta()
+            info['reference_vectors'] = self.converged_loop
+            info['contacts'] = self.total_contribs
+            if self.instrument.enabled:
+                info['bins_touched'] = int(np.count_nonzero(self.rolling_Theta))
+        self.instrument.emit('stage', tag=self.tag, stage='convergence_checks', wall_time_s=self.convergence_time,
+                             checks=self.converged_loop, converged=self.converged_flag)
+        if self.probe_radii:
+            with self.instrument.stage('probe_sweep', tag=self.tag) as info:
+                self.probe_sweep()
+                info['probes'] = len(self.probe_Theta)
+
+    def run_saving(self):
+        with self.instrument.stage('saving', tag=self.tag):
+            self.save_theta()
+            self.save_probe_theta()
+
+        self.calculation_time = time.time() - self.run_start
+        print(
+            f"<fast_model_padf.run_fast_serial_calculation> run_fast_serial_calculation run time = {self.calculation_time} seconds")
+        print(
+            f"<fast_model_padf.run_fast_serial_calculation> Total contributing contacts (for normalization) = {self.total_contribs}")
+        self.write_calculation_summary()
+        if self.flush_writer:
+            self.writer.flush()
+        self.instrument.emit('finished', tag=self.tag, wall_time_s=self.calculation_time, contacts=self.total_contribs)
+        # Plot diagnostics
+        self.loop_similarity_array = np.array(self.loop_similarity_array)
 
     def run_fast_serial_calculation(self):
-        global_start = time.time()
-        self.parameter_check()
-        self.write_all_params_to_file()
-        self.subject_atoms, self.extended_atoms = self.subject_target_setup()  # Sets up the atom positions of the subject set and supercell
-        self.dimension = self.get_dimension()  # Sets the target dimension (somewhat redundant until I get the fast r=r' mode set up)
-        """
-        Here we do the chunking for sending to threads
-        """
-        self.interatomic_vectors = self.pair_dist_calculation()  # Calculate all the interatomic vectors.
-        self.trim_interatomic_vectors_to_probe()  # Trim all the interatomic vectors to the r_probe limit
-        self.percent_milestones = np.linspace(start=0, stop=len(self.interatomic_vectors), num=10)
-        self.iteration_times = np.zeros(len(self.interatomic_vectors))
-        # print(self.iteration_times.shape)
+        self.run_start = time.time()
+        self.setup_instrument()
+        self.setup_writer()
+        for stage in self.stages:
+            getattr(self, f'run_{stage}')()
+
+    def accumulate_theta(self):
+        """
+        Loops over the reference vectors and accumulates the rolling Theta arrays until
+        the convergence criteria are met
+        :return:
+        """
+        self.setup_instrument()
+        self.symmetry_setup()  # Select the reference vectors of symmetry-unique subject atoms
+        self.percent_milestones = np.linspace(start=0, stop=len(self.reference_vectors), num=10)
+        self.iteration_times = np.zeros(len(self.reference_vectors))
+        self.loop_time = 0.0
         [int(j) for j in self.percent_milestones]
         # print(f'{self.percent_milestones=}')
-        np.random.shuffle(self.interatomic_vectors)  # Shuffle list of vectors
+        self.order_reference_vectors()
         print(
             f'<fast_model_padf.run_fast_serial_calculation> Total interatomic vectors: {len(self.interatomic_vectors)}')
         # Set up the rolling PADF arrays
-        self.rolling_Theta = np.zeros((self.nr, self.nr, self.nth))
         self.rolling_Theta_odds = np.zeros((self.nr, self.nr, self.nth))
         self.rolling_Theta_evens = np.zeros((self.nr, self.nr, self.nth))
+        if self.partials_flag:
+            self.setup_partial_theta()
+        self.setup_binning()
         # Here we loop over interatomic vectors
         print(f'<fast_model_padf.run_fast_serial_calculation> Working...')
-        for k, subject_iav in enumerate(self.interatomic_vectors):
+        self.convergence_time = 0.0
+        if self.accumulation == 'tiled':
+            self.accumulate_tiles()
+            return
+        elif self.accumulation != 'vector':
+            raise ValueError(f"<accumulate_theta>: unknown accumulation '{self.accumulation}'")
+        self.reference_rows = np.arange(len(self.reference_vectors))
+        weights = self.subject_multiplicity[self.reference_vectors.subject]
+        k_lo, k_hi = self.shard_range()
+        for k in range(k_lo, k_hi):
             k_start = time.time()
-            self.calc_padf_frm_iav(k=k, r_ij=subject_iav)
+            self.calc_padf_frm_iav(k=k, weight=weights[k])
+            check_start = time.time()
             self.cycle_assessment(k=k, start_time=k_start)
-            if self.converged_flag:
+            self.convergence_time += time.time() - check_start
+            self.converged_loop = k + 1 - k_lo
+            if self.converged_flag and self.shard_count == 1:
                 break
 
-        # Save the rolling PADF arrays
-        np.save(self.root + self.project + self.tag + '_mPADF_total_sum', self.rolling_Theta)
-        np.save(self.root + self.project + self.tag + '_mPADF_odds_sum', self.rolling_Theta_odds)
-        np.save(self.root + self.project + self.tag + '_mPADF_evens_sum', self.rolling_Theta_evens)
+    def shard_range(self):
+        """
+        Range of reference vector numbers processed by this calculator
+        :return: first, last + 1
+        """
+        n = len(self.reference_vectors)
+        k_lo, k_hi = n * self.shard_index // self.shard_count, n * (self.shard_index + 1) // self.shard_count
+        if self.shard_count > 1:
+            print(f'<shard_range> Shard {self.shard_index} of {self.shard_count}: reference vectors {k_lo} to {k_hi}')
+        return k_lo, k_hi
 
-        self.calculation_time = time.time() - global_start
-        print(
-            f"<fast_model_padf.run_fast_serial_calculation> run_fast_serial_calculation run time = {self.calculation_time} seconds")
-        print(
-            f"<fast_model_padf.run_fast_serial_calculation> Total contributing contacts (for normalization) = {self.total_contribs}")
-        self.write_calculation_summary()
-        # Plot diagnostics
-        self.loop_similarity_array = np.array(self.loop_similarity_array)
+    def setup_tiles(self):
+        """
+        Sorts the partner vectors by radial bin, so each block of tile_partners partners covers
+        a narrow range of r2
+        :return: row of each reference vector (in sampling order) in reference_vectors
+        """
+        order = np.argsort(self.interatomic_vectors.r_bin, kind='stable')
+        shared = self.reference_vectors is self.interatomic_vectors
+        self.interatomic_vectors = self.interatomic_vectors.subset(order)
+        if shared:
+            # The sorted table is also the reference table, remember the sampling order
+            self.reference_vectors = self.interatomic_vectors
+            rows = np.empty_like(order)
+            rows[order] = np.arange(len(order))
+            return rows
+        return np.arange(len(self.reference_vectors))
+
+    def accumulate_tiles(self):
+        """
+        Tiled accumulation loop. Convergence is checked after each batch of tile_references
+        reference vectors, so the calculation stops at the end of the batch in which it converged
+        :return:
+        """
+        rows = self.setup_tiles()
+        self.reference_rows = rows
+        weights = self.subject_multiplicity[self.reference_vectors.subject[rows]]
+        print(f'<accumulate_tiles> {self.tile_references} reference x {self.tile_partners} partner vector tiles')
+        k_lo, k_hi = self.shard_range()
+        for k0 in range(k_lo, k_hi, self.tile_references):
+            k_start = time.time()
+            k1 = min(k0 + self.tile_references, k_hi)
+            self.calc_padf_frm_tile(k0, rows[k0:k1], weights[k0:k1])
+            check_start = time.time()
+            self.cycle_assessment(k=k1 - 1, start_time=k_start)
+            self.convergence_time += time.time() - check_start
+            self.converged_loop = k1 - k_lo
+            if self.converged_flag and self.shard_count == 1:
+                break
 
-        # plt.plot(self.loop_similarity_array[:, 0], self.loop_similarity_array[:, 1], '-')
-        # plt.show()
+    def probe_bins(self):
+        """
+        Number of radial bins of each probe radius of the sweep
+        :return: dict of probe radius : bins, in ascending order of radius
+        """
+        bins = {}
+        for probe in sorted(self.probe_radii):
+            n = int(round(probe / self.r_dist_bin))
+            if not 0 < n < self.nr or not m.isclose(n * self.r_dist_bin, probe, rel_tol=1e-9):
+                raise ValueError(f'<probe_bins>: probe radius {probe} is not a multiple of the bin width '
+                                 f'{self.r_dist_bin} below rmax {self.rmax}')
+            bins[float(probe)] = n
+        return bins
+
+    def probe_sweep(self):
+        """
+        Theta of each probe radius of the sweep from the reference vectors processed at rmax. The
+        sub-cube of the probe's bins holds every contact of the probe, plus the contacts of the
+        vectors in its last bin that are longer than the probe (probe <= |r| < probe + r_dist_bin / 2),
+        which are binned again here and subtracted
+        :return:
+        """
+        table = self.interatomic_vectors
+        ref = self.reference_vectors
+        k_lo = len(ref) * self.shard_index // self.shard_count
+        ks = np.arange(k_lo, k_lo + self.converged_loop)
+        rows = self.reference_rows[ks]
+        weights = self.subject_multiplicity[ref.subject[rows]]
+        same_count = np.bincount(table.value_id)[ref.value_id[rows]]
+        for q, (probe, n) in enumerate(self.probe_bins().items()):
+            halves = (self.rolling_Theta_evens[:n, :n].copy(), self.rolling_Theta_odds[:n, :n].copy())
+            partners = np.flatnonzero(table.r_bin < n)
+            longer = partners[table.probe_level[partners] > q]
+            ref_inside = ref.probe_level[rows] <= q
+            # Reference vectors longer than the probe, against every partner in the sub-cube
+            for i in np.flatnonzero(~ref_inside & (ref.r_bin[rows] < n)):
+                row = rows[i]
+                th_index = u.cos_bin_index(ref.unit[:, row] @ table.unit[:, partners], self.cos_bin_edges)
+                fprod = -(ref.z_product[row] * weights[i]) * table.z_product[partners]
+                fprod[table.value_id[partners] == ref.value_id[row]] = 0.0
+                hist = np.bincount(np.multiply(table.r_bin[partners], self.nth, dtype=np.intp) + th_index,
+                                   weights=fprod, minlength=n * self.nth).reshape(n, self.nth)
+                half = halves[ks[i] % 2]
+                half[ref.r_bin[row]] += hist
+                if self.r12_reflection:
+                    half[:, ref.r_bin[row]] += hist
+            # Reference vectors inside the probe, against the partners longer than the probe
+            inside = np.flatnonzero(ref_inside)
+            ref_unit = ref.unit[:, rows[inside]]
+            ref_fz = ref.z_product[rows[inside]] * weights[inside]
+            base = np.multiply(ks[inside] % 2 * n + ref.r_bin[rows[inside]], self.nth, dtype=np.intp)
+            for c in longer:
+                th_index = u.cos_bin_index(table.unit[:, c] @ ref_unit, self.cos_bin_edges)
+                fprod = -ref_fz * table.z_product[c]
+                fprod[ref.value_id[rows[inside]] == table.value_id[c]] = 0.0
+                hist = np.bincount(base + th_index, weights=fprod,
+                                   minlength=2 * n * self.nth).reshape(2, n, self.nth)
+                for half, h in zip(halves, hist):
+                    half[:, table.r_bin[c]] += h
+                    if self.r12_reflection:
+                        half[table.r_bin[c]] += h
+            self.probe_Theta[probe] = (halves[0] + halves[1], halves[1], halves[0])
+            self.probe_contribs[probe] = float(np.sum(
+                (np.count_nonzero(table.probe_level <= q) - same_count[ref_inside]) * weights[ref_inside]))
+            print(f'<probe_sweep> rmax {probe} ({n} bins): {len(longer)} vectors beyond the probe in its last bin, '
+                  f'{self.probe_contribs[probe]} contacts')
+
+    def save_probe_theta(self):
+        """
+        Saves the Theta volumes of the probe sweep ({tag}_rmax{probe}_mPADF_*_sum.npy, or group
+        probe_rmax_{probe} of the container)
+        :return:
+        """
+        for probe, (total, odds, evens) in self.probe_Theta.items():
+            if self.output_format == 'hdf5':
+                self.write_container({'total': total, 'odds': odds, 'evens': evens}, group=f'probe_rmax_{probe:g}',
+                                     attrs={'rmax': probe, 'nr': total.shape[0],
+                                            'total_contribs': self.probe_contribs[probe]})
+                continue
+            stem = f'{self.root}{self.project}{self.tag}_rmax{probe:g}_mPADF'
+            self.writer.submit(np.save, stem + '_total_sum', total)
+            self.writer.submit(np.save, stem + '_odds_sum', odds)
+            self.writer.submit(np.save, stem + '_evens_sum', evens)
+
+    def save_rebinned_theta(self, volumes):
+        """
+        Saves the volumes rebinned to each of rebin_grids ({tag}_nr{nr}_nth{nth}_mPADF_*_sum.npy, or
+        group rebinned_nr{nr}_nth{nth} of the container)
+        :param volumes: dict of part : volume
+        :return:
+        """
+        for nr, nth in self.rebin_grids:
+            coarse = {part: u.rebin_theta(volume, nr, nth) for part, volume in volumes.items()}
+            if self.output_format == 'hdf5':
+                self.write_container(coarse, group=f'rebinned_nr{nr}_nth{nth}',
+                                     attrs={'nr': nr, 'nth': nth, 'rmax': self.rmax})
+                continue
+            for part, volume in coarse.items():
+                self.writer.submit(np.save, f'{self.root}{self.project}{self.tag}_nr{nr}_nth{nth}_mPADF_{part}_sum',
+                                   volume)
+
+    def save_theta(self):
+        """
+        Saves the rolling PADF arrays
+        :return:
+        """
+        total = self.rolling_Theta
+        if self.output_format == 'hdf5':
+            volumes = {'total': total, 'odds': self.rolling_Theta_odds, 'evens': self.rolling_Theta_evens}
+            if self.error_bound > 0 and self.converged_loop > 0:
+                volumes['variance'] = self.variance_estimate(self.converged_loop)
+            self.write_container(volumes, attrs={'r_bin_edges': str(self.r_bin_edges.tolist()),
+                                                 'cos_bin_edges': str(self.cos_bin_edges.tolist())})
+            if self.partials_flag:
+                self.save_partial_theta()
+            self.save_rebinned_theta({'total': total, 'odds': self.rolling_Theta_odds,
+                                      'evens': self.rolling_Theta_evens})
+            return
+        elif self.output_format != 'npy':
+            raise ValueError(f"<save_theta>: unknown output_format '{self.output_format}'")
+        self.writer.submit(np.save, self.root + self.project + self.tag + '_mPADF_total_sum', total)
+        self.writer.submit(np.save, self.root + self.project + self.tag + '_mPADF_odds_sum', self.rolling_Theta_odds)
+        self.writer.submit(np.save, self.root + self.project + self.tag + '_mPADF_evens_sum', self.rolling_Theta_evens)
+        if self.partials_flag:
+            self.save_partial_theta()
+        if self.error_bound > 0 and self.converged_loop > 0:
+            self.writer.submit(np.save, self.root + self.project + self.tag + '_mPADF_variance',
+                               self.variance_estimate(self.converged_loop))
+        self.save_rebinned_theta({'total': total, 'odds': self.rolling_Theta_odds, 'evens': self.rolling_Theta_evens})
 
 # if __name__ == '__main__':
 #     modelp = ModelPadfCalculator()
@@ -0,0 +1,422 @@
+"""
+Incremental Theta updates along an MD trajectory
+
+Theta is a sum over pairs of interatomic vectors, so when only some atoms move between
+frames only the pairs involving a vector of a moved atom change. IncrementalTheta keeps
+the vectors of the previous frame, subtracts the contacts of the vectors touching moved
+atoms (or atoms entering or leaving the cluster) and adds their new contacts, so a frame
+costs about (changed vectors) x (all vectors) instead of (all vectors)^2. When more than
+rebuild_fraction of the vectors would be replaced, subtracting and re-adding their contacts
+costs more than building the frame from scratch, so the frame is rebuilt instead.
+
+With tolerance 0 every atom that moved at all is changed, so a trajectory where every atom
+jitters would recompute everything. To avoid part of that, each vector also keeps its margin:
+the smallest distance of the cosines of its contacts to a theta bin boundary. A vector that
+keeps its radial bin, has no identical vector and turned by less than its margin (less the
+largest turn of any other kept vector) has all its contacts in the same bins, so it keeps its
+stored row and its contacts are not recomputed. Margins are small (about the bin width over
+the number of vectors), so this only helps for very small displacements or rigid motion, with
+a float64 vector table; for thermal jitter use a tolerance.
+
+Every vector is a reference vector (no convergence stop, no symmetry reduction), and its
+odd/even half is fixed by a hash of its atom pair, so the halves also update incrementally.
+The contact weights are integer products of atomic numbers, so the sums are exact and
+verify() reproduces the incremental volumes bit for bit from a full recompute.
+
+@author: andrewmartin, jack-binns
+"""
+import numpy as np
+
+import utils as u
+import vector_table as vt
+
+
+def pair_parity(atom_i, atom_j):
+    """
+    Odd/even half of the vectors between atoms atom_i and atom_j, a hash of the atom pair
+    :return: int array of 0 (evens) and 1 (odds)
+    """
+    h = atom_i.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) + atom_j.astype(np.uint64) * np.uint64(
+        0xC2B2AE3D27D4EB4F)
+    return ((h >> np.uint64(32)) & np.uint64(1)).astype(np.intp)
+
+
+class IncrementalTheta:
+    """
+    Theta volumes of a trajectory, updated frame by frame. The atoms of every frame must be in
+    the same order. Binning parameters, the COM cluster settings and the output are taken from
+    the calculator
+    """
+
+    def __init__(self, calculator, tolerance=0.0, max_pairs=1 << 20, rebuild_fraction=0.5):
+        """
+        :param calculator: ModelPadfCalculator with the parameters of the run
+        :param tolerance: atoms that moved at most this far keep their previous position,
+        0 follows every displacement and is exact
+        :param max_pairs: atom pairs evaluated at once when building vectors
+        :param rebuild_fraction: rebuild the frame from scratch when more than this fraction of the
+        vectors would be replaced
+        """
+        if calculator.partials_flag or calculator.symmetry_mode is not None or calculator.periodic_flag:
+            raise ValueError('<IncrementalTheta> incremental updates do not support partials, symmetry reduction '
+                             'or periodic mode')
+        self.calc = calculator
+        self.tolerance = tolerance
+        self.max_pairs = max_pairs
+        self.rebuild_fraction = rebuild_fraction
+        self.calc.parameter_check()
+        self.calc.setup_binning()
+        self.bin_bounds = u.cos_bin_bounds(self.calc.cos_bin_edges, self.calc.vector_dtype)
+        self.moved_atoms = 0  # atoms that changed in the last update
+        self.updated_vectors = 0  # vectors removed plus vectors added in the last update
+        self.rebuilds = 0  # frames rebuilt from scratch because most vectors were stale
+        self.kept_vectors = 0  # vectors of changed atoms that kept their stored row in the last update
+        self.reset()
+
+    def reset(self):
+        """
+        Empty volumes and no vectors
+        :return:
+        """
+        shape = (self.calc.nr, self.calc.nr, self.calc.nth)
+        self.odds = np.zeros(shape)
+        self.evens = np.zeros(shape)
+        self.total_contribs = 0
+        self.atoms = None  # (N, 4) positions the current vectors were built from
+        self.in_subject = np.zeros(0, dtype=bool)
+        self.in_extended = np.zeros(0, dtype=bool)
+        # Current vectors: float64 rows [dx, dy, dz, |r|, Z_i * Z_j] and the atoms they join
+        self.rows = np.zeros((0, 5))
+        self.atom_i = np.zeros(0, dtype=np.intp)
+        self.atom_j = np.zeros(0, dtype=np.intp)
+        self.margin = np.zeros(0)  # smallest distance of the cosines of each vector's contacts to a theta bin boundary
+        self.turn = np.zeros(0)  # distance between the stored and the current unit vector of each vector
+        self.table = None
+
+    @property
+    def theta(self):
+        """
+        Total Theta, the sum of the half volumes
+        """
+        return self.odds + self.evens
+
+    def select_atoms(self, atoms):
+        """
+        Subject and extended atoms of a frame, with the selection rules of clean_subject_atoms
+        and clean_extended_atoms
+        :return: subject indices, extended indices
+        """
+        calc = self.calc
+        if not calc.com_cluster_flag:
+            everything = np.arange(len(atoms))
+            return everything, everything
+        centre = calc.cluster_centre if calc.cluster_centre is not None else np.mean(atoms[:, :3], axis=0)
+        subject = calc.cluster_atoms(atoms, centre, calc.com_radius)
+        if calc.cluster_centre is None:
+            centre = np.mean(atoms[subject, :3], axis=0)
+        extended = calc.cluster_atoms(atoms, centre, 2 * calc.rmax)
+        return subject, extended
+
+    def pair_rows(self, atoms, subject, extended, changed):
+        """
+        Vectors from subject to extended atoms that touch a changed atom, as pair_dist_calculation
+        and trim_interatomic_vectors_to_probe compute them
+        :return: (M, 5) float64 rows, atom_i, atom_j
+        """
+        s_changed = subject[changed[subject]]
+        s_static = subject[~changed[subject]]
+        e_changed = extended[changed[extended]]
+        rows, atom_i, atom_j = [np.zeros((0, 5))], [np.zeros(0, dtype=np.intp)], [np.zeros(0, dtype=np.intp)]
+        for starts, partners in ((s_changed, extended), (s_static, e_changed)):
+            if len(partners) == 0:
+                continue
+            step = max(1, self.max_pairs // len(partners))
+            for lo in range(0, len(starts), step):
+                i = np.repeat(starts[lo:lo + step], len(partners))
+                j = np.tile(partners, len(starts[lo:lo + step]))
+                pairs = self.vector_rows(atoms, i, j)
+                keep = (i != j) & (pairs[:, 3] < self.calc.rmax) & (pairs[:, 3] > self.calc.rmin)
+                rows.append(pairs[keep])
+                atom_i.append(i[keep])
+                atom_j.append(j[keep])
+        return np.concatenate(rows), np.concatenate(atom_i), np.concatenate(atom_j)
+
+    @staticmethod
+    def vector_rows(atoms, atom_i, atom_j):
+        """
+        Rows [dx, dy, dz, |r|, Z_i * Z_j] of the vectors from atom_i to atom_j
+        :return: (M, 5) float64 rows
+        """
+        dx = atoms[atom_j, 0] - atoms[atom_i, 0]
+        dy = atoms[atom_j, 1] - atoms[atom_i, 1]
+        dz = atoms[atom_j, 2] - atoms[atom_i, 2]
+        r = np.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
+        return np.column_stack((dx, dy, dz, r, atoms[atom_i, 3] * atoms[atom_j, 3]))
+
+    def build_table(self, rows, atom_i):
+        return vt.InteratomicVectorTable.from_array(
+            np.column_stack((rows, np.zeros(len(rows)), atom_i)), self.calc.r_bin_edges, dtype=self.calc.vector_dtype)
+
+    @staticmethod
+    def identical(rows, row):
+        """
+        Rows equal to row in dx, dy, dz, |r| and Z_i * Z_j (vector_table.value_keys), the partners
+        skipped by calc_padf_frm_iav
+        """
+        candidates = np.flatnonzero(np.abs(rows[:, 3] - row[3]) < 10.0 ** -vt.VALUE_DECIMALS)
+        return candidates[np.all(vt.value_keys(rows[candidates]) == vt.value_keys(row), axis=1)]
+
+    def add_reference_contacts(self, refs, ref_rows, ref_parity, partners, partner_rows, sign, margin=None,
+                               reverse=None):
+        """
+        Adds (sign 1) or removes (sign -1) the contacts of each reference vector with every partner
+        :param margin: if given, set to the bin margin of each reference vector over its contacts
+        :param reverse: partner that is the reverse of each reference vector (reverse_index), left out of the margin
+        :return:
+        """
+        halves = (self.evens, self.odds)
+        for k in range(len(refs)):
+            cos = refs.unit[:, k] @ partners.unit
+            th_index = u.cos_bin_index(cos, self.calc.cos_bin_edges)
+            if margin is not None:
+                margin[k] = u.min_bin_margin(cos, th_index, *self.bin_bounds, reverse[k])
+            fprod = float(sign * int(refs.z_product[k])) * partners.z_product
+            same = self.identical(partner_rows, ref_rows[k])
+            fprod[same] = 0.0
+            self.calc.bin_contacts_to_theta(refs.r_bin[k], partners.r_bin, th_index, fprod, [halves[ref_parity[k]]])
+            self.total_contribs += sign * (len(partners) - len(same))
+
+    def add_partner_contacts(self, refs, ref_rows, ref_parity, partners, partner_rows, sign, margin=None,
+                             reverse=None):
+        """
+        Same contacts as add_reference_contacts, looping over the partners instead, for many
+        reference vectors against few partners
+        :param margin: if given, the bin margin of each reference vector, lowered to cover the new contacts
+        :param reverse: reference vector that is the reverse of each partner, left out of the margin
+        :return:
+        """
+        nr, nth = self.calc.nr, self.calc.nth
+        base = np.multiply(ref_parity * nr + refs.r_bin, nth, dtype=np.intp)
+        for c in range(len(partners)):
+            cos = partners.unit[:, c] @ refs.unit
+            th_index = u.cos_bin_index(cos, self.calc.cos_bin_edges)
+            if margin is not None:
+                u.lower_bin_margins(margin, cos, th_index, *self.bin_bounds, reverse[c])
+            fprod = float(sign * int(partners.z_product[c])) * refs.z_product
+            same = self.identical(ref_rows, partner_rows[c])
+            fprod[same] = 0.0
+            hist = np.bincount(base + th_index, weights=fprod, minlength=2 * nr * nth).reshape(2, nr, nth)
+            r2_index = partners.r_bin[c]
+            for array, h in ((self.evens, hist[0]), (self.odds, hist[1])):
+                array[:, r2_index] += h
+                if self.calc.r12_reflection:
+                    array[r2_index] += h
+            self.total_contribs += sign * (len(refs) - len(same))
+
+    def reverse_index(self, atom_i, atom_j, rows, partner_i, partner_j, partner_rows):
+        """
+        Partner joining atom_j to atom_i with exactly the negated row, for each vector, -1 if there is
+        none. Rows built from the same positions are exact negatives, so their contact stays
+        anti-parallel (theta bin 0) however the atoms move
+        :return: int array of partner rows
+        """
+        if len(partner_i) == 0:
+            return np.full(len(atom_i), -1)
+        n_atoms = len(self.atoms)
+        keys = partner_i * n_atoms + partner_j
+        order = np.argsort(keys)
+        wanted = atom_j * n_atoms + atom_i
+        index = order[np.minimum(np.searchsorted(keys[order], wanted), len(keys) - 1)]
+        found = (keys[index] == wanted) & np.all(partner_rows[index, :3] == -rows[:, :3], axis=1)
+        return np.where(found, index, -1)
+
+    def unit_vectors(self, rows):
+        """
+        Unit vectors of rows as stored in a vector table, (N, 3)
+        """
+        return (rows[:, :3] / rows[:, 3:4]).astype(self.calc.vector_dtype)
+
+    def bin_stable(self, candidates, new_rows, new_i, new_j):
+        """
+        Vectors touching a changed atom whose contacts all stay in the same bins: the same atom pair
+        in the same radial bin, no identical vector before or after, and a turn of the unit vector
+        smaller than the bin margin of its contacts less the largest turn of the other kept vectors.
+        Their contacts with the vectors added this frame are checked as well
+        :param candidates: mask of the current vectors touching a changed atom or kept with a turn before
+        :param new_rows: current rows of the candidate atom pairs (and of any new pairs)
+        :return: kept (mask of the current vectors keeping their stored row),
+        fresh (mask of new_rows still to add), turn of each current vector
+        """
+        kept = np.zeros(len(self.rows), dtype=bool)
+        fresh = np.ones(len(new_rows), dtype=bool)
+        turns = np.zeros(len(self.rows))
+        old = np.flatnonzero(candidates)
+        if len(old) == 0 or len(new_rows) == 0:
+            return kept, fresh, turns
+        n_atoms = len(self.atoms)
+        _, o, n = np.intersect1d(self.atom_i[old] * n_atoms + self.atom_j[old], new_i * n_atoms + new_j,
+                                 assume_unique=True, return_indices=True)
+        old = old[o]
+        stored, current = self.rows[old], new_rows[n]
+        # No identical vector among the stored and the current rows (a vector that did not move
+        # appears once in each)
+        _, value, counts = np.unique(vt.value_keys(np.concatenate((self.rows, new_rows))), axis=0,
+                                     return_inverse=True, return_counts=True)
+        value = value.ravel()
+        stored_value, current_value = value[old], value[len(self.rows) + n]
+        unique = np.where(stored_value == current_value, counts[stored_value] == 2,
+                          (counts[stored_value] == 1) & (counts[current_value] == 1))
+        eligible = unique & (self.table.r_bin[old] == u.r_bin_index(current[:, 3], self.calc.r_bin_edges))
+        # A contact between two kept vectors changes its cosine by at most the sum of their turns
+        turn = np.linalg.norm(stored[:, :3] / stored[:, 3:4] - current[:, :3] / current[:, 3:4], axis=1)
+        rounding = max(1e-12, 32 * np.finfo(self.calc.vector_dtype).eps)
+        stable = eligible & (self.margin[old] > turn + np.max(turn[eligible], initial=0.0) + 2 * rounding)
+        kept[old[stable]] = True
+        fresh[n[stable]] = False
+        # Contacts of the turned vectors with the vectors added this frame, binned with the stored rows.
+        # A failing vector is added again, so its current row is checked against the others in turn
+        turned = np.flatnonzero(stable & (turn > 0))
+        pending = np.flatnonzero(fresh)
+        edges = self.calc.cos_bin_edges
+        while len(turned) and len(pending):
+            turned_unit = self.unit_vectors(stored[turned])
+            failed = np.zeros(len(turned), dtype=bool)
+            step = max(1, self.max_pairs // len(turned))
+            for start in range(0, len(pending), step):
+                cos = self.unit_vectors(new_rows[pending[start:start + step]]) @ turned_unit.T
+                margin = np.full(cos.size, np.inf)
+                u.lower_bin_margins(margin, cos.ravel(), u.cos_bin_index(cos, edges).ravel(), *self.bin_bounds)
+                failed |= np.any(margin.reshape(cos.shape) <= turn[turned] + 2 * rounding, axis=0)
+            kept[old[turned[failed]]] = False
+            fresh[n[turned[failed]]] = True
+            pending = n[turned[failed]]
+            turned = turned[~failed]
+        turns[old[kept[old]]] = turn[kept[old]]
+        return kept, fresh, turns
+
+    def update(self, atoms):
+        """
+        Moves the volumes to a new frame
+        :param atoms: (N, 4) atoms of the frame
+        :return:
+        """
+        atoms = np.asarray(atoms, dtype=float)
+        if self.atoms is None or atoms.shape != self.atoms.shape or np.any(atoms[:, 3] != self.atoms[:, 3]):
+            # First frame (or different atoms): start from empty volumes
+            self.reset()
+            self.atoms = atoms.copy()
+            moved = np.ones(len(atoms), dtype=bool)
+            self.in_subject = np.zeros(len(atoms), dtype=bool)
+            self.in_extended = np.zeros(len(atoms), dtype=bool)
+        else:
+            moved = np.sqrt(np.sum((atoms[:, :3] - self.atoms[:, :3]) ** 2, axis=1)) > self.tolerance
+            self.atoms[moved] = atoms[moved]
+        subject, extended = self.select_atoms(self.atoms)
+        in_subject = np.zeros(len(atoms), dtype=bool)
+        in_subject[subject] = True
+        in_extended = np.zeros(len(atoms), dtype=bool)
+        in_extended[extended] = True
+        changed = moved | (in_subject != self.in_subject) | (in_extended != self.in_extended)
+        self.in_subject, self.in_extended = in_subject, in_extended
+        self.moved_atoms = int(np.count_nonzero(changed))
+
+        # Vectors touching a changed atom, and vectors kept with a turn in earlier frames (their contacts
+        # with this frame's new vectors are checked again), except those whose contacts stay in the same bins
+        candidates = changed[self.atom_i] | changed[self.atom_j]
+        new_rows, new_i, new_j = self.pair_rows(self.atoms, subject, extended, changed)
+        drifted = ~candidates & (self.turn > 0)
+        if np.any(drifted):
+            drifted_rows = self.vector_rows(self.atoms, self.atom_i[drifted], self.atom_j[drifted])
+            new_rows = np.concatenate((new_rows, drifted_rows))
+            new_i = np.concatenate((new_i, self.atom_i[drifted]))
+            new_j = np.concatenate((new_j, self.atom_j[drifted]))
+            candidates |= drifted
+        kept, fresh, turns = self.bin_stable(candidates, new_rows, new_i, new_j)
+        new_rows, new_i, new_j = new_rows[fresh], new_i[fresh], new_j[fresh]
+        self.kept_vectors = int(np.count_nonzero(kept))
+        stale = candidates & ~kept
+        if len(self.rows) and np.count_nonzero(stale) > self.rebuild_fraction * len(self.rows):
+            # Build the frame from scratch: every vector is new, nothing to subtract
+            current = self.atoms, self.in_subject, self.in_extended
+            self.reset()
+            self.atoms, self.in_subject, self.in_extended = current
+            new_rows, new_i, new_j = self.pair_rows(self.atoms, subject, extended, np.ones(len(atoms), dtype=bool))
+            stale = np.zeros(0, dtype=bool)
+            turns = np.zeros(0)
+            self.kept_vectors = 0
+            self.rebuilds += 1
+        # Remove the contacts of the other vectors touching a changed atom
+        parity = pair_parity(self.atom_i, self.atom_j)
+        if np.any(stale):
+            old = self.table.subset(stale)
+            static = self.table.subset(~stale)
+            self.add_reference_contacts(old, self.rows[stale], parity[stale], self.table, self.rows, -1)
+            self.add_partner_contacts(static, self.rows[~stale], parity[~stale], old, self.rows[stale], -1)
+        # Add the contacts of their replacements
+        self.updated_vectors = int(np.count_nonzero(stale)) + len(new_rows)
+        static_rows = self.rows[~stale]
+        static_parity = parity[~stale]
+        self.rows = np.concatenate((static_rows, new_rows))
+        self.atom_i = np.concatenate((self.atom_i[~stale], new_i))
+        self.atom_j = np.concatenate((self.atom_j[~stale], new_j))
+        self.margin = np.concatenate((self.margin[~stale], np.full(len(new_rows), np.inf)))
+        self.turn = np.concatenate((turns[~stale], np.zeros(len(new_rows))))
+        self.table = self.build_table(self.rows, self.atom_i)
+        if len(new_rows):
+            new = self.build_table(new_rows, new_i)
+            static = self.table.subset(np.arange(len(static_rows)))
+            static_i, static_j = self.atom_i[:len(static_rows)], self.atom_j[:len(static_rows)]
+            self.add_reference_contacts(new, new_rows, pair_parity(new_i, new_j), self.table, self.rows, 1,
+                                        margin=self.margin[len(static_rows):],
+                                        reverse=self.reverse_index(new_i, new_j, new_rows, self.atom_i, self.atom_j,
+                                                                   self.rows))
+            self.add_partner_contacts(static, static_rows, static_parity, new, new_rows, 1,
+                                      margin=self.margin[:len(static_rows)],
+                                      reverse=self.reverse_index(new_i, new_j, new_rows, static_i, static_j,
+                                                                 static_rows))
+        print(f'<IncrementalTheta.update> {self.moved_atoms} of {len(atoms)} atoms changed, '
+              f'{self.updated_vectors} vectors updated, {self.kept_vectors} kept their bins, '
+              f'{len(self.rows)} vectors')
+
+    def recompute(self):
+        """
+        Theta of the current frame from scratch (new pair table and full four-body sum)
+        :return: IncrementalTheta holding only the current frame
+        """
+        full = IncrementalTheta(self.calc, tolerance=0.0, max_pairs=self.max_pairs)
+        full.update(self.atoms)
+        return full
+
+    def verify(self):
+        """
+        Checks the incrementally updated volumes against a full recompute of the current frame
+        :return: True, raises RuntimeError if they differ
+        """
+        full = self.recompute()
+        for name in ('theta', 'odds', 'evens'):
+            if not np.array_equal(getattr(self, name), getattr(full, name)):
+                difference = np.max(np.abs(getattr(self, name) - getattr(full, name)))
+                raise RuntimeError(f'<IncrementalTheta.verify> {name} differs from the full recompute by '
+                                   f'up to {difference}')
+        if self.total_contribs != full.total_contribs:
+            raise RuntimeError(f'<IncrementalTheta.verify> {self.total_contribs} contacts, '
+                               f'full recompute {full.total_contribs}')
+        print(f'<IncrementalTheta.verify> Incremental volumes equal the full recompute')
+        return True
+
+    def save(self):
+        """
+        Writes the volumes and logs of the current frame through the calculator (under its tag)
+        :return:
+        """
+        calc = self.calc
+        calc.rolling_Theta_odds, calc.rolling_Theta_evens = self.odds, self.evens
+        calc.total_contribs = self.total_contribs
+        calc.interatomic_vectors = calc.reference_vectors = self.table
+        calc.subject_atoms = self.atoms[self.in_subject]
+        calc.extended_atoms = self.atoms[self.in_extended]
+        calc.converged_loop = len(self.table)
+        calc.write_all_params_to_file()
+        calc.setup_writer()
+        calc.save_theta()
+        calc.write_calculation_summary()
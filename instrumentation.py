@@ -0,0 +1,154 @@
+"""
+Instrumentation for the model PADF calculator
+
+Stages of a calculation and its progress are reported as events (plain dicts)
+to an instrument. Instruments can print them, write them as JSON lines, or pass
+them to a callback. NullInstrument discards everything and costs next to nothing.
+
+@author: andrewmartin, jack-binns
+"""
+import contextlib
+import json
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def memory_high_water():
+    """
+    Peak memory of the process in bytes (or the tracemalloc peak if tracing), None if unknown
+    """
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kB on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class NullInstrument:
+    """
+    Discards all events. Also the base class for the other instruments, which override handle()
+    """
+    enabled = False
+
+    def emit(self, event, **fields):
+        if self.enabled:
+            record = {'time': time.time(), 'event': event}
+            record.update(fields)
+            self.handle(record)
+
+    def handle(self, record):
+        pass
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        Times a stage of the calculation. The yielded dict can be filled with
+        counters (contacts, bins_touched, ...) that are reported with the stage
+        """
+        info = dict(fields)
+        if not self.enabled:
+            yield info
+            return
+        start = time.perf_counter()
+        yield info
+        self.emit('stage', stage=name, wall_time_s=time.perf_counter() - start,
+                  memory_high_water_bytes=memory_high_water(), **info)
+
+    def close(self):
+        pass
+
+
+class ConsoleInstrument(NullInstrument):
+    """
+    Prints stage summaries, and progress at most once every progress_interval seconds
+    """
+    enabled = True
+
+    def __init__(self, progress_interval=10.0):
+        self.progress_interval = progress_interval
+        self.last_progress = 0.0
+
+    def handle(self, record):
+        if record['event'] == 'progress':
+            if record['time'] - self.last_progress < self.progress_interval:
+                return
+            self.last_progress = record['time']
+            line = f"| {record['k']} / {record['n']} |"
+            if record.get('similarity') is not None:
+                line += f" Odd/even cosine similarity == {record['similarity']}"
+            if record.get('error') is not None:
+                line += f" Estimated relative error == {record['error']}"
+            eta = record.get('eta_s')
+            if eta is not None:
+                line += f" Estimate {round(eta / 3600, 3)} hr remaining" if eta > 3600 \
+                    else f" Estimate {round(eta, 3)} s remaining"
+            print(line)
+        elif record['event'] == 'stage':
+            fields = ', '.join(f'{key} = {value}' for key, value in record.items()
+                               if key not in ('time', 'event', 'stage', 'tag'))
+            print(f"<{record.get('tag', '')}:{record['stage']}> {fields}")
+        else:
+            print(f"<{record['event']}> {record}")
+
+
+class JsonLinesInstrument(NullInstrument):
+    """
+    Appends every event to a file as one JSON object per line
+    """
+    enabled = True
+
+    def __init__(self, path, progress_interval=0.0):
+        self.path = path
+        self.progress_interval = progress_interval
+        self.last_progress = 0.0
+        self.file = open(path, 'a')
+
+    def handle(self, record):
+        if record['event'] == 'progress':
+            if record['time'] - self.last_progress < self.progress_interval:
+                return
+            self.last_progress = record['time']
+        self.file.write(json.dumps(record, default=float) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CallbackInstrument(NullInstrument):
+    """
+    Passes every event to callback(record)
+    """
+    enabled = True
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def handle(self, record):
+        self.callback(record)
+
+
+class MultiInstrument(NullInstrument):
+    """
+    Sends every event to several instruments
+    """
+    enabled = True
+
+    def __init__(self, *instruments):
+        self.instruments = [ins for ins in instruments if ins.enabled]
+
+    def handle(self, record):
+        for ins in self.instruments:
+            ins.handle(record)
+
+    def close(self):
+        for ins in self.instruments:
+            ins.close()
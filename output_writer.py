@@ -0,0 +1,133 @@
+"""
+Output writers for the model PADF calculator
+
+The calculator hands every file it writes (np.save, np.savetxt, xyz dumps, container writes)
+to a writer as a function and its arguments. SyncWriter calls it straight away. BackgroundWriter
+takes a snapshot of the array arguments and writes them in a background thread while the
+calculation carries on, holding at most max_pending_bytes of snapshots at a time. Writes run one
+at a time in the order they were submitted, so writes into the same container stay in order.
+A failed write is raised again by the next submit() or by flush().
+
+@author: andrewmartin, jack-binns
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class SyncWriter:
+    """
+    Writes immediately in the calling thread
+    """
+
+    def submit(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def snapshot(value):
+    """
+    Copy of the arrays in value (an array, or a list, tuple or dict of them), other values as they are
+    """
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, dict):
+        return {key: snapshot(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(item) for item in value)
+    return value
+
+
+def snapshot_bytes(value):
+    """
+    Bytes of the arrays and numbers in value (numbers in lists count 8 bytes each, as in an array)
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(snapshot_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(snapshot_bytes(item) for item in value)
+    if isinstance(value, (int, float, complex, np.number)) and not isinstance(value, bool):
+        return 8
+    return 0
+
+
+class BackgroundWriter(SyncWriter):
+    """
+    Writes snapshots in a background thread. submit() blocks while the pending snapshots would
+    exceed max_pending_bytes (a single larger write is still let through on its own)
+    """
+
+    def __init__(self, max_pending_bytes=1 << 30):
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self.pending_writes = 0
+        self.written = 0
+        self.error = None
+        self.condition = threading.Condition()
+        self.executor = None
+
+    def submit(self, func, *args, **kwargs):
+        self.raise_error()
+        size = snapshot_bytes(args) + snapshot_bytes(kwargs)
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending_writes == 0
+                                    or self.pending_bytes + size <= self.max_pending_bytes)
+            self.pending_bytes += size
+            self.pending_writes += 1
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mpadf_writer')
+        self.executor.submit(self.write, func, snapshot(args), snapshot(kwargs), size)
+
+    def write(self, func, args, kwargs, size):
+        try:
+            func(*args, **kwargs)
+        except BaseException as e:
+            with self.condition:
+                if self.error is None:
+                    self.error = e
+        finally:
+            with self.condition:
+                self.pending_bytes -= size
+                self.pending_writes -= 1
+                self.written += 1
+                self.condition.notify_all()
+
+    def raise_error(self):
+        """
+        Raises the first failed write since the last call
+        """
+        with self.condition:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def flush(self):
+        """
+        Waits for all submitted writes, then raises the first that failed
+        :return:
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending_writes == 0)
+        self.raise_error()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
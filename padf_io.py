@@ -0,0 +1,149 @@
+"""
+Chunked, compressed HDF5 containers for model PADF output
+
+A run container ({tag}_mPADF.h5) holds the total/odds/evens Theta volumes, the partials,
+the pair distances and PDF, the convergence logs, and the parameters and run metadata as
+attributes. A trajectory container stacks the frames of an MD run along a first axis
+and keeps their running sums. Volumes are chunked in (r, r', theta) blocks, so slices can
+be read without loading the whole cube. Needs h5py (pip install h5py).
+
+@author: andrewmartin, jack-binns
+"""
+import time
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def require_h5py():
+    if h5py is None:
+        raise ImportError("<padf_io> HDF5 output needs h5py (pip install h5py)")
+
+
+def chunk_shape(shape):
+    """
+    Chunks of at most 16 x 16 radial bins by 64 angular bins (one frame at a time for stacks)
+    """
+    if len(shape) == 3:
+        return min(shape[0], 16), min(shape[1], 16), min(shape[2], 64)
+    if len(shape) == 4:
+        return (1,) + chunk_shape(shape[1:])
+    return True
+
+
+def attr_value(value):
+    """
+    Value as an HDF5 attribute: numbers, strings and bools as they are, anything else as its string
+    """
+    if value is None:
+        return 'None'
+    if isinstance(value, (bool, int, float, str, np.number, np.bool_)):
+        return value
+    return str(value)
+
+
+def scalar_parameters(parameters):
+    """
+    The scalar and string entries of a parameter dict (e.g. a calculator's __dict__), skipping arrays and objects
+    """
+    return {key: attr_value(value) for key, value in parameters.items()
+            if value is None or isinstance(value, (bool, int, float, str, tuple, type, np.number, np.bool_))}
+
+
+def write_datasets(path, datasets, attrs=None, group='/', mode='a', compression='gzip', compression_level=4):
+    """
+    Writes (or replaces) datasets and attributes in a container
+    :param path: container path
+    :param datasets: dict of name : array
+    :param attrs: dict of attributes of the group
+    :param group: group to write into
+    :param mode: 'w' starts a new container, 'a' adds to an existing one
+    :param compression: h5py compression filter ('gzip', 'lzf' or None)
+    :param compression_level: gzip level
+    :return:
+    """
+    require_h5py()
+    with h5py.File(path, mode) as f:
+        g = f.require_group(group)
+        for name, data in datasets.items():
+            data = np.asarray(data)
+            if name in g:
+                del g[name]
+            if data.ndim == 0 or data.size < 1024:
+                g.create_dataset(name, data=data)
+            else:
+                g.create_dataset(name, data=data, chunks=chunk_shape(data.shape), compression=compression,
+                                 compression_opts=compression_level if compression == 'gzip' else None,
+                                 shuffle=compression is not None)
+        for key, value in (attrs or {}).items():
+            g.attrs[key] = attr_value(value)
+
+
+def read_theta(path, name='total', r1=slice(None), r2=slice(None), th=slice(None), frame=None):
+    """
+    Reads a slice of a Theta volume, only loading the chunks it touches
+    :param name: 'total', 'odds', 'evens', 'variance' or e.g. 'partials/3'
+    :param r1, r2, th: index or slice along each axis
+    :param frame: frame index in a trajectory container (reads frames/{name}), None for the volume itself
+    :return: array
+    """
+    require_h5py()
+    with h5py.File(path, 'r') as f:
+        if frame is None:
+            return f[name][r1, r2, th]
+        return f[f'frames/{name}'][frame, r1, r2, th]
+
+
+def read_parameters(path):
+    """
+    Attributes of the container root (parameters and run metadata)
+    """
+    require_h5py()
+    with h5py.File(path, 'r') as f:
+        return dict(f.attrs)
+
+
+def append_trajectory_frame(path, frame_name, arrays, attrs=None, compression='gzip', compression_level=4):
+    """
+    Appends one frame to a trajectory container and adds it to the running sums. Frames
+    already in the container are skipped, so consolidation can be rerun as frames finish
+    :param frame_name: unique name of the frame (e.g. its tag)
+    :param arrays: dict of name : (nr, nr, nth) array, e.g. total/odds/evens
+    :param attrs: attributes to set on the container root
+    :return: True if the frame was appended
+    """
+    require_h5py()
+    with h5py.File(path, 'a') as f:
+        if 'frame_names' not in f:
+            f.create_dataset('frame_names', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+            f.attrs['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        names = f['frame_names']
+        if frame_name in [n.decode() if isinstance(n, bytes) else n for n in names[:]]:
+            return False
+        n_frames = len(names)
+        for name, data in arrays.items():
+            data = np.asarray(data)
+            key = f'frames/{name}'
+            if key not in f:
+                f.create_dataset(key, shape=(0,) + data.shape, maxshape=(None,) + data.shape, dtype=data.dtype,
+                                 chunks=chunk_shape((1,) + data.shape), compression=compression,
+                                 compression_opts=compression_level if compression == 'gzip' else None,
+                                 shuffle=compression is not None)
+                f.create_dataset(name, data=np.zeros_like(data), chunks=chunk_shape(data.shape),
+                                 compression=compression,
+                                 compression_opts=compression_level if compression == 'gzip' else None,
+                                 shuffle=compression is not None)
+            f[key].resize(n_frames + 1, axis=0)
+            f[key][n_frames] = data
+            f[name][...] = f[name][...] + data
+        names.resize(n_frames + 1, axis=0)
+        names[n_frames] = frame_name
+        for key, value in (attrs or {}).items():
+            f.attrs[key] = attr_value(value)
+        f.attrs['n_frames'] = n_frames + 1
+    return True
+
@@ -0,0 +1,64 @@
+"""
+Batch Model PADF Runner
+
+Runs a sweep of model PADF calculations from a job spec. Setup, pairing and trimming
+are shared between the jobs that have the same parameters up to that stage.
+
+@author: andrewmartin, jack-binns
+"""
+import batch_runner as br
+
+if __name__ == '__main__':
+    '''
+    The job spec can also be kept in a TOML or JSON file (see batch_runner.py) and run with
+        python batch_runner.py jobs.toml [workers]
+    'calculator' holds any ModelPadfCalculator attributes shared by all jobs, as in
+    run_mPADF_dlc_kphase.py. Dtypes are given by name, e.g. 'vector_dtype': 'float64'
+    '''
+    spec = {'calculator': {
+        'root': "C:\\rmit\\dlc\\model_padf\\",
+        'project': "k_phase_20ang_fast\\",
+        'tag': "dlc_k_disk",
+        'supercell_atoms': "dlc_k_disc_sc6136.xyz",
+        'subject_atoms': "dlc_k_disc.xyz",
+        'rmax': 20.0,
+        'nr': 128,
+        'nth': 180,
+        'r_power': 2,
+        'convergence_check_flag': True,
+        'convergence_target': 0.5,
+        'sampling': 'stratified',
+        'seed': 888,
+        'mode': 'stm',
+    }}
+
+    '''
+    Sweep.
+    One job per combination of the listed values, tagged e.g.
+    dlc_k_disk_nth90_convergence_target0.9. Jobs that only differ in nth,
+    convergence_target, sampling, seed etc. share one pair table.
+    '''
+    spec['sweep'] = {'nth': [90, 180], 'convergence_target': [0.5, 0.9]}
+
+    '''
+    Explicit jobs.
+    Each entry overrides 'calculator' and is crossed with the sweep. Give each its own tag, e.g.
+        spec['jobs'] = [{'tag': 'dlc_k_r10', 'rmax': 10.0, 'nr': 64}, {'tag': 'dlc_k_r20'}]
+    MD frames.
+    spec['frames'] = {'glob': '192DLC_frame_*_sc.xyz'} (or 'files': [...], in root + project)
+    runs every job on each frame ({tag}_{k}, used as subject and supercell) and sums the
+    frames into {tag}_trajectory_mPADF_*_sum.npy
+    '''
+
+    #
+    # worker processes for independent tasks, 1 runs everything in this process
+    #
+    spec['batch'] = {'workers': 2}
+
+    #
+    # Finished jobs are logged here and skipped when the batch is run again
+    #
+    log_path = spec['calculator']['root'] + spec['calculator']['project'] + spec['calculator']['tag'] + '_batch_log.json'
+
+    runner = br.BatchRunner(spec, log_path=log_path)
+    runner.run()
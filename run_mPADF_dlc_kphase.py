@@ -7,6 +7,7 @@ import numpy as np
 
 import parallel_model_padf_0p94 as pmp
 import fast_model_padf as fmp
+import output_writer as ow
 
 # import multiprocessing as mp
 
@@ -61,6 +62,18 @@ if __name__ == '__main__':
         # number of angular bins in the final PADF function
         modelp.nth = 180
 
+        '''
+        Probe sweep.
+        Instead of a run per probe radius, run once at the largest radius and list the
+        smaller ones in probe_radii. Each gets its own Theta cut out of this run
+        ({tag}_rmax{probe}_mPADF_*_sum.npy) and its own contact count in the calculation
+        log. The radii must be multiples of the bin width rmax / nr, e.g.
+            modelp.rmax = 24.5
+            modelp.nr = 49
+            modelp.probe_radii = np.arange(2.5, 24.5, 2.0)
+        '''
+        modelp.probe_radii = []
+
         # Scale the radial correlations by this power, i.e. r^(r_power)
         modelp.r_power = 2
 
@@ -73,6 +86,49 @@ if __name__ == '__main__':
         modelp.convergence_check_flag = True
         modelp.convergence_target = 0.5
 
+        '''
+        Sampling of the reference vectors.
+        'uniform' :     random shuffle
+        'stratified' :  interleave |r| bins and species pairs so early
+                        iterations cover the whole volume
+        error_bound :   stop once the estimated relative error of Theta
+                        falls below this value (0 disables)
+        seed :          fixes the order for reproducible runs
+        '''
+        modelp.sampling = 'stratified'
+        modelp.error_bound = 0.0
+        modelp.seed = 888
+
+        '''
+        Accumulation mode.
+        'vector' :  bins one reference vector at a time
+        'tiled' :   bins blocks of tile_references reference vectors against blocks
+                    of tile_partners partners, faster for large nr. Convergence is
+                    checked once per block of reference vectors
+        '''
+        modelp.accumulation = 'vector'
+        modelp.tile_references = 64
+        modelp.tile_partners = 8192
+
+        '''
+        Output format.
+        'npy' :     .npy volumes and text logs
+        'hdf5' :    one chunked, compressed {tag}_mPADF.h5 container per run
+                    holding the volumes, partials, PDF, logs and parameters.
+                    Slices can be read with padf_io.read_theta (needs h5py)
+        '''
+        modelp.output_format = 'npy'
+
+        '''
+        Output writer.
+        ow.SyncWriter() writes each file as soon as it is produced. ow.BackgroundWriter() takes
+        a snapshot and writes it in a background thread while the calculation
+        continues, keeping at most max_pending_bytes of snapshots queued (1 GB by
+        default). The run waits for the writes at the end, and a failed write is
+        raised there (or at the next write).
+        '''
+        modelp.writer = ow.SyncWriter()
+
         '''
         Calculation mode.
         'rrprime' :     Calculate the r = r' slice
@@ -81,11 +137,32 @@ if __name__ == '__main__':
         'rrtheta' :     Calculate slices through Theta(r,r',theta)
                         slice frequency given by probe_theta_bin
         'stm'     :     Calculate Theta(r,r',theta) and send directly to a 
-                        numpy matrix (Straight-To-Matrix). Can't be rebinned
-                        at a later date
+                        numpy matrix (Straight-To-Matrix). Run it once on a fine
+                        grid and rebin: coarser grids are sums of the fine volume
+                        for any nr, nth that divide the fine ones by an odd factor
+                        (rmax stays the same). Only odd factors line the coarse bin
+                        edges up with fine ones, so pick the fine grid as an odd
+                        multiple of the grids wanted, e.g. nr = 384 for 128 and nth =
+                        180 for 60 or 36. A power of two such as nr = 128 has no
+                        odd divisor, so it cannot be rebinned in r. List them in
+                        rebin_grids to write {tag}_nr{nr}_nth{nth}_mPADF_*_sum.npy with
+                        this run, or later
+                            u.rebin_theta(np.load(<..._mPADF_total_sum.npy>, mmap_mode='r'), nr, nth)
         '''
         # modelp.mode = 'rrprime'
         modelp.mode = 'stm'
+        modelp.rebin_grids = []  # (nr, nth) pairs, odd divisors: e.g. [(128, 60), (128, 36)] with nr = 384, nth = 180
+
+        '''
+        Species-resolved (partial) PADFs.
+        Set partials_flag to True to accumulate one Theta volume per
+        combination of species pairs (e.g. C-C|C-O) in the same pass.
+        partial_storage :   'dense' or 'sparse' (only combinations that are hit)
+        partial_dtype :     np.float32 halves the memory of the partials
+        '''
+        modelp.partials_flag = False
+        modelp.partial_storage = 'sparse'
+        modelp.partial_dtype = np.float64
 
         #
         # save parameters to file
@@ -104,6 +181,12 @@ if __name__ == '__main__':
         # will be extended to logging output in the future
         modelp.verbosity = 0
 
+        #
+        # Stage timings and progress events. None prints them to the console,
+        # ins.JsonLinesInstrument('run_events.jsonl') writes them as JSON lines,
+        # ins.CallbackInstrument(f) passes them to f and ins.NullInstrument() drops them
+        modelp.instrument = None
+
         #
         # Run the calculation!
         #
@@ -7,6 +7,7 @@ import numpy as np
 
 import parallel_model_padf_0p94 as pmp
 import fast_model_padf as fmp
+import output_writer as ow
 
 # import multiprocessing as mp
 
@@ -50,6 +51,24 @@ if __name__ == '__main__':
         #
         modelp.subject_atoms = "three_row.xyz"  # the cif containing the asymmetric unit
 
+        '''
+        Periodic mode.
+        Set periodic_flag to True to give supercell_atoms as a single unit cell
+        (an xyz plus lattice_vectors, or a cif) instead of an expanded supercell.
+        Only the lattice translations reaching rmax are generated.
+        '''
+        modelp.periodic_flag = False
+        modelp.lattice_vectors = None  # e.g. np.diag([a, a, a]) for a cubic cell
+
+        '''
+        Symmetry reduction.
+        None :          every subject atom supplies reference vectors
+        'cif' :         subject_atoms is a cif, the full cell is used and only one
+                        atom per asymmetric unit site is computed, weighted by its multiplicity
+        'fingerprint' : subject atoms with matching environments are computed once
+        '''
+        modelp.symmetry_mode = None
+
         # probe radius: defines the neighbourhood around each atom to correlate
         modelp.rmax = probe
 
@@ -71,9 +90,56 @@ if __name__ == '__main__':
         modelp.convergence_check_flag = True
         modelp.convergence_target = 1e-8
 
+        '''
+        Sampling of the reference vectors.
+        'uniform' :     random shuffle
+        'stratified' :  interleave |r| bins and species pairs so early
+                        iterations cover the whole volume
+        error_bound :   stop once the estimated relative error of Theta
+                        falls below this value (0 disables)
+        seed :          fixes the order for reproducible runs
+        '''
+        modelp.sampling = 'stratified'
+        modelp.error_bound = 0.0
+        modelp.seed = 888
+
+        '''
+        Accumulation mode.
+        'vector' :  bins one reference vector at a time
+        'tiled' :   bins blocks of tile_references reference vectors against blocks
+                    of tile_partners partners, faster for large nr. Convergence is
+                    checked once per block of reference vectors
+        '''
+        modelp.accumulation = 'vector'
+        modelp.tile_references = 64
+        modelp.tile_partners = 8192
+
+        '''
+        Output format.
+        'npy' :     .npy volumes and text logs
+        'hdf5' :    one chunked, compressed {tag}_mPADF.h5 container per run
+                    holding the volumes, partials, PDF, logs and parameters.
+                    Slices can be read with padf_io.read_theta (needs h5py)
+        '''
+        modelp.output_format = 'npy'
+        # ow.SyncWriter() writes the output straight away, ow.BackgroundWriter() writes it in a
+        # background thread while the calculation continues
+        modelp.writer = ow.SyncWriter()
+
         # Calculates full PADF vol
         modelp.mode = 'stm'
 
+        '''
+        Species-resolved (partial) PADFs.
+        Set partials_flag to True to accumulate one Theta volume per
+        combination of species pairs (e.g. C-C|C-O) in the same pass.
+        partial_storage :   'dense' or 'sparse' (only combinations that are hit)
+        partial_dtype :     np.float32 halves the memory of the partials
+        '''
+        modelp.partials_flag = False
+        modelp.partial_storage = 'sparse'
+        modelp.partial_dtype = np.float64
+
         #
         # save parameters to file
         #
@@ -91,6 +157,12 @@ if __name__ == '__main__':
         # will be extended to logging output in the future
         modelp.verbosity = 0
 
+        #
+        # Stage timings and progress events. None prints them to the console,
+        # ins.JsonLinesInstrument('run_events.jsonl') writes them as JSON lines,
+        # ins.CallbackInstrument(f) passes them to f and ins.NullInstrument() drops them
+        modelp.instrument = None
+
         #
         # Run the calculation!
         #
@@ -33,7 +33,47 @@ if __name__ == '__main__':
     cont.convergence_target = 0.9
     cont.com_cluster_flag = True
     cont.com_radius = 10.0
+    '''
+    Several clusters per frame: each centre gives an independent sample ({tag}_{k}_c{j}) from
+    one read of the frame, e.g. centres on a grid spaced 2 * com_radius, 2 * rmax inside the box
+        import utils
+        cont.cluster_centres = utils.cluster_centre_grid(utils.read_xyz(<first frame>),
+                                                         2 * cont.com_radius, 2 * cont.rmax)
+    '''
+    cont.cluster_centres = None
+    # 'hdf5' writes a container per frame, consolidate_md_results then appends the
+    # frames to {tag}_trajectory_mPADF.h5
+    cont.output_format = 'npy'
+    # output_writer.BackgroundWriter() writes the output of each frame while the next frame is
+    # calculated. The run (and consolidate_md_results) waits for the writes and raises a failed write
+    cont.writer = None
 
     # Generate the file paths
     cont.generate_calculation_plan()
+
+    '''
+    Distributed runs on nodes sharing the filesystem:
+    cont.write_job_manifest(shards_per_frame=4) writes {tag}_jobs/manifest.json,
+    start any number of workers with
+        python controller.py worker <manifest> [stale lock timeout in s]
+    check progress with
+        python controller.py status <manifest>
+    then merge the shards with cont.reduce_distributed_results(<manifest>)
+    (or python controller.py reduce <manifest>) before consolidate_md_results().
+    cont.run_local_workers(4, shards_per_frame=2) does all of this on one machine.
+    '''
+    '''
+    Slowly evolving trajectories: cont.run_incremental_mPADF_calc() runs the frames in order and
+    only recomputes the contacts of vectors whose atoms moved (every vector is a reference vector,
+    convergence_target is not used). incremental_check_interval = n checks the volumes against a
+    full recompute every n frames; incremental_tolerance > 0 ignores smaller displacements.
+    The exact default (0.0) only saves time when few atoms move between frames, or when moves are
+    so small that no contact can change theta bin (about 1e-6 A or less, or rigid translation, and
+    only with cont.vector_dtype = 'float64', float32 rounding leaves too little margin).
+    For thermal jitter, where every atom moves a little, most vectors are stale and the frame is
+    rebuilt from scratch (about the cost of a full calculation, more than half the vectors stale);
+    set a tolerance (e.g. 0.05 A) to make it incremental.
+    '''
+    cont.incremental_tolerance = 0.0
+    cont.incremental_check_interval = 0
     cont.run_serial_mPADF_calc()
@@ -0,0 +1,33 @@
+"""
+Tests of the MD controller
+
+@author: andrewmartin, jack-binns
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import controller
+
+
+def test_consolidate_md_results_sums_only_the_frame_volumes(tmp_path):
+    cont = controller.MPADFController(root=str(tmp_path) + os.sep, project='', tag='md', rmax=5.0, nr=4, nth=6)
+    shape = (cont.nr, cont.nr, cont.nth)
+    for k in range(3):
+        for part in ('total', 'odds', 'evens'):
+            np.save(tmp_path / f'md_{k}_mPADF_{part}_sum.npy', np.full(shape, k + 1.0))
+            # Probe sweep and rebinned volumes of the same frame, which must not be summed
+            np.save(tmp_path / f'md_{k}_rmax2.5_mPADF_{part}_sum.npy', np.full(shape, 100.0))
+            np.save(tmp_path / f'md_{k}_nr4_nth6_mPADF_{part}_sum.npy', np.full(shape, 1000.0))
+    (tmp_path / 'md_0_mPADF_param_log.txt').write_text('nr = 4\n')
+    cont.consolidate_md_results()
+    np.testing.assert_array_equal(np.load(tmp_path / 'md_trajectory_mPADF_total_sum.npy'), np.full(shape, 6.0))
+    np.testing.assert_array_equal(np.load(tmp_path / 'md_trajectory_mPADF_odds_sum.npy'), np.full(shape, 6.0))
+
+    # Rerunning leaves the trajectory sums out as well
+    cont.total_counts = 0
+    cont.consolidate_md_results()
+    np.testing.assert_array_equal(np.load(tmp_path / 'md_trajectory_mPADF_total_sum.npy'), np.full(shape, 6.0))
@@ -0,0 +1,123 @@
+"""
+ModelPadfCalculator accumulation paths against the plain full calculation
+
+@author: andrewmartin, jack-binns
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark_mpadf as b
+import fast_model_padf as fmp
+import instrumentation as ins
+import utils as u
+
+# Fm-3m Cu (the centring translations are the symmetry operations), with an extra H site so the
+# cell has two equivalence classes
+FM3M_CIF = """data_Cu
+_cell_length_a    3.6150(2)
+_cell_length_b    3.6150(2)
+_cell_length_c    3.6150(2)
+_cell_angle_alpha 90
+_cell_angle_beta  90.0
+_cell_angle_gamma 90
+_symmetry_space_group_name_H-M 'F m -3 m'
+loop_
+_symmetry_equiv_pos_site_id
+_symmetry_equiv_pos_as_xyz
+1 'x, y, z'
+2 'x, y+1/2, z+1/2'
+3 'x+1/2, y, z+1/2'
+4 'x+1/2, y+1/2, z'
+loop_
+_atom_site_label
+_atom_site_occupancy
+_atom_site_fract_x
+_atom_site_fract_y
+_atom_site_fract_z
+_atom_site_type_symbol
+Cu1 1.0 0.00000(3) 0.0 0.0 Cu
+H1 1.0 0.1 0.1 0.1 H
+"""
+
+
+def run_calculation(tmp_path, tag, subject, supercell, vector_dtype, periodic=False, symmetry_mode=None,
+                    accumulation='vector'):
+    mpc = fmp.ModelPadfCalculator()
+    mpc.root = str(tmp_path) + os.sep
+    mpc.project = ''
+    mpc.tag = tag
+    mpc.subject_atoms = subject
+    mpc.supercell_atoms = supercell
+    mpc.periodic_flag = periodic
+    mpc.rmax = 5.0
+    mpc.nr = 12
+    mpc.nth = 90
+    mpc.convergence_target = 2.0  # never converges, every reference vector is used
+    mpc.vector_dtype = vector_dtype
+    mpc.symmetry_mode = symmetry_mode
+    mpc.accumulation = accumulation
+    mpc.tile_references = 7
+    mpc.tile_partners = 50
+    mpc.instrument = ins.NullInstrument()
+    mpc.verbosity = 0
+    mpc.run_fast_serial_calculation()
+    return mpc
+
+
+def write_fcc(tmp_path):
+    subject, extended = b.fcc_lattice(3)
+    u.output_reference_xyz(subject, path=str(tmp_path / 'fcc_subject.xyz'))
+    u.output_reference_xyz(extended, path=str(tmp_path / 'fcc_supercell.xyz'))
+    return 'fcc_subject.xyz', 'fcc_supercell.xyz'
+
+
+def assert_same_theta(reduced, full):
+    assert reduced.total_contribs == full.total_contribs
+    np.testing.assert_array_equal(reduced.rolling_Theta, full.rolling_Theta)
+
+
+@pytest.mark.parametrize('vector_dtype', [np.float32, np.float64])
+def test_cif_symmetry_matches_full_cell(tmp_path, vector_dtype):
+    (tmp_path / 'cu.cif').write_text(FM3M_CIF)
+    cell, frac, z, _ = u.read_cif_unit_cell(str(tmp_path / 'cu.cif'))
+    u.output_reference_xyz(np.column_stack((frac @ cell, z)), path=str(tmp_path / 'cell.xyz'))
+    full = run_calculation(tmp_path, 'full', 'cell.xyz', 'cu.cif', vector_dtype, periodic=True)
+    reduced = run_calculation(tmp_path, 'cif', 'cu.cif', 'cu.cif', vector_dtype, periodic=True,
+                              symmetry_mode='cif')
+    assert len(reduced.reference_vectors) < len(full.reference_vectors)
+    assert_same_theta(reduced, full)
+
+
+@pytest.mark.parametrize('vector_dtype', [np.float32, np.float64])
+def test_fingerprint_symmetry_matches_full_calculation(tmp_path, vector_dtype):
+    subject, supercell = write_fcc(tmp_path)
+    full = run_calculation(tmp_path, 'full', subject, supercell, vector_dtype)
+    reduced = run_calculation(tmp_path, 'fingerprint', subject, supercell, vector_dtype,
+                              symmetry_mode='fingerprint')
+    assert len(reduced.reference_vectors) < len(full.reference_vectors)
+    assert_same_theta(reduced, full)
+
+
+@pytest.mark.parametrize('vector_dtype', [np.float32, np.float64])
+def test_tiled_matches_vector_accumulation(tmp_path, vector_dtype):
+    subject, supercell = write_fcc(tmp_path)
+    vector = run_calculation(tmp_path, 'vector', subject, supercell, vector_dtype)
+    tiled = run_calculation(tmp_path, 'tiled', subject, supercell, vector_dtype, accumulation='tiled')
+    assert_same_theta(tiled, vector)
+
+
+@pytest.mark.parametrize('accumulation', ['vector', 'tiled'])
+def test_antiparallel_contacts_go_to_bin_zero(tmp_path, accumulation):
+    # Every pair of vectors in a straight chain is parallel or anti-parallel: all contacts in the first
+    # theta bin (fast_vec_angle gives -1.0 for anti-parallel vectors), none in the 180 degree bin
+    chain = np.column_stack((np.arange(8) * 1.3, np.zeros(8), np.zeros(8), np.full(8, 29.0)))
+    u.output_reference_xyz(chain, path=str(tmp_path / 'chain.xyz'))
+    mpc = run_calculation(tmp_path, accumulation, 'chain.xyz', 'chain.xyz', np.float32, accumulation=accumulation)
+    assert mpc.total_contribs > 0
+    assert np.sum(mpc.rolling_Theta[:, :, 1:]) == 0
+    assert np.sum(mpc.rolling_Theta[:, :, 0]) > 0
@@ -0,0 +1,70 @@
+"""
+IncrementalTheta against a fresh ModelPadfCalculator run on each frame
+
+@author: andrewmartin, jack-binns
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark_mpadf as b
+import fast_model_padf as fmp
+import incremental_theta as it
+import instrumentation as ins
+
+
+def make_calculator(tmp_path, tag, vector_dtype, frame_atoms=None):
+    mpc = fmp.ModelPadfCalculator()
+    mpc.root = str(tmp_path) + os.sep
+    mpc.project = 'proj' + os.sep
+    mpc.tag = tag
+    mpc.rmax = 5.0
+    mpc.nr = 20
+    mpc.nth = 36
+    mpc.com_cluster_flag = True
+    mpc.com_radius = 4.0
+    mpc.convergence_target = 2.0  # never converges, every vector is a reference vector
+    mpc.vector_dtype = vector_dtype
+    mpc.instrument = ins.NullInstrument()
+    mpc.verbosity = 0
+    mpc.frame_atoms = frame_atoms
+    return mpc
+
+
+def trajectory():
+    """
+    Frames of a 120 atom cluster: a few atoms moved (some across the cluster radius), then every atom
+    jittered, by a little and by very little (most vectors keep their bins), then a rigid translation
+    """
+    rng = np.random.default_rng(7)
+    atoms, _ = b.amorphous_cluster(120, rng)
+    frames = [atoms.copy()]
+    for n_moved, scale in ((3, 0.2), (5, 1.0), (len(atoms), 1e-3), (len(atoms), 1e-7)):
+        atoms = atoms.copy()
+        moved = rng.choice(len(atoms), n_moved, replace=False)
+        atoms[moved, :3] += rng.normal(scale=scale, size=(n_moved, 3))
+        frames.append(atoms)
+    atoms = atoms.copy()
+    atoms[:, :3] += [0.3, -0.2, 0.1]
+    frames.append(atoms)
+    return frames
+
+
+@pytest.mark.parametrize('rebuild_fraction', [0.5, 1.0])
+@pytest.mark.parametrize('vector_dtype', [np.float32, np.float64])
+def test_incremental_matches_fresh_calculation(tmp_path, vector_dtype, rebuild_fraction):
+    os.makedirs(tmp_path / 'proj')
+    incremental = it.IncrementalTheta(make_calculator(tmp_path, 'incremental', vector_dtype),
+                                      rebuild_fraction=rebuild_fraction)
+    for k, atoms in enumerate(trajectory()):
+        incremental.update(atoms)
+        fresh = make_calculator(tmp_path, f'fresh_{k}', vector_dtype, frame_atoms=atoms)
+        fresh.run_fast_serial_calculation()
+        assert incremental.total_contribs == fresh.total_contribs
+        np.testing.assert_array_equal(incremental.theta, fresh.rolling_Theta)
+    # The jittered frame replaces most vectors: rebuilt from scratch unless rebuilds are disabled
+    assert (incremental.rebuilds > 0) == (rebuild_fraction < 1.0)
@@ -0,0 +1,26 @@
+"""
+Tests of the background output writer
+
+@author: andrewmartin, jack-binns
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import output_writer as ow
+
+
+def test_lists_count_towards_pending_bytes():
+    assert ow.snapshot_bytes([[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]]) == 48
+    assert ow.snapshot_bytes(('path.npy', np.zeros(4), [1.5])) == 40
+
+
+def test_background_writer_output_equals_sync(tmp_path):
+    rows = [[float(i), i * 2.0] for i in range(100)]
+    with ow.BackgroundWriter(max_pending_bytes=64) as writer:
+        writer.submit(np.save, str(tmp_path / 'background.npy'), rows)
+    ow.SyncWriter().submit(np.save, str(tmp_path / 'sync.npy'), rows)
+    np.testing.assert_array_equal(np.load(tmp_path / 'background.npy'), np.load(tmp_path / 'sync.npy'))
@@ -0,0 +1,46 @@
+"""
+Tests of the hdf5 container output
+
+@author: andrewmartin, jack-binns
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark_mpadf as b
+import fast_model_padf as fmp
+import instrumentation as ins
+import padf_io
+
+h5py = pytest.importorskip('h5py')
+
+
+def test_hdf5_run_writes_pdf_and_partials_only_to_the_container(tmp_path):
+    atoms, _ = b.amorphous_cluster(40, np.random.default_rng(3))
+    mpc = fmp.ModelPadfCalculator()
+    mpc.root = str(tmp_path) + os.sep
+    mpc.project = ''
+    mpc.tag = 'run'
+    mpc.rmax = 5.0
+    mpc.nr = 10
+    mpc.nth = 18
+    mpc.convergence_target = 2.0
+    mpc.partials_flag = True
+    mpc.output_format = 'hdf5'
+    mpc.instrument = ins.NullInstrument()
+    mpc.verbosity = 0
+    mpc.frame_atoms = atoms
+    mpc.run_fast_serial_calculation()
+
+    written = os.listdir(tmp_path)
+    for suffix in ('_PDF.txt', '_APDF.txt', '_mPADF_partial_labels.txt', '_atomic_pairs.txt'):
+        assert f'run{suffix}' not in written
+    with h5py.File(mpc.container_path(), 'r') as f:
+        assert f['pairs/pdf'].shape[1] == 2
+        np.testing.assert_array_equal(f['pairs/apdf'][:, 0], f['pairs/pdf'][:, 0])
+        assert 'labels' in f['partials'].attrs
+    np.testing.assert_allclose(padf_io.read_theta(mpc.container_path()), mpc.rolling_Theta)
@@ -0,0 +1,79 @@
+"""
+Tests of the utils readers and binning helpers
+
+@author: andrewmartin, jack-binns
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils as u
+
+CIF_WITHOUT_CELL = """data_test
+loop_
+_atom_site_label
+_atom_site_fract_x
+_atom_site_fract_y
+_atom_site_fract_z
+C1 0.0 0.0 0.0
+O1 0.5 0.25 0.0
+"""
+
+
+def test_cif_without_cell_uses_unit_cell_dimensions(tmp_path):
+    path = tmp_path / 'no_cell.cif'
+    path.write_text(CIF_WITHOUT_CELL)
+    atoms = u.subject_atom_reader(str(path), ucds=[10, 10, 10])
+    np.testing.assert_allclose(atoms, [[0.0, 0.0, 0.0, 6.0], [5.0, 2.5, 0.0, 8.0]], atol=1e-12)
+    with pytest.raises(KeyError):
+        u.subject_atom_reader(str(path))
+
+
+def argmin_theta_bin(a, b, nth):
+    """
+    Theta bin of the angle between a and b as binned before cos_bin_index: acos, then argmin over the yard stick
+    """
+    th_yard_stick = np.arange(0, np.pi, np.radians(180 / nth))
+    return int(np.abs(th_yard_stick - u.fast_vec_angle(*a, *b)).argmin())
+
+
+def cos_theta_bin(a, b, nth):
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    cos = np.array([np.dot(a / np.linalg.norm(a), b / np.linalg.norm(b))])
+    return int(u.cos_bin_index(cos, u.cos_bin_edges(180 / nth, nth))[0])
+
+
+@pytest.mark.parametrize('nth', [36, 90, 180])
+def test_cos_bin_index_matches_argmin_binning(nth):
+    rng = np.random.default_rng(nth)
+    for a, b in rng.normal(size=(5000, 2, 3)):
+        assert cos_theta_bin(a, b, nth) == argmin_theta_bin(a, b, nth)
+    # Bin centres: 0, 60 and 90 degrees
+    for a, b in (((1, 0, 0), (2, 0, 0)), ((1, 0, 0), (1, np.sqrt(3), 0)), ((1, 0, 0), (0, 0, 1))):
+        assert cos_theta_bin(a, b, nth) == argmin_theta_bin(a, b, nth)
+
+
+def test_cos_bin_index_sends_antiparallel_to_bin_zero():
+    edges = u.cos_bin_edges(2.0, 90)
+    # acos(-1) = pi, for which fast_vec_angle returns -1.0 and the argmin gives bin 0
+    for a, b in (((1, 0, 0), (-1, 0, 0)), ((1, 1, 1), (-2, -2, -2)), ((0.1, 0.2, 0.3), (-0.1, -0.2, -0.3))):
+        assert argmin_theta_bin(a, b, 90) == 0
+        assert cos_theta_bin(a, b, 90) == 0
+    # Cosines rounded just past +-1
+    np.testing.assert_array_equal(u.cos_bin_index(np.array([1.0, 1.0 + 1e-15, -1.0, -1.0 - 1e-15]), edges), 0)
+    np.testing.assert_array_equal(u.cos_bin_index(np.array([1.0, -1.0, -1.0 + 1e-7], dtype=np.float32), edges),
+                                  0)
+
+
+def test_cos_bin_index_bins_edge_ties_the_same_in_every_orientation():
+    # 45 degrees is the edge between bins 22 and 23 for 2 degree bins. acos rounds it either way depending
+    # on the orientation, cos_bin_index puts every symmetry image in the lower bin
+    images = [((1, 0, 0), (1, 1, 0)), ((0, 1, 0), (1, 1, 0)), ((-1, 0, 0), (-1, -1, 0)), ((0, 0, 1), (0, 1, 1)),
+              ((0, 0, -1), (0, -1, -1)), ((2, 0, 0), (3, 0, 3))]
+    for a, b in images:
+        assert argmin_theta_bin(a, b, 90) in (22, 23)
+        assert cos_theta_bin(a, b, 90) == 22
@@ -0,0 +1,53 @@
+"""
+Tests of the file-based work queue locks
+
+@author: andrewmartin, jack-binns
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import work_queue as wq
+
+
+def make_old_lock(jobs_dir, job_id, age):
+    assert wq.claim(str(jobs_dir), job_id)
+    lock = wq.marker(str(jobs_dir), job_id, 'lock')
+    os.utime(lock, (time.time() - age, time.time() - age))
+    return lock
+
+
+def test_long_running_job_keeps_its_lock(tmp_path):
+    jobs_dir = str(tmp_path)
+    stolen = []
+
+    def run_job(job):
+        # Another worker tries to take the job well after stale_after has passed since the claim
+        time.sleep(1.0)
+        stolen.append(wq.claim(jobs_dir, job['id'], stale_after=0.4))
+
+    assert wq.run_worker(jobs_dir, [{'id': 'slow'}], run_job, stale_after=0.4) == 1
+    assert stolen == [False]
+    assert wq.job_state(jobs_dir, 'slow') == 'done'
+
+
+def test_stale_lock_is_stolen(tmp_path):
+    make_old_lock(tmp_path, 'dead', 100.0)
+    assert wq.claim(str(tmp_path), 'dead', stale_after=10.0)
+
+
+def test_lock_refreshed_before_the_steal_is_put_back(tmp_path, monkeypatch):
+    lock = make_old_lock(tmp_path, 'busy', 100.0)
+    rename = os.rename
+
+    def touch_then_rename(src, dst):
+        # The owner touches its lock between the stealer's age check and its rename
+        os.utime(src)
+        rename(src, dst)
+
+    monkeypatch.setattr(wq.os, 'rename', touch_then_rename)
+    assert not wq.steal_stale_lock(str(tmp_path), 'busy', 10.0)
+    assert os.path.exists(lock)
+    assert [name for name in os.listdir(tmp_path) if '.stale.' in name] == []
@@ -2,7 +2,10 @@ import numba
 import math as m
 import numpy as np
 import atomic_z as atoms
+import re
+import shlex
 import shutil
+from fractions import Fraction
 from tqdm import tqdm
 from re import split as resplit
 
@@ -47,6 +50,166 @@ def fast_vec_subtraction(x1, x2, x3, y1, y2, y3):
     return [(y1 - x1), (y2 - x2), (y3 - x3)]
 
 
+def species_codes(z_column, species_z):
+    """
+    Compact integer species code for each atom
+    :param z_column: atomic numbers (column 3 of an atom array)
+    :param species_z: sorted array of the unique atomic numbers in the system
+    :return: int array of indices into species_z
+    """
+    return np.searchsorted(species_z, z_column)
+
+
+def pair_code(a, b, n):
+    """
+    Index of the unordered pair (a, b) amongst the n(n+1)/2 combinations of n codes.
+    Works on ints or integer arrays
+    """
+    lo = np.minimum(a, b)
+    hi = np.maximum(a, b)
+    return lo * n - (lo * (lo - 1)) // 2 + (hi - lo)
+
+
+def pair_labels(labels):
+    """
+    Labels for every unordered pair of the given labels, ordered by pair_code
+    """
+    n = len(labels)
+    return [f'{labels[a]}-{labels[b]}' for a in range(n) for b in range(a, n)]
+
+
+def r_bin_edges(r_dist_bin, nr):
+    """
+    Edges between neighbouring radial bins, i.e. the midpoints of the r yard stick
+    (bin centres at r_dist_bin, 2 * r_dist_bin, ...). Ties fall in the lower bin
+    """
+    r_yard_stick = r_dist_bin + np.arange(nr) * r_dist_bin
+    return (r_yard_stick[1:] + r_yard_stick[:-1]) / 2
+
+
+def cos_bin_edges(angular_bin, nth):
+    """
+    Cosines of the edges between neighbouring theta bins (bin centres at 0, angular_bin, ...
+    degrees), in ascending order for binning directly on the cosine
+    """
+    th_yard_stick = np.arange(nth) * m.radians(angular_bin)
+    return np.cos((th_yard_stick[1:] + th_yard_stick[:-1]) / 2)[::-1]
+
+
+def r_bin_index(r, edges, tie_tol=1e-9):
+    """
+    Radial bin of each distance, equivalent to the argmin over the r yard stick. Distances within
+    tie_tol of a bin edge count as on the edge, so symmetry images of a vector land in the same bin
+    whatever the rounding of their components
+    """
+    return np.searchsorted(edges + tie_tol, r, side='left')
+
+
+def rebin_factor(n_fine, n_coarse, name='nr'):
+    """
+    Factor between a fine and a coarse grid. It must be odd, so the edges of the coarse bins
+    (centred on every factor-th fine centre) fall on fine bin edges
+    :return: int factor
+    """
+    factor = n_fine // n_coarse if n_coarse > 0 else 0
+    if factor < 1 or factor * n_coarse != n_fine or factor % 2 == 0:
+        raise ValueError(f'<utils.rebin_factor> {name} = {n_coarse} is not an odd divisor of the fine {name} = {n_fine}, '
+                         f'run the fine grid at an odd multiple such as {name} = {3 * n_coarse}')
+    return factor
+
+
+def rebin_theta(theta, nr, nth):
+    """
+    Sums a Theta volume into a coarser (nr, nr, nth) grid with the same rmax, equal to a calculation
+    run on that grid. The fine volume is read one block of rows at a time, so memory-mapped
+    volumes (np.load(path, mmap_mode='r')) and HDF5 datasets are never loaded whole
+    :param theta: (nr_fine, nr_fine, nth_fine) volume, nr_fine and nth_fine odd multiples of nr and nth
+    :return: (nr, nr, nth) array
+    """
+    nr_fine, _, nth_fine = theta.shape
+    f = rebin_factor(nr_fine, nr, 'nr')
+    g = rebin_factor(nth_fine, nth, 'nth')
+    # Fine radial bin j (centre (j + 1) dr) and theta bin k (centre k dth) in coarse bins round((j + 1) / f) - 1
+    # and round(k / g); the first and last coarse bins are open ended
+    r_index = np.clip(np.rint((np.arange(nr_fine) + 1) / f).astype(int) - 1, 0, nr - 1)
+    th_index = np.clip(np.rint(np.arange(nth_fine) / g).astype(int), 0, nth - 1)
+    r_starts = np.searchsorted(r_index, np.arange(nr + 1))
+    th_starts = np.searchsorted(th_index, np.arange(nth))
+    coarse = np.zeros((nr, nr, nth))
+    for i in range(nr):
+        slab = np.sum(np.asarray(theta[r_starts[i]:r_starts[i + 1]], dtype=np.float64), axis=0)
+        coarse[i] = np.add.reduceat(np.add.reduceat(slab, r_starts[:-1], axis=0), th_starts, axis=1)
+    return coarse
+
+
+def cos_bin_index(cos, edges, antiparallel_tol=None):
+    """
+    Theta bin of each cosine without evaluating acos, equivalent to the argmin over the theta
+    yard stick of fast_vec_angle. Anti-parallel (and out of range) cosines go to bin 0, as
+    fast_vec_angle returns -1.0 for them. Cosines within antiparallel_tol of -1 count as
+    anti-parallel, and cosines within antiparallel_tol of a bin edge count as on the edge, so
+    exactly opposite vectors and angles on a bin edge (e.g. 45 degrees in a cubic cell) do not
+    depend on the rounding of the unit vectors
+    :param cos: cosines of the angles between unit vectors
+    :param edges: ascending edges from cos_bin_edges
+    :param antiparallel_tol: defaults to 1e-12, or a few eps for float32 cosines
+    :return: int array of theta bin indices
+    """
+    if antiparallel_tol is None:
+        antiparallel_tol = max(1e-12, 8 * np.finfo(cos.dtype).eps)
+    index = len(edges) - np.searchsorted(edges - antiparallel_tol, cos, side='right')
+    index[cos <= -1.0 + antiparallel_tol] = 0
+    return index
+
+
+def cos_bin_bounds(edges, dtype=np.float32, antiparallel_tol=None):
+    """
+    Boundaries of the theta bins of cos_bin_index: the cosines in bin b lie in [lower[b], upper[b]),
+    apart from the anti-parallel ones (at most antiparallel) that also go to bin 0
+    :param edges: ascending edges from cos_bin_edges
+    :param dtype: float dtype of the cosines, sets the default antiparallel_tol as in cos_bin_index
+    :return: lower, upper (nth,) arrays and the anti-parallel threshold
+    """
+    if antiparallel_tol is None:
+        antiparallel_tol = max(1e-12, 8 * np.finfo(dtype).eps)
+    bounds = np.concatenate(([-np.inf], edges - antiparallel_tol, [np.inf]))
+    position = len(edges) - np.arange(len(edges) + 1)
+    return bounds[position], bounds[position + 1], -1.0 + antiparallel_tol
+
+
+@numba.njit()
+def bin_margin(cos, index, lower, upper, antiparallel):
+    """
+    Distance of a cosine in theta bin index to the nearest boundary of that bin (cos_bin_bounds),
+    so a cosine that changes by less stays in the same bin
+    """
+    if cos <= antiparallel:
+        return antiparallel - cos
+    return min(cos - lower[index], upper[index] - cos, cos - antiparallel)
+
+
+@numba.njit()
+def min_bin_margin(cos, index, lower, upper, antiparallel, skip=-1):
+    """
+    Smallest bin_margin of the cosines, leaving out cos[skip]
+    """
+    margin = np.inf
+    for n in range(len(cos)):
+        if n != skip:
+            margin = min(margin, bin_margin(cos[n], index[n], lower, upper, antiparallel))
+    return margin
+
+
+@numba.njit()
+def lower_bin_margins(margin, cos, index, lower, upper, antiparallel, skip=-1):
+    """
+    Lowers each margin[n] to the bin_margin of cos[n] (leaving out cos[skip]), in place
+    """
+    for n in range(len(cos)):
+        if n != skip:
+            margin[n] = min(margin[n], bin_margin(cos[n], index[n], lower, upper, antiparallel))
+
+
 def make_interaction_sphere(probe, center, atoms):
     sphere = []
     for tar_1 in atoms:
@@ -56,74 +219,350 @@ def make_interaction_sphere(probe, center, atoms):
     return sphere
 
 
+def radial_distances(atoms, centre):
+    """
+    Distance of every atom from a centre in one array operation
+    :param atoms: (N, >= 3) array of atoms or positions
+    :param centre: (3,) centre
+    :return: (N,) distances
+    """
+    return np.sqrt(np.sum((np.asarray(atoms)[:, :3] - np.asarray(centre)[:3]) ** 2, axis=1))
+
+
+def atoms_near_any(atoms, reference, radius, max_pairs=1 << 20):
+    """
+    Mask of the atoms within radius of at least one reference atom, evaluated in chunks of
+    reference atoms of at most max_pairs atom pairs
+    :return: (N,) bool array
+    """
+    atoms = np.asarray(atoms)[:, :3]
+    reference = np.asarray(reference)[:, :3]
+    keep = np.zeros(len(atoms), dtype=bool)
+    step = max(1, max_pairs // max(len(atoms), 1))
+    for lo in range(0, len(reference), step):
+        diff = atoms[:, None, :] - reference[None, lo:lo + step, :]
+        keep |= np.any(np.sqrt(np.sum(diff ** 2, axis=2)) <= radius, axis=1)
+    return keep
+
+
+def cluster_centre_grid(atoms, spacing, margin):
+    """
+    Cluster centres on a regular grid inside the bounding box of the atoms, at least margin from
+    its faces. With spacing >= 2 * com_radius the clusters do not overlap
+    :return: (k, 3) array of centres
+    """
+    atoms = np.asarray(atoms)[:, :3]
+    lo = atoms.min(axis=0) + margin
+    hi = atoms.max(axis=0) - margin
+    axes = [np.arange(l, h + 1e-9, spacing) if h >= l else np.array([(l + h) / 2]) for l, h in zip(lo, hi)]
+    return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def strip_uncertainty(values):
+    """
+    Vectorised removal of crystallographic uncertainties, e.g. '0.1234(5)' -> 0.1234
+    :param values: sequence of str
+    :return: float array
+    """
+    return np.char.partition(np.asarray(values, dtype=str), '(')[..., 0].astype(float)
+
+
+def cell_matrix(a, b, c, alpha, beta, gamma):
+    """
+    Lattice vectors of a unit cell as rows (a along x, b in the xy plane), so that
+    cartesian = fractional @ cell_matrix
+    :param a, b, c: cell lengths
+    :param alpha, beta, gamma: cell angles in degrees
+    :return: (3, 3) array
+    """
+    ca, cb, cg = np.cos(np.radians([alpha, beta, gamma]))
+    sg = np.sin(np.radians(gamma))
+    cy = (ca - cb * cg) / sg
+    return np.array([[a, 0.0, 0.0],
+                     [b * cg, b * sg, 0.0],
+                     [c * cb, c * cy, c * m.sqrt(1.0 - cb ** 2 - cy ** 2)]])
+
+
+def parse_symop(op):
+    """
+    Converts a symmetry operator such as '-x+1/2, y, z' into a rotation matrix
+    and translation acting on fractional coordinates
+    :return: (3, 3) rotation, (3,) translation
+    """
+    rot = np.zeros((3, 3))
+    trans = np.zeros(3)
+    for i, component in enumerate(op.replace(' ', '').lower().split(',')):
+        for term in re.findall(r'[+-]?[^+-]+', component):
+            sign = -1.0 if term[0] == '-' else 1.0
+            term = term.lstrip('+-')
+            if term[-1] in 'xyz':
+                coeff = term[:-1].rstrip('*')
+                rot[i, 'xyz'.index(term[-1])] = sign * (float(Fraction(coeff)) if coeff else 1.0)
+            else:
+                trans[i] += sign * float(Fraction(term))
+    return rot, trans
+
+
+def read_cif(raw):
+    """
+    Single pass reader for the data items and loops of a CIF
+    :param raw: path to the CIF
+    :return: dict of single-valued tags -> str, dict of loop tags -> list of str
+    """
+    items = {}
+    loops = {}
+    loop_tags = []
+    loop_values = []
+    in_header = False
+    in_text = False
+    with open(raw, 'r') as foo:
+        for line in foo:
+            if line.startswith(';'):
+                in_text = not in_text
+                continue
+            stripped = line.strip()
+            if in_text or not stripped or stripped[0] == '#':
+                continue
+            try:
+                tokens = shlex.split(stripped)
+            except ValueError:
+                tokens = stripped.split()
+            if tokens[0].lower() == 'loop_':
+                loop_tags, loop_values, in_header = [], [], True
+            elif tokens[0][0] == '_':
+                if in_header:
+                    loop_tags.append(tokens[0].lower())
+                    loops[tokens[0].lower()] = []
+                else:
+                    loop_tags = []
+                    if len(tokens) > 1:
+                        items[tokens[0].lower()] = tokens[1]
+            elif loop_tags:
+                in_header = False
+                loop_values.extend(tokens)
+                while len(loop_values) >= len(loop_tags):
+                    for tag, value in zip(loop_tags, loop_values[:len(loop_tags)]):
+                        loops[tag].append(value)
+                    loop_values = loop_values[len(loop_tags):]
+            else:
+                loop_tags, in_header = [], False
+    return items, loops
+
+
+def cif_cell(items, ucds=None):
+    """
+    Cell matrix of a parsed CIF
+    :param items: single-valued tags from read_cif
+    :param ucds: optional unit cell lengths overriding those in the CIF
+    :return: (3, 3) array of lattice vectors as rows
+    """
+    if ucds is not None:
+        lengths = np.asarray(ucds, dtype=float)
+    else:
+        lengths = strip_uncertainty([items['_cell_length_a'], items['_cell_length_b'], items['_cell_length_c']])
+    angles = strip_uncertainty([items.get('_cell_angle_alpha', '90'), items.get('_cell_angle_beta', '90'),
+                                items.get('_cell_angle_gamma', '90')])
+    return cell_matrix(*lengths, *angles)
+
+
+def cif_asymmetric_unit(loops):
+    """
+    Fractional coordinates and atomic numbers of the (non-hydrogen) atom sites of a parsed CIF
+    :param loops: loop tags from read_cif
+    :return: (N, 3) fractional coordinates, (N,) atomic numbers
+    """
+    if '_atom_site_type_symbol' in loops:
+        symbols = loops['_atom_site_type_symbol']
+    else:
+        symbols = loops['_atom_site_label']
+    symbols = [re.match(r'[A-Za-z]+', sym).group(0).capitalize() for sym in symbols]
+    symbols = [sym if get_z(sym) is not None else sym[0] for sym in symbols]
+    frac = np.column_stack([strip_uncertainty(loops[f'_atom_site_fract_{ax}']) for ax in 'xyz'])
+    z = np.array([get_z(sym) for sym in symbols], dtype=float)
+    keep = z != 1
+    return frac[keep], z[keep]
+
+
+def cif_symops(loops):
+    """
+    Rotation matrices and translations of the symmetry operators of a parsed CIF
+    :return: (n_ops, 3, 3), (n_ops, 3)
+    """
+    ops = loops.get('_space_group_symop_operation_xyz', loops.get('_symmetry_equiv_pos_as_xyz', ['x,y,z']))
+    rots, trans = zip(*[parse_symop(op) for op in ops])
+    return np.array(rots), np.array(trans)
+
+
+def cif_unit_cell(frac, z, rots, trans, tol=1e-4):
+    """
+    Applies all symmetry operators to the asymmetric unit and removes the duplicated sites
+    :return: (M, 3) fractional coordinates in [0, 1), (M,) atomic numbers,
+    (M,) index of the asymmetric unit atom each site was generated from
+    """
+    images = np.einsum('oij,nj->oni', rots, frac) + trans[:, None, :]
+    images = (images - np.floor(images)).reshape(-1, 3)
+    asym_index = np.tile(np.arange(len(frac)), len(rots))
+    keys = np.round(images / tol).astype(np.int64) % int(round(1 / tol))
+    _, first = np.unique(keys, axis=0, return_index=True)
+    first = np.sort(first)
+    return images[first], z[asym_index[first]], asym_index[first]
+
+
+def read_cif_unit_cell(raw, ucds=None):
+    """
+    Reads a CIF and generates the full unit cell from its asymmetric unit
+    :param raw: path to the CIF
+    :param ucds: optional unit cell lengths overriding those in the CIF
+    :return: (3, 3) cell matrix, (M, 3) fractional coordinates in [0, 1), (M,) atomic numbers,
+    (M,) index of the asymmetric unit atom each cell atom was generated from
+    """
+    items, loops = read_cif(raw)
+    cell = cif_cell(items, ucds)
+    frac, z = cif_asymmetric_unit(loops)
+    rots, trans = cif_symops(loops)
+    return (cell,) + cif_unit_cell(frac, z, rots, trans)
+
+
+def expand_cif_supercell(raw, rmax, ucds=None, full_cell=False):
+    """
+    Builds the subject set (asymmetric unit) and the extended atom set within rmax of
+    any subject atom directly from a CIF, by vectorised symmetry and lattice
+    translation replication of the asymmetric unit
+    :param raw: path to the CIF
+    :param rmax: probe radius
+    :param ucds: optional unit cell lengths overriding those in the CIF
+    :param full_cell: use every atom of the unit cell as a subject atom rather than the asymmetric unit
+    :return: subject atoms (N, 4), extended atoms (M, 4) as [x, y, z, Z],
+    (N,) index of the asymmetric unit atom each subject atom belongs to
+    """
+    print(f"<utils.expand_cif_supercell> Expanding {raw} to a radius of {rmax}...")
+    # The subject atoms are taken from the cell so the subject and extended sets share identical coordinates
+    cell, cell_frac, cell_z, asym_index = read_cif_unit_cell(raw, ucds)
+    subject_rows = np.arange(len(cell_frac)) if full_cell else np.unique(asym_index, return_index=True)[1]
+    # Fractional half-width of a sphere of radius rmax along each axis
+    extent = rmax * np.linalg.norm(np.linalg.inv(cell), axis=0)
+    lo = np.floor(cell_frac[subject_rows].min(axis=0) - extent).astype(int) - 1
+    hi = np.ceil(cell_frac[subject_rows].max(axis=0) + extent).astype(int)
+    shifts = np.stack(np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(lo, hi)], indexing='ij'), axis=-1)
+    shifts = shifts.reshape(-1, 1, 3)
+    # Put the zero translation first so the subject rows keep their positions
+    shifts = shifts[np.argsort(np.abs(shifts).sum(axis=(1, 2)), kind='stable')]
+    extended_cart = ((shifts + cell_frac[None, :, :]).reshape(-1, 3)) @ cell
+    extended_z = np.tile(cell_z, len(shifts))
+    subject = np.column_stack((extended_cart[subject_rows], extended_z[subject_rows]))
+    keep = np.zeros(len(extended_cart), dtype=bool)
+    step = max(1, 2 ** 22 // len(subject))
+    for chunk in range(0, len(extended_cart), step):
+        d = np.linalg.norm(extended_cart[chunk:chunk + step, None, :] - subject[None, :, :3], axis=-1)
+        keep[chunk:chunk + step] = np.any(d <= rmax, axis=1)
+    extended = np.column_stack((extended_cart[keep], extended_z[keep]))
+    print(f"<utils.expand_cif_supercell> {len(subject)} subject atoms, {len(cell_frac)} atoms per cell, "
+          f"{len(shifts)} cell translations, {len(extended)} atoms within {rmax}")
+    return subject, extended, asym_index[subject_rows]
+
+
+def periodic_pair_vectors(subject, cell_atoms, lattice, rmax, bin_width=None):
+    """
+    Interatomic vectors from each subject atom to every periodic image of the unit cell
+    atoms within rmax. Candidate images are found with a cell list over the periodic
+    cell, so only the lattice translations that can reach rmax are generated
+    :param subject: (N, 3+) cartesian coordinates of the subject atoms
+    :param cell_atoms: (M, 3+) cartesian coordinates of the atoms in one unit cell
+    :param lattice: (3, 3) lattice vectors as rows
+    :param rmax: probe radius
+    :param bin_width: approximate cell-list bin width, defaults to rmax / 2
+    :return: (K, 3) vectors r_j - r_i, (K,) magnitudes, (K,) subject index i, (K,) cell atom index j
+    """
+    lattice = np.asarray(lattice, dtype=float)
+    inv_lattice = np.linalg.inv(lattice)
+    if bin_width is None:
+        bin_width = rmax / 2
+    # Interplanar spacings set the number of bins along each lattice vector
+    recip_norm = np.linalg.norm(inv_lattice, axis=0)
+    n_bins = np.maximum(1, np.floor(1.0 / (recip_norm * bin_width))).astype(int)
+    cell_frac = cell_atoms[:, :3] @ inv_lattice
+    cell_frac = cell_frac - np.floor(cell_frac)
+    atom_bin = np.minimum((cell_frac * n_bins).astype(int), n_bins - 1)
+    flat_bin = np.ravel_multi_index(atom_bin.T, n_bins)
+    order = np.argsort(flat_bin, kind='stable')
+    bin_starts = np.searchsorted(flat_bin[order], np.arange(np.prod(n_bins) + 1))
+    # Half the longest body diagonal of a bin bounds the distance from its centre to any atom in it
+    corners = np.array([[1, 1, 1], [1, 1, -1], [1, -1, 1], [-1, 1, 1]]) / n_bins
+    bin_radius = 0.5 * np.max(np.linalg.norm(corners @ lattice, axis=1))
+    extent = rmax * recip_norm
+    vectors, mags, i_index, j_index = [], [], [], []
+    for i, s_frac in enumerate(subject[:, :3] @ inv_lattice):
+        lo = np.floor((s_frac - extent) * n_bins).astype(int)
+        hi = np.floor((s_frac + extent) * n_bins).astype(int)
+        image_bins = np.stack(np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(lo, hi)], indexing='ij'),
+                              axis=-1).reshape(-1, 3)
+        centres = ((image_bins + 0.5) / n_bins - s_frac) @ lattice
+        image_bins = image_bins[np.linalg.norm(centres, axis=1) <= rmax + bin_radius]
+        shifts = np.floor_divide(image_bins, n_bins)
+        home = np.ravel_multi_index((image_bins - shifts * n_bins).T, n_bins)
+        counts = bin_starts[home + 1] - bin_starts[home]
+        owner = np.repeat(np.arange(len(home)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        atoms_j = order[bin_starts[home][owner] + offsets]
+        r_ij = (cell_frac[atoms_j] + shifts[owner] - s_frac) @ lattice
+        mag = np.linalg.norm(r_ij, axis=1)
+        # Skip the subject atom itself (to within rounding of the fractional wrap)
+        keep = (mag < rmax) & (mag > 1e-6)
+        vectors.append(r_ij[keep])
+        mags.append(mag[keep])
+        i_index.append(np.full(np.count_nonzero(keep), i))
+        j_index.append(atoms_j[keep])
+    return np.concatenate(vectors), np.concatenate(mags), np.concatenate(i_index), np.concatenate(j_index)
+
+
+def environment_fingerprints(vectors, subject_index, n_subject, decimals=3, n_angular=32):
+    """
+    Groups subject atoms with matching local environments. The fingerprint of an atom is its
+    sorted list of (|r|, Z product) over all its interatomic vectors plus the sorted cosines
+    between the vectors to its nearest neighbour shells (at least n_angular neighbours),
+    rounded to the given decimals
+    :param vectors: interatomic vector table [dx, dy, dz, |r|, Z_i * Z_j, ...]
+    :param subject_index: subject atom each vector starts from
+    :param n_subject: number of subject atoms
+    :return: (n_subject,) int group label of each subject atom
+    """
+    order = np.argsort(subject_index, kind='stable')
+    splits = np.searchsorted(subject_index[order], np.arange(1, n_subject))
+    keys = {}
+    labels = np.zeros(n_subject, dtype=int)
+    for i, rows in enumerate(np.split(order, splits)):
+        env = vectors[rows]
+        dist = np.round(env[:, 3], decimals)
+        order = np.lexsort((env[:, 4], dist))
+        env, dist = env[order], dist[order]
+        # Complete neighbour shells up to the n_angular-th neighbour
+        near = env[dist <= dist[min(n_angular, len(dist)) - 1], :3] if len(dist) else env[:, :3]
+        near = near / np.linalg.norm(near, axis=1)[:, None]
+        cosines = np.sort(np.round((near @ near.T)[np.triu_indices(len(near), 1)], decimals))
+        key = (tuple(dist), tuple(env[:, 4]), tuple(cosines))
+        labels[i] = keys.setdefault(key, len(keys))
+    return labels
+
+
 def subject_atom_reader(raw, ucds=None):
     """
-    An exceedingly ungainly function for reading
-    in various file types
+    Reads the subject atoms from a CIF (asymmetric unit, cartesian coordinates
+    from the full cell matrix) or an xyz file
+    :param raw: path to the CIF or xyz
+    :param ucds: optional unit cell lengths overriding those in the CIF
+    :return: (N, 4) array [x, y, z, Z]
     """
     print("Finding the subject atoms [subject_atom_reader]...")
     if raw[-3:] == 'cif':
-        atom_loop_count = 0  # counts the number of _atom_ labels
-        atoms = []
-        with open(raw, 'r') as foo:
-            for line in foo:
-                if '_atom_site_' in line:
-                    atom_loop_count += 1
-        with open(raw, 'r') as foo:
-            if atom_loop_count == 8:
-                for line in foo:
-                    sploot = line.split()
-                    if len(sploot) == atom_loop_count:  # VESTA TYPE
-                        if sploot[7] != 'H':
-                            if "(" in sploot[2]:
-                                subsploot = sploot[2].split("(")
-                                raw_x = float(subsploot[0])
-                            else:
-                                raw_x = float(sploot[2])
-                            if "(" in sploot[3]:
-                                subsploot = sploot[3].split("(")
-                                raw_y = float(subsploot[0])
-                            else:
-                                raw_y = float(sploot[3])
-                            if "(" in sploot[4]:
-                                subsploot = sploot[4].split("(")
-                                raw_z = float(subsploot[0])
-                            else:
-                                raw_z = float(sploot[4])
-                            raw_atom = [float(raw_x * ucds[0]), float(raw_y * ucds[1]),
-                                        float(raw_z * ucds[2])]
-                            atoms.append(raw_atom)
-            elif atom_loop_count == 5:  # AM TYPE
-                for line in foo:
-                    sploot = line.split()
-                    if len(sploot) == atom_loop_count:
-                        if sploot[1][0] != 'H':
-                            if "(" in sploot[2]:
-                                subsploot = sploot[2].split("(")
-                                raw_x = float(subsploot[0])
-                            else:
-                                raw_x = float(sploot[2])
-                            if "(" in sploot[3]:
-                                subsploot = sploot[3].split("(")
-                                raw_y = float(subsploot[0])
-                            else:
-                                raw_y = float(sploot[3])
-                            if "(" in sploot[4]:
-                                subsploot = sploot[4].split("(")
-                                raw_z = float(subsploot[0])
-                            else:
-                                raw_z = float(sploot[4])
-                            raw_atom = [float(raw_x * ucds[0]), float(raw_y * ucds[1]),
-                                        float(raw_z * ucds[2])]
-                            atoms.append(raw_atom)
+        items, loops = read_cif(raw)
+        frac, z = cif_asymmetric_unit(loops)
+        atoms = np.column_stack((frac @ cif_cell(items, ucds), z))
     elif raw[-3:] == 'xyz':
         atoms = read_xyz(raw)
     else:
         print("WARNING: model_padf couldn't understand your subject_atom_name")
-        atoms = []
+        atoms = np.zeros((0, 4))
     print("Asymmetric unit contains ", len(atoms), " atoms found in ", raw)
-    np.array(atoms)
-
     return atoms
 
 
@@ -163,15 +602,113 @@ def cossim_measure(array_a, array_b):
     return sim
 
 
+def stratified_order(strata, rng):
+    """
+    Visiting order for a set of items such that every prefix of the order samples each
+    stratum in proportion to its size (systematic proportional allocation). The order
+    within each stratum is random
+    :param strata: (N,) int stratum label of each item
+    :param rng: numpy Generator
+    :return: (N,) permutation
+    """
+    order = rng.permutation(len(strata))
+    _, inverse, counts = np.unique(strata[order], return_inverse=True, return_counts=True)
+    by_stratum = np.argsort(inverse, kind='stable')
+    rank = np.empty(len(strata))
+    rank[by_stratum] = np.arange(len(strata)) - np.repeat(np.cumsum(counts) - counts, counts)
+    position = (rank + rng.random(len(counts))[inverse]) / counts[inverse]
+    return order[np.argsort(position, kind='stable')]
+
+
 def calc_rfactor(array_a, array_b):
-    delta = 0.0
-    yobs = 0.0
-    for i, dp in enumerate(array_b):
-        delta = delta + (array_b[i, 1] - array_a[i, 1]) ** 2
-        yobs = yobs + (array_b[i, 1]) ** 2
-    r_p = np.sqrt(delta / yobs)
-    # print(f'R_p : {r_p}')
-    return r_p
+    """
+    R-factor of the curve array_a against the observed curve array_b, both [r, value] rows
+    :return: sqrt(sum (b - a)^2 / sum b^2) over the values
+    """
+    return rfactor_scores(array_b, [array_a[:len(array_b)]], column=1)[0]
+
+
+def sequential_sum(values, axis=-1):
+    """
+    Sum accumulated element by element in order, as a Python loop adds them (np.sum adds pairwise,
+    which rounds differently)
+    """
+    return np.cumsum(values, axis=axis).take(-1, axis=axis)
+
+
+def candidate_blocks(candidates, max_bytes=1 << 28):
+    """
+    Reads stacked candidate arrays a block of at most max_bytes at a time
+    :param candidates: (M, ...) array, memory-mapped array or HDF5 dataset (e.g. frames/total of a
+    trajectory container), or a sequence of M arrays (e.g. from theta_memmaps)
+    :return: generator of (m, ...) arrays
+    """
+    if hasattr(candidates, 'shape') and hasattr(candidates, 'dtype'):
+        item_bytes = int(np.prod(candidates.shape[1:])) * candidates.dtype.itemsize
+        step = max(1, max_bytes // max(item_bytes, 1))
+        for lo in range(0, len(candidates), step):
+            yield np.asarray(candidates[lo:lo + step])
+    elif len(candidates):
+        step = max(1, max_bytes // max(np.asarray(candidates[0]).nbytes, 1))
+        for lo in range(0, len(candidates), step):
+            yield np.stack([np.asarray(c) for c in candidates[lo:lo + step]])
+
+
+def score_values(array, column=None, stacked=False):
+    """
+    Values compared by the scores: every element, or one column of the last axis, flattened
+    (per candidate if stacked)
+    """
+    array = np.asarray(array)
+    if column is not None:
+        array = array[..., column]
+    return array.reshape(len(array), -1) if stacked else array.reshape(-1)
+
+
+def rfactor_scores(reference, candidates, column=None, max_bytes=1 << 28):
+    """
+    R-factor of every candidate against the reference in one call. The sums are accumulated in
+    order, so each score equals calc_rfactor(candidate, reference) exactly
+    :param reference: observed array, e.g. an (N, 2) PDF or an (nr, nr, nth) Theta
+    :param candidates: M arrays of the reference's shape, see candidate_blocks
+    :param column: compare only this column of the last axis (1 for [r, value] curves), None for every element
+    :param max_bytes: candidates read at once
+    :return: (M,) array of R-factors
+    """
+    ref = score_values(reference, column)
+    # float_power squares through pow(), like the scalar ** 2 of the element loop (np.square can round differently)
+    yobs = sequential_sum(np.float_power(ref, 2))
+    scores = [np.zeros(0)]
+    for block in candidate_blocks(candidates, max_bytes):
+        delta = sequential_sum(np.float_power(ref - score_values(block, column, stacked=True), 2), axis=1)
+        scores.append(np.sqrt(delta / yobs))
+    return np.concatenate(scores)
+
+
+def cossim_scores(reference, candidates, column=None, max_bytes=1 << 28):
+    """
+    Cosine similarity of every candidate with the reference in one call, equal to
+    cossim_measure(candidate, reference). The reference norm is only computed once
+    :param reference: e.g. an experimental (nr, nr, nth) Theta
+    :param candidates: M arrays of the reference's shape, see candidate_blocks
+    :param column: compare only this column of the last axis, None for every element
+    :param max_bytes: candidates read at once
+    :return: (M,) array of similarities
+    """
+    ref = score_values(reference, column)
+    ref_norm = np.linalg.norm(ref)
+    scores = []
+    for block in candidate_blocks(candidates, max_bytes):
+        for values in score_values(block, column, stacked=True):
+            scores.append(np.dot(values, ref) / (np.linalg.norm(values) * ref_norm))
+    return np.array(scores)
+
+
+def theta_memmaps(paths):
+    """
+    Memory-mapped Theta volumes (.npy), e.g. candidate models for rfactor_scores and cossim_scores
+    """
+    return [np.load(path, mmap_mode='r') for path in paths]
 
 
 def output_reference_xyz(atom_list, path):
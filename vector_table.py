@@ -0,0 +1,131 @@
+"""
+Columnar interatomic vector table
+
+Each column of the table is its own contiguous array, with the smallest dtype that
+holds it, so the accumulation loop streams only the columns it needs per contact.
+
+@author: andrewmartin, jack-binns
+"""
+import numpy as np
+
+import utils as u
+
+VALUE_DECIMALS = 9  # decimals (of an angstrom) two vectors must agree to to count as identical
+
+
+def value_keys(a):
+    """
+    [dx, dy, dz, |r|, Z_i * Z_j] of each row rounded to VALUE_DECIMALS, so vectors that only
+    differ by rounding (e.g. symmetry images of the same vector) count as identical
+    """
+    return np.round(np.asarray(a, dtype=np.float64)[..., :5], VALUE_DECIMALS) + 0.0
+
+
+class InteratomicVectorTable:
+    """
+    Columns:
+        xyz :       (3, N) vector components dx, dy, dz
+        r :         (N,) vector length |r|
+        unit :      (3, N) unit vector components ux, uy, uz
+        z_product : (N,) uint16 product of the atomic numbers Z_i * Z_j
+        pair_code : (N,) uint8 (uint16 for more than 256 species pairs) species pair code
+        subject :   (N,) uint32 index of the subject atom the vector starts from
+        r_bin :     (N,) uint16 radial bin of |r|
+        value_id :  (N,) uint32 label of the distinct [dx, dy, dz, |r|, Z_i * Z_j] values (value_keys),
+                    computed in float64 so identical vectors are found whatever the float dtype
+        probe_level : (N,) uint8 number of probe radii of a sweep that are <= |r| (all zero without a sweep),
+                    so the vector is inside the probe radii from index probe_level on
+    Floats are stored as dtype (float32 by default, ~42 bytes per vector)
+    """
+
+    def __init__(self, xyz, r, unit, z_product, pair_code, subject, r_bin, value_id, dtype=np.float32,
+                 probe_level=None):
+        self.dtype = np.dtype(dtype)
+        self.xyz = np.ascontiguousarray(xyz, dtype=self.dtype)
+        self.r = np.ascontiguousarray(r, dtype=self.dtype)
+        self.unit = np.ascontiguousarray(unit, dtype=self.dtype)
+        self.z_product = np.ascontiguousarray(z_product, dtype=np.uint16)
+        self.pair_code = np.ascontiguousarray(
+            pair_code, dtype=np.uint8 if len(pair_code) == 0 or np.max(pair_code) < 256 else np.uint16)
+        self.subject = np.ascontiguousarray(subject, dtype=np.uint32)
+        self.r_bin = np.ascontiguousarray(r_bin, dtype=np.uint16)
+        self.value_id = np.ascontiguousarray(value_id, dtype=np.uint32)
+        self.probe_level = np.zeros(len(self.r), dtype=np.uint8) if probe_level is None \
+            else np.ascontiguousarray(probe_level, dtype=np.uint8)
+        self.value_order = None  # rows sorted by value_id, built by same_as on first use
+        self.value_start = None
+
+    @classmethod
+    def from_array(cls, a, r_bin_edges, dtype=np.float32, probe_radii=()):
+        """
+        Builds the table from a float64 array [dx, dy, dz, |r|, Z_i * Z_j, species pair code, subject atom index].
+        The radial bins, unit vectors and probe levels are computed at full precision before the cast
+        :param a: (N, 7) interatomic vector array
+        :param r_bin_edges: edges from utils.r_bin_edges
+        :param dtype: float dtype of the vector columns
+        :param probe_radii: probe radii of a sweep
+        :return: InteratomicVectorTable
+        """
+        a = np.asarray(a, dtype=np.float64).reshape(-1, 7)
+        _, value_id = np.unique(value_keys(a), axis=0, return_inverse=True)
+        return cls(xyz=a[:, :3].T, r=a[:, 3], unit=(a[:, :3] / a[:, 3:4]).T, z_product=np.rint(a[:, 4]),
+                   pair_code=a[:, 5].astype(int), subject=a[:, 6].astype(int),
+                   r_bin=u.r_bin_index(a[:, 3], r_bin_edges), value_id=value_id.ravel(),
+                   dtype=dtype, probe_level=np.searchsorted(np.sort(probe_radii), a[:, 3], side='right'))
+
+    def __len__(self):
+        return len(self.r)
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in self.columns().values())
+
+    def subset(self, index):
+        """
+        New table of the selected rows
+        :param index: boolean mask or integer indices
+        :return: InteratomicVectorTable
+        """
+        return InteratomicVectorTable(self.xyz[:, index], self.r[index], self.unit[:, index], self.z_product[index],
+                                      self.pair_code[index], self.subject[index], self.r_bin[index],
+                                      self.value_id[index], dtype=self.dtype, probe_level=self.probe_level[index])
+
+    def same_as(self, other, k):
+        """
+        Rows equal to row k of other in dx, dy, dz, |r| and Z_i * Z_j. other must be this table
+        or a subset of it, so the value labels agree
+        :return: int array of row indices
+        """
+        if self.value_order is None:
+            self.value_order = np.argsort(self.value_id, kind='stable')
+            self.value_start = np.searchsorted(self.value_id[self.value_order],
+                                               np.arange(int(self.value_id.max(initial=0)) + 2))
+        v = other.value_id[k]
+        return self.value_order[self.value_start[v]:self.value_start[v + 1]]
+
+    def as_array(self):
+        """
+        The table as a float64 array [dx, dy, dz, |r|, Z_i * Z_j, species pair code, subject atom index]
+        """
+        return np.column_stack((self.xyz.T, self.r, self.z_product, self.pair_code, self.subject)).astype(np.float64)
+
+    def columns(self):
+        """
+        dict of column name : array
+        """
+        return {'xyz': self.xyz, 'r': self.r, 'unit': self.unit, 'z_product': self.z_product,
+                'pair_code': self.pair_code, 'subject': self.subject, 'r_bin': self.r_bin, 'value_id': self.value_id,
+                'probe_level': self.probe_level}
+
+    def save(self, path):
+        """
+        Writes the columns to an npz
+        """
+        np.savez(path, **self.columns())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['xyz'], f['r'], f['unit'], f['z_product'], f['pair_code'], f['subject'], f['r_bin'],
+                       f['value_id'], dtype=f['r'].dtype,
+                       probe_level=f['probe_level'] if 'probe_level' in f.files else None)
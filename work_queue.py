@@ -0,0 +1,179 @@
+"""
+File-based work queue
+
+A job manifest (manifest.json) lists the jobs of a run. Workers, possibly on different
+nodes sharing the filesystem, claim a job by creating its lock file with O_CREAT | O_EXCL,
+which succeeds for exactly one of them. The worker touches its lock while the job runs, so
+a lock that has not been touched for stale_after seconds belongs to a dead worker and may be
+stolen. A finished job leaves a .done marker next to its lock, a failed one a .failed marker
+with the traceback. No services are needed beyond
+the shared filesystem.
+
+@author: andrewmartin, jack-binns
+"""
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+HEARTBEAT_INTERVAL = 60.0  # seconds between touches of a running job's lock when no stale_after is given
+
+
+def write_manifest(jobs_dir, parameters, jobs):
+    """
+    Writes the job manifest
+    :param jobs_dir: directory for the manifest, locks and markers
+    :param parameters: dict of run parameters, must be JSON serialisable
+    :param jobs: list of job dicts, each with a unique 'id'
+    :return: path to the manifest
+    """
+    os.makedirs(jobs_dir, exist_ok=True)
+    path = os.path.join(jobs_dir, 'manifest.json')
+    tmp = path + f'.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'parameters': parameters, 'jobs': jobs}, f, indent=2)
+    os.replace(tmp, path)
+    print(f'<work_queue.write_manifest> {len(jobs)} jobs written to {path}')
+    return path
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def marker(jobs_dir, job_id, kind):
+    return os.path.join(jobs_dir, f'{job_id}.{kind}')
+
+
+def job_state(jobs_dir, job_id):
+    """
+    :return: 'done', 'failed', 'running' or 'pending'
+    """
+    for kind in ('done', 'failed'):
+        if os.path.exists(marker(jobs_dir, job_id, kind)):
+            return kind
+    if os.path.exists(marker(jobs_dir, job_id, 'lock')):
+        return 'running'
+    return 'pending'
+
+
+def steal_stale_lock(jobs_dir, job_id, stale_after):
+    """
+    Removes the lock of a job whose worker has not touched it for stale_after seconds (e.g. the
+    worker died). The lock is renamed away first, so only one worker can take it, and its age is
+    checked on the renamed file. A lock that turns out to be fresh (touched or re-created by
+    another worker since) is put back
+    :return: True if the lock was removed by this worker
+    """
+    lock = marker(jobs_dir, job_id, 'lock')
+    if job_state(jobs_dir, job_id) != 'running':
+        return False
+    try:
+        if time.time() - os.path.getmtime(lock) < stale_after:
+            return False
+        taken = lock + f'.stale.{socket.gethostname()}.{os.getpid()}'
+        os.rename(lock, taken)
+    except FileNotFoundError:
+        return False
+    if time.time() - os.path.getmtime(taken) < stale_after:
+        try:
+            os.link(taken, lock)  # fails rather than replace a lock created in the meantime
+        except FileExistsError:
+            pass
+        os.remove(taken)
+        return False
+    print(f'<work_queue.steal_stale_lock> Stale lock on {job_id} removed')
+    return True
+
+
+def claim(jobs_dir, job_id, stale_after=None):
+    """
+    Claims a job by creating its lock file. The lock stays after the job finishes,
+    so a job is only ever claimed once (unless its lock goes stale)
+    :param stale_after: seconds since a running job's lock was last touched after which it may be
+    stolen, None never
+    :return: True if this worker now owns the job
+    """
+    lock = marker(jobs_dir, job_id, 'lock')
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if stale_after is not None and steal_stale_lock(jobs_dir, job_id, stale_after):
+            return claim(jobs_dir, job_id)
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}, f)
+    return True
+
+
+class LockHeartbeat:
+    """
+    Touches a lock file every interval seconds from a background thread while in the with block
+    """
+
+    def __init__(self, lock, interval):
+        self.lock = lock
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    def beat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.lock)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_worker(jobs_dir, jobs, run_job, stale_after=None, max_jobs=None):
+    """
+    Claims and runs jobs until none are left
+    :param jobs: list of job dicts from the manifest
+    :param run_job: callable run_job(job)
+    :param stale_after: seconds after which a running job's lock may be stolen, None never.
+    The lock of the running job is touched every stale_after / 4 seconds
+    :param max_jobs: stop after this many jobs, None for no limit
+    :return: number of jobs run by this worker
+    """
+    interval = stale_after / 4 if stale_after is not None else HEARTBEAT_INTERVAL
+    n_run = 0
+    for job in jobs:
+        if max_jobs is not None and n_run >= max_jobs:
+            break
+        if not claim(jobs_dir, job['id'], stale_after):
+            continue
+        print(f"<work_queue.run_worker> {socket.gethostname()}:{os.getpid()} running {job['id']}")
+        start = time.time()
+        try:
+            with LockHeartbeat(marker(jobs_dir, job['id'], 'lock'), interval):
+                run_job(job)
+        except Exception:
+            with open(marker(jobs_dir, job['id'], 'failed'), 'w') as f:
+                f.write(traceback.format_exc())
+            print(f"<work_queue.run_worker> {job['id']} failed, see {marker(jobs_dir, job['id'], 'failed')}")
+        else:
+            with open(marker(jobs_dir, job['id'], 'done'), 'w') as f:
+                json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time_s': time.time() - start}, f)
+        n_run += 1
+    return n_run
+
+
+def queue_status(jobs_dir, jobs):
+    """
+    :return: dict of the job ids in each state
+    """
+    status = {'pending': [], 'running': [], 'done': [], 'failed': []}
+    for job in jobs:
+        status[job_state(jobs_dir, job['id'])].append(job['id'])
+    return status